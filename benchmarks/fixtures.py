@@ -0,0 +1,173 @@
+"""
+Synthetic inputs for the stage benchmarks.
+
+Reads are random sequence with Phred+33 qualities, a fraction of them ending in the
+Illumina adapter so that a real Trim Galore has something to trim. Paired-end mates
+share their read names, like the files run_pipeline downloads.
+"""
+
+import gzip
+import os
+from typing import Dict, List
+
+import numpy as np
+
+ADAPTER = b"AGATCGGAAGAGC"
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+CHUNK_READS = 50_000
+
+# S. cerevisiae R64-1-1, the genome the pipeline runs on
+CHROM_SIZES = {
+    "I": 230218,
+    "II": 813184,
+    "III": 316620,
+    "IV": 1531933,
+    "IX": 439888,
+    "V": 576874,
+    "VI": 270161,
+    "VII": 1090940,
+    "VIII": 562643,
+    "X": 745751,
+    "XI": 666816,
+    "XII": 1078177,
+    "XIII": 924431,
+    "XIV": 784333,
+    "XV": 1091291,
+    "XVI": 948066,
+}
+
+
+def _open(path: str, mode: str):
+    if path.endswith(".gz"):
+        # Level 1 keeps fixture generation fast, the files are only read
+        return gzip.open(path, mode, compresslevel=1)
+    return open(path, mode)
+
+
+def write_fastq(
+    path: str,
+    n_reads: int,
+    read_length: int = 100,
+    mate: int = None,
+    adapter_fraction: float = 0.1,
+    seed: int = 0,
+) -> int:
+    """Writes n_reads random FASTQ records to path (gzipped if it ends with .gz).
+
+    Args:
+        mate (int): 1 or 2 to append /1 or /2 to the read names of paired files
+
+    Returns:
+        int: size of the written file in bytes
+    """
+    # The same seed for both mates would make them identical
+    rng = np.random.default_rng(seed * 3 + (mate or 0))
+    suffix = f"/{mate}".encode() if mate else b""
+    name = os.path.basename(path).split(".")[0].split("_")[0].encode()
+
+    with _open(path, "wb") as f:
+        for start in range(0, n_reads, CHUNK_READS):
+            k = min(CHUNK_READS, n_reads - start)
+            seqs = BASES[rng.integers(0, 4, (k, read_length))]
+            quals = rng.integers(33 + 2, 33 + 41, (k, read_length), dtype=np.uint8)
+
+            with_adapter = np.flatnonzero(rng.random(k) < adapter_fraction)
+            positions = rng.integers(read_length // 2, read_length, len(with_adapter))
+            for row, pos in zip(with_adapter, positions):
+                n = min(len(ADAPTER), read_length - pos)
+                seqs[row, pos : pos + n] = np.frombuffer(ADAPTER[:n], dtype=np.uint8)
+
+            chunk = []
+            for i in range(k):
+                chunk.append(
+                    b"@%s.%d%s\n%s\n+\n%s\n"
+                    % (name, start + i, suffix, seqs[i].tobytes(), quals[i].tobytes())
+                )
+            f.write(b"".join(chunk))
+
+    return os.path.getsize(path)
+
+
+def write_sample(
+    directory: str,
+    accession: str,
+    n_reads: int,
+    paired: bool,
+    read_length: int = 100,
+    seed: int = 0,
+) -> List[str]:
+    """Writes the gzipped read files of a sample, named like the ones in blob storage.
+
+    Returns:
+        List[str]: `{accession}.fastq.gz` or `{accession}_{1,2}.fastq.gz`
+    """
+    os.makedirs(directory, exist_ok=True)
+
+    if paired:
+        paths = [os.path.join(directory, f"{accession}_{m}.fastq.gz") for m in (1, 2)]
+        for mate, path in enumerate(paths, start=1):
+            write_fastq(path, n_reads, read_length, mate=mate, seed=seed)
+    else:
+        paths = [os.path.join(directory, f"{accession}.fastq.gz")]
+        write_fastq(paths[0], n_reads, read_length, seed=seed)
+
+    return paths
+
+
+def write_chrom_sizes(path: str, chrom_sizes: Dict[str, int] = CHROM_SIZES) -> None:
+    """Writes chromosome sizes as `name<TAB>length`, like STAR's chrNameLength.txt."""
+    with open(path, "w") as f:
+        for chrom, size in chrom_sizes.items():
+            f.write(f"{chrom}\t{size}\n")
+
+
+def read_chrom_sizes(path: str) -> Dict[str, int]:
+    with open(path) as f:
+        return {
+            chrom: int(size) for chrom, size in (line.split()[:2] for line in f if line)
+        }
+
+
+def write_wig(
+    path: str,
+    chrom_sizes: Dict[str, int] = CHROM_SIZES,
+    n_positions: int = 100_000,
+    seed: int = 0,
+) -> int:
+    """Writes a variableStep wiggle file like STAR's Signal.*.out.wig.
+
+    Positions are spread over the chromosomes proportionally to their size.
+
+    Returns:
+        int: size of the written file in bytes
+    """
+    rng = np.random.default_rng(seed)
+    genome_size = sum(chrom_sizes.values())
+
+    with open(path, "w") as f:
+        for chrom, size in chrom_sizes.items():
+            n = max(1, min(size, n_positions * size // genome_size))
+            positions = np.sort(rng.choice(size, n, replace=False)) + 1
+            values = rng.exponential(2.0, n) + 0.01
+            f.write(f"variableStep chrom={chrom}\n")
+            f.writelines(f"{p}\t{v:.5f}\n" for p, v in zip(positions, values))
+
+    return os.path.getsize(path)
+
+
+def write_transcripts(
+    path: str, n_transcripts: int = 6000, length: int = 1500, seed: int = 0
+) -> int:
+    """Writes random transcripts as gzipped FASTA, like salmon's gentrome.
+
+    Returns:
+        int: size of the written file in bytes
+    """
+    rng = np.random.default_rng(seed)
+
+    with _open(path, "wb") as f:
+        for i in range(n_transcripts):
+            seq = BASES[rng.integers(0, 4, length)].tobytes()
+            f.write(b">transcript%d\n%s\n" % (i, seq))
+
+    return os.path.getsize(path)
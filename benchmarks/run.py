@@ -0,0 +1,474 @@
+"""
+Benchmarks the Python orchestration of every stage wrapper on synthetic reads.
+
+For each read layout (single, paired) and sample size, a sample is written to
+/data/pl-bench-*/reads and fastqc, trimgalore, STARAlign.align (including the
+bigWig conversion of the signal tracks), infer_strandedness (with the salmon and the
+k-mer engine) and upload_results are run locally through Modal's `.local()`, in the
+order run_pipeline runs them. Real tools are used where they are installed (at the
+path the stage uses in its image or on PATH, STAR and salmon only with an index),
+stubs from stubs.py otherwise. The volume is replaced by a local no-op and, unless
+--real-upload is given, the results container by a local directory.
+
+Every stage runs once with force_recompute=True and once more to measure the cache
+check. The report lists per stage
+- wall: time of the stage call
+- tool: time spent in the tools (or the transfer), from the stage's metrics records
+- overhead: wall - tool, i.e. the orchestration layer
+- reads/s and MB/s of input, and the time of the cached call
+
+Run it from the repository root with rnaseqpipe installed and /data writable (e.g. in
+a Linux container):
+
+    python benchmarks/run.py --reads 10000,100000 --json bench.json
+    python benchmarks/run.py --baseline bench.json  # exit code 1 on regressions
+"""
+
+import argparse
+import glob
+import importlib.util
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import Dict, List
+
+import fixtures
+from stubs import install_stubs
+
+STAGES = [
+    "fastqc",
+    "trimgalore",
+    "staralign",
+    "infer_strandedness",
+    "strandedness_kmer",
+    "upload",
+]
+
+# Metrics records that belong to a stage call (see rnaseqpipe.modules.metrics)
+STAGE_RECORDS = {
+    "fastqc": ["fastqc"],
+    "trimgalore": ["trimgalore"],
+    "staralign": ["staralign", "bigwig"],
+    "infer_strandedness": ["subsample", "salmon"],
+    "strandedness_kmer": ["strandedness_kmer"],
+    "upload": ["upload"],
+}
+
+BENCH_ASSEMBLY = "bench"
+
+
+class LocalVolume:
+    """Stand-in for the Modal volume outside a container, counts commits and reloads."""
+
+    def __init__(self) -> None:
+        self.commits = 0
+        self.reloads = 0
+
+    def commit(self) -> None:
+        self.commits += 1
+
+    def reload(self) -> None:
+        self.reloads += 1
+
+
+class DirectoryBlobService:
+    """Stand-in for BlobServiceClient that stores blobs in a local directory."""
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        # Content settings of the blobs, like the properties Azure keeps per blob
+        self.content_settings = {}
+
+    def from_connection_string(self, connect_str: str, **kwargs):
+        return self
+
+    def get_container_client(self, container: str) -> "DirectoryContainer":
+        return DirectoryContainer(self, os.path.join(self.root, container))
+
+
+class DirectoryContainer:
+    def __init__(self, service: DirectoryBlobService, root: str) -> None:
+        self.service = service
+        self.root = root
+
+    def get_blob_client(self, name: str) -> "DirectoryBlob":
+        return DirectoryBlob(self.service, os.path.join(self.root, name))
+
+    def list_blobs(self, name_starts_with: str = None):
+        for path in sorted(glob.glob(f"{self.root}/**", recursive=True)):
+            name = os.path.relpath(path, self.root)
+            if os.path.isfile(path) and name.startswith(name_starts_with or ""):
+                yield SimpleNamespace(
+                    name=name,
+                    size=os.path.getsize(path),
+                    etag=str(os.stat(path).st_mtime_ns),
+                    content_settings=self.service.content_settings.get(path),
+                )
+
+
+class DirectoryBlob:
+    def __init__(self, service: DirectoryBlobService, path: str) -> None:
+        self.service = service
+        self.path = path
+
+    def upload_blob(
+        self, data, overwrite: bool = False, content_settings=None, **kwargs
+    ):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "wb") as f:
+            shutil.copyfileobj(data, f)
+        self.service.content_settings[self.path] = content_settings
+        return {"etag": str(os.stat(self.path).st_mtime_ns)}
+
+
+def load_stage_modules() -> Dict:
+    """Imports the stage modules, trim-galore.py is not importable by name."""
+    import rnaseqpipe.modules as modules_pkg
+    from rnaseqpipe.modules import fastqc, staralign, uploader
+    from rnaseqpipe.modules.infer_strandedness import main as strandedness
+
+    path = os.path.join(os.path.dirname(modules_pkg.__file__), "trim-galore.py")
+    spec = importlib.util.spec_from_file_location("trimgalore", path)
+    trimgalore = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(trimgalore)
+
+    return {
+        "fastqc": fastqc,
+        "trimgalore": trimgalore,
+        "staralign": staralign,
+        "infer_strandedness": strandedness,
+        "upload": uploader,
+    }
+
+
+def _executable(path: str) -> bool:
+    return os.path.isfile(path) and os.access(path, os.X_OK)
+
+
+def resolve_tools(modules: Dict, bench_dir: str, args) -> Dict[str, str]:
+    """Points the stage modules at real tools where available, at stubs otherwise.
+
+    Returns:
+        Dict[str, str]: stage -> "real" or "stub"
+    """
+    from rnaseqpipe.modules import genomes, salmonindex
+    from rnaseqpipe.modules.strandedness import build_index, index_path, save_index
+
+    stubs = install_stubs(os.path.join(bench_dir, "bin"))
+    staralign = modules["staralign"]
+    strandedness = modules["infer_strandedness"]
+
+    def real(default: str, name: str) -> str:
+        if args.stubs_only:
+            return None
+        if _executable(default):
+            return default
+        return shutil.which(name)
+
+    tools = {}
+
+    fastqc_bin = real(modules["fastqc"].FASTQC_BIN, "fastqc")
+    modules["fastqc"].FASTQC_BIN = fastqc_bin or stubs["fastqc"]
+    tools["fastqc"] = "real" if fastqc_bin else "stub"
+
+    trimgalore_bin = real(modules["trimgalore"].TRIMGALORE_BIN, "trim_galore")
+    modules["trimgalore"].TRIMGALORE_BIN = trimgalore_bin or stubs["trim_galore"]
+    tools["trimgalore"] = "real" if trimgalore_bin else "stub"
+
+    # STAR and the bigwigs use the index of the default assembly
+    star_bin = real(staralign.STAR_BIN, "STAR")
+    genome_index = genomes.genome_dir(genomes.DEFAULT_ASSEMBLY)
+    if star_bin and os.path.exists(f"{genome_index}/genomeParameters.txt"):
+        staralign.STAR_BIN = star_bin
+        tools["staralign"] = "real"
+    else:
+        genome_dir = os.path.join(bench_dir, "genome-index")
+        os.makedirs(genome_dir, exist_ok=True)
+        fixtures.write_chrom_sizes(os.path.join(genome_dir, "chrNameLength.txt"))
+        with open(os.path.join(genome_dir, "genomeParameters.txt"), "w") as f:
+            f.write("### benchmark stub\nversionGenome\t2.7.4a\n")
+        staralign.STAR_BIN = stubs["STAR"]
+        genomes.GENOME_ROOT = bench_dir
+        genomes.GENOME_DIRS[genomes.DEFAULT_ASSEMBLY] = genome_dir
+        tools["staralign"] = "stub"
+
+    salmon_bin = real(strandedness.SALMON_BIN, "salmon")
+    if (
+        salmon_bin
+        and args.assembly
+        and os.path.exists(
+            salmonindex.index_dir(args.assembly, strandedness.SALMON_INDEX_DIR)
+        )
+    ):
+        strandedness.SALMON_BIN = salmon_bin
+        tools["infer_strandedness"] = "real"
+    else:
+        index_dir = os.path.join(bench_dir, "salmon_index")
+        os.makedirs(f"{index_dir}/{BENCH_ASSEMBLY}/transcripts_index", exist_ok=True)
+        with open(
+            f"{index_dir}/{BENCH_ASSEMBLY}/transcripts_index/versionInfo.json", "w"
+        ) as f:
+            json.dump({"indexVersion": 0}, f)
+        strandedness.SALMON_BIN = stubs["salmon"]
+        strandedness.SALMON_INDEX_DIR = index_dir
+        args.assembly = BENCH_ASSEMBLY
+        tools["infer_strandedness"] = "stub"
+
+    # The k-mer engine reads the index make_salmon_index builds into the salmon
+    # index, the stub one is built from random transcripts
+    kmer_index = index_path(
+        salmonindex.index_dir(args.assembly, strandedness.SALMON_INDEX_DIR)
+    )
+    if tools["infer_strandedness"] == "stub":
+        gentrome = os.path.join(bench_dir, "gentrome.fa.gz")
+        fixtures.write_transcripts(gentrome)
+        save_index(build_index(gentrome), kmer_index)
+        tools["strandedness_kmer"] = "stub"
+    elif os.path.exists(kmer_index):
+        tools["strandedness_kmer"] = "real"
+    else:
+        # Without a k-mer index infer_strandedness runs salmon
+        tools["strandedness_kmer"] = "salmon"
+
+    # Never upload to the results container unless asked to
+    if args.real_upload:
+        tools["upload"] = "real"
+    else:
+        modules["upload"].BlobServiceClient = DirectoryBlobService(
+            os.path.join(bench_dir, "blobs")
+        )
+        modules["upload"].ContentSettings = SimpleNamespace
+        tools["upload"] = "stub"
+
+    return tools
+
+
+def _stage_seconds(plid: str, stage: str, since: float) -> float:
+    """Time spent in the tools of a stage call, from the metrics it recorded."""
+    from rnaseqpipe.modules.metrics import load_records, metrics_dir
+
+    return sum(
+        r["wall_seconds"]
+        for r in load_records(metrics_dir(plid))
+        if r["stage"] in STAGE_RECORDS[stage] and r["started"] >= since
+    )
+
+
+def _bytes(paths: List[str]) -> int:
+    return sum(os.path.getsize(p) for p in paths)
+
+
+def bench_sample(
+    modules: Dict, tools: Dict, bench_dir: str, layout: str, n_reads: int, args
+) -> List[Dict]:
+    from rnaseqpipe.modules.utils import PLID, trimmed_read_files
+
+    plid = PLID(f"pl-bench-{layout}-{n_reads}")
+    shutil.rmtree(f"/data/{plid}", ignore_errors=True)
+
+    read_files = fixtures.write_sample(
+        f"/data/{plid}/reads",
+        f"BENCH{n_reads}",
+        n_reads,
+        paired=layout == "paired",
+        read_length=args.read_length,
+    )
+    trimmed = trimmed_read_files(
+        read_files, f"/data/{plid}/trimgalore", compressed=True
+    )
+
+    aligner = modules["staralign"].STARAlign()
+
+    calls = {
+        "fastqc": lambda force: modules["fastqc"].fastqc.local(plid, read_files, force),
+        "trimgalore": lambda force: modules["trimgalore"].trimgalore.local(
+            plid, read_files, force, compress=True, cpu=args.cpu
+        ),
+        "staralign": lambda force: aligner.align.local(
+            plid, trimmed, force, cpu=args.cpu, memory=args.memory
+        ),
+        "infer_strandedness": lambda force: modules[
+            "infer_strandedness"
+        ].infer_strandedness.local(
+            plid, read_files, args.assembly, force, engine="salmon"
+        ),
+        "strandedness_kmer": lambda force: modules[
+            "infer_strandedness"
+        ].infer_strandedness.local(plid, read_files, args.assembly, force),
+        # Uploads are skipped by comparing sizes, so the second call is the cache check
+        "upload": lambda force: modules["upload"].upload_results.local(str(plid)),
+    }
+    inputs = {
+        "fastqc": lambda: _bytes(read_files),
+        "trimgalore": lambda: _bytes(read_files),
+        "staralign": lambda: _bytes(trimmed),
+        "infer_strandedness": lambda: _bytes(read_files),
+        "strandedness_kmer": lambda: _bytes(read_files),
+        "upload": lambda: _bytes(
+            [
+                p
+                for p in glob.glob(f"/data/{plid}/**", recursive=True)
+                if os.path.isfile(p)
+            ]
+        ),
+    }
+
+    results = []
+    for stage in STAGES:
+        walls, tool_seconds = [], []
+        for _ in range(args.repeat):
+            started = time.time()
+            calls[stage](True)
+            walls.append(time.time() - started)
+            tool_seconds.append(_stage_seconds(str(plid), stage, started))
+
+        started = time.time()
+        calls[stage](False)
+        cached = time.time() - started
+
+        wall = statistics.median(walls)
+        tool = statistics.median(tool_seconds)
+        input_bytes = inputs[stage]()
+        results.append(
+            {
+                "stage": stage,
+                "layout": layout,
+                "reads": n_reads,
+                "tool": tools[stage],
+                "wall_seconds": wall,
+                "tool_seconds": tool,
+                "overhead_seconds": wall - tool,
+                "cached_seconds": cached,
+                "input_bytes": input_bytes,
+                "reads_per_second": n_reads / wall,
+                "mb_per_second": input_bytes / 1e6 / wall,
+            }
+        )
+
+    if not args.keep:
+        shutil.rmtree(f"/data/{plid}", ignore_errors=True)
+
+    return results
+
+
+def format_report(results: List[Dict]) -> str:
+    lines = [
+        f"{'stage':<20}{'layout':<8}{'reads':>9}{'tool':>11}{'wall [s]':>10}"
+        f"{'tool [s]':>10}{'overhead [s]':>14}{'reads/s':>11}{'MB/s':>9}{'cached [s]':>12}"
+    ]
+    for r in results:
+        reads_per_second = (
+            f"{r['reads_per_second']:>11.0f}" if r["reads_per_second"] else f"{'-':>11}"
+        )
+        lines.append(
+            f"{r['stage']:<20}{r['layout']:<8}{r['reads']:>9}{r['tool']:>11}"
+            f"{r['wall_seconds']:>10.2f}{r['tool_seconds']:>10.2f}"
+            f"{r['overhead_seconds']:>14.2f}{reads_per_second}"
+            f"{r['mb_per_second']:>9.1f}{r['cached_seconds']:>12.2f}"
+        )
+    return "\n".join(lines)
+
+
+def compare(
+    results: List[Dict], baseline: List[Dict], tolerance: float, floor: float
+) -> List[str]:
+    """Returns the stages whose overhead or cached time regressed against a baseline.
+
+    Differences below floor seconds are ignored, they are within timer noise.
+    """
+    previous = {(r["stage"], r["layout"], r["reads"]): r for r in baseline}
+    regressions = []
+    for r in results:
+        old = previous.get((r["stage"], r["layout"], r["reads"]))
+        if old is None:
+            continue
+        for key in ("overhead_seconds", "cached_seconds"):
+            if r[key] - old[key] > max(floor, old[key] * tolerance):
+                regressions.append(
+                    f"{r['stage']} ({r['layout']}, {r['reads']} reads): {key} "
+                    f"{old[key]:.2f}s -> {r[key]:.2f}s"
+                )
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--reads", default="10000,100000", help="reads per sample, comma separated"
+    )
+    parser.add_argument("--layouts", default="single,paired")
+    parser.add_argument("--read-length", type=int, default=100)
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="runs per stage, the median is reported"
+    )
+    parser.add_argument("--cpu", type=float, default=4.0)
+    parser.add_argument("--memory", type=int, default=8 * 1024)
+    parser.add_argument(
+        "--assembly", help="salmon index assembly when running real salmon"
+    )
+    parser.add_argument(
+        "--stubs-only", action="store_true", help="ignore installed tools"
+    )
+    parser.add_argument(
+        "--real-upload",
+        action="store_true",
+        help="upload to Azure (AZURE_STORAGE_CONNECTION_STRING) instead of a local directory",
+    )
+    parser.add_argument(
+        "--keep", action="store_true", help="keep /data/pl-bench-* and the work dir"
+    )
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument(
+        "--baseline", help="results of an earlier run to compare against"
+    )
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--floor", type=float, default=0.05)
+    args = parser.parse_args()
+
+    if not os.access("/data", os.W_OK):
+        print("benchmarks: /data must exist and be writable, the stages write there.")
+        return 2
+
+    bench_dir = tempfile.mkdtemp(prefix="rnaseq-bench-")
+    modules = load_stage_modules()
+    volume = LocalVolume()
+    for module in modules.values():
+        module.vol = volume
+    tools = resolve_tools(modules, bench_dir, args)
+
+    results = []
+    try:
+        for layout in args.layouts.split(","):
+            for n_reads in map(int, args.reads.split(",")):
+                results.extend(
+                    bench_sample(modules, tools, bench_dir, layout, n_reads, args)
+                )
+    finally:
+        if not args.keep:
+            shutil.rmtree(bench_dir, ignore_errors=True)
+
+    print(format_report(results))
+    print(f"\nvolume: {volume.commits} commits, {volume.reloads} reloads")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance, args.floor)
+        for regression in regressions:
+            print(f"regression: {regression}")
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
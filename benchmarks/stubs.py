@@ -0,0 +1,185 @@
+"""
+Stand-in executables for the bioinformatics tools of the pipeline.
+
+Each stub accepts the command line the stage wrapper builds, reads all of its input
+and writes outputs with the names and formats the wrapper and the later stages
+expect, without doing the actual work. The benchmark then measures the orchestration
+around the tools rather than the tools themselves.
+
+    install_stubs("/tmp/bench/bin")  # -> {"fastqc": "/tmp/bench/bin/fastqc", ...}
+
+Run a stub directly with `python stubs.py <tool> <args>`.
+"""
+
+import argparse
+import gzip
+import json
+import os
+import shutil
+import stat
+import sys
+from typing import Dict, List
+
+BLOCK_SIZE = 1024 * 1024
+
+
+def _open(path: str, mode: str = "rb"):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode, compresslevel=1)
+    return open(path, mode)
+
+
+def _basename(path: str) -> str:
+    return os.path.basename(path).split(".")[0]
+
+
+def _count_records(path: str) -> int:
+    lines = 0
+    with _open(path) as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+            lines += block.count(b"\n")
+    return lines // 4
+
+
+def fastqc(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(prog="fastqc")
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--outdir", required=True)
+    parser.add_argument("files", nargs="+")
+    args = parser.parse_args(argv)
+
+    for path in args.files:
+        if path == "stdin":
+            reads = sum(block.count(b"\n") for block in sys.stdin.buffer) // 4
+        else:
+            reads = _count_records(path)
+        base = os.path.join(args.outdir, f"{_basename(path)}_fastqc")
+        with open(f"{base}.html", "w") as f:
+            f.write(f"<html><body>Total Sequences {reads}</body></html>\n")
+        with open(f"{base}.zip", "wb") as f:
+            f.write(b"PK\x05\x06" + bytes(18))
+
+
+def trim_galore(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(prog="trim_galore")
+    parser.add_argument("--cores", type=int, default=1)
+    parser.add_argument("--paired", action="store_true")
+    parser.add_argument("-o", "--output_dir", default=".")
+    parser.add_argument("--dont_gzip", action="store_true")
+    parser.add_argument("files", nargs="+")
+    args = parser.parse_args(argv)
+
+    ext = ".fq" if args.dont_gzip else ".fq.gz"
+    for mate, path in enumerate(args.files, start=1):
+        name = _basename(path)
+        suffix = f"_val_{mate}{ext}" if args.paired else f"_trimmed{ext}"
+        with _open(path) as src, _open(
+            os.path.join(args.output_dir, name + suffix), "wb"
+        ) as dst:
+            shutil.copyfileobj(src, dst, BLOCK_SIZE)
+        with open(
+            os.path.join(
+                args.output_dir, f"{os.path.basename(path)}_trimming_report.txt"
+            ),
+            "w",
+        ) as f:
+            f.write(f"SUMMARISING RUN PARAMETERS\nInput filename: {path}\n")
+
+
+def STAR(argv: List[str]) -> None:
+    from fixtures import read_chrom_sizes, write_wig
+
+    parser = argparse.ArgumentParser(prog="STAR")
+    parser.add_argument("--genomeDir", required=True)
+    parser.add_argument("--genomeLoad", default="NoSharedMemory")
+    parser.add_argument("--readFilesIn", nargs="+", default=[])
+    parser.add_argument("--outFileNamePrefix", default="./")
+    args, _ = parser.parse_known_args(argv)
+
+    # Loading or removing the genome in shared memory
+    if not args.readFilesIn:
+        return
+
+    # Gzipped reads come with --readFilesCommand, _open decompresses them as well
+    reads = [_count_records(path) for path in args.readFilesIn][0]
+
+    prefix = args.outFileNamePrefix
+    with open(f"{prefix}Aligned.sortedByCoord.out.bam", "wb") as f:
+        f.write(gzip.compress(b"BAM\x01" + bytes(64 * reads)))
+    with open(f"{prefix}Log.final.out", "w") as f:
+        f.write(
+            f"                          Number of input reads |\t{reads}\n"
+            f"                   Uniquely mapped reads number |\t{int(reads * 0.9)}\n"
+            f"                        Uniquely mapped reads % |\t90.00%\n"
+        )
+    open(f"{prefix}SJ.out.tab", "w").close()
+
+    chrom_sizes = read_chrom_sizes(os.path.join(args.genomeDir, "chrNameLength.txt"))
+    for seed, track in enumerate(
+        ["Unique.str1", "Unique.str2", "UniqueMultiple.str1", "UniqueMultiple.str2"]
+    ):
+        write_wig(f"{prefix}Signal.{track}.out.wig", chrom_sizes, reads, seed)
+
+
+def salmon(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(prog="salmon")
+    parser.add_argument("command", choices=["quant"])
+    parser.add_argument("-i", "--index", required=True)
+    parser.add_argument("-r", "--unmatedReads")
+    parser.add_argument("-1", "--mates1")
+    parser.add_argument("-2", "--mates2")
+    parser.add_argument("-o", "--output", required=True)
+    args, _ = parser.parse_known_args(argv)
+
+    paired = args.mates1 is not None
+    reads = _count_records(args.mates1 if paired else args.unmatedReads)
+
+    os.makedirs(args.output, exist_ok=True)
+    with open(os.path.join(args.output, "lib_format_counts.json"), "w") as f:
+        json.dump(
+            {
+                "read_files": (
+                    [args.mates1, args.mates2] if paired else [args.unmatedReads]
+                ),
+                "expected_format": "ISR" if paired else "SR",
+                "compatible_fragment_ratio": 0.97,
+                "num_compatible_fragments": int(reads * 0.8),
+                "num_assigned_fragments": int(reads * 0.8),
+                "SF": int(reads * 0.02),
+                "SR": int(reads * 0.78),
+            },
+            f,
+            indent=4,
+        )
+
+
+TOOLS = {
+    "fastqc": fastqc,
+    "trim_galore": trim_galore,
+    "STAR": STAR,
+    "salmon": salmon,
+}
+
+
+def install_stubs(bin_dir: str) -> Dict[str, str]:
+    """Writes an executable wrapper per tool to bin_dir.
+
+    Returns:
+        Dict[str, str]: tool name -> path of its stub
+    """
+    os.makedirs(bin_dir, exist_ok=True)
+    script = os.path.abspath(__file__)
+
+    paths = {}
+    for tool in TOOLS:
+        path = os.path.join(bin_dir, tool)
+        with open(path, "w") as f:
+            f.write(f'#!/bin/sh\nexec "{sys.executable}" "{script}" {tool} "$@"\n')
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+        paths[tool] = path
+
+    return paths
+
+
+if __name__ == "__main__":
+    TOOLS[sys.argv[1]](sys.argv[2:])
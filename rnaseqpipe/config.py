@@ -21,3 +21,29 @@ def fastqc_img(img: Image) -> Image:
             "unzip fastqc_v0.12.1.zip",
         )
     )
+
+
+def trimgalore_img(img: Image) -> Image:
+    # pigz lets Trim Galore (and the readers of its output) use multithreaded gzip
+    return img.apt_install("cutadapt", "curl", "pigz").run_commands(
+        "curl -fsSL https://github.com/FelixKrueger/TrimGalore/archive/0.6.10.tar.gz -o trim_galore.tar.gz",
+        "tar xvzf trim_galore.tar.gz",
+    )
+
+
+def star_img(img: Image) -> Image:
+    return img.apt_install("wget").run_commands(
+        "wget https://github.com/alexdobin/STAR/archive/2.7.11b.tar.gz",
+        "tar -xzf 2.7.11b.tar.gz",
+    )
+
+
+def reference_img(img: Image) -> Image:
+    # Genome and transcriptome of R64-1-1 from Ensembl, see salmonindex.SOURCES and
+    # genomes.SOURCES
+    return (
+        img.apt_install("wget", "unzip")
+        .run_commands("wget https://zenodo.org/api/records/11550687/files-archive")
+        .run_commands("mv files-archive files-archive.zip")
+        .run_commands("unzip files-archive.zip")
+    )
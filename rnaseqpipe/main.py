@@ -12,6 +12,20 @@ from modal import (
 )
 from typing import Tuple, List
 from config import vol
+from rnaseqpipe.modules.transfer import stream_download, DEFAULT_MAX_CONCURRENCY
+from rnaseqpipe.modules.utils import trimmed_read_files as trimmed_read_files_for
+from rnaseqpipe.modules.resources import (
+    directory_bytes,
+    load_model,
+    plan_resources,
+)
+from rnaseqpipe.modules.metrics import metrics_dir, write_record
+from rnaseqpipe.modules.volsession import VolumeSession
+from rnaseqpipe.modules.dag import DAGExecutor, DAGExecutionError, Node, format_report
+from rnaseqpipe.modules.batching import batch_id, pack_batches
+from rnaseqpipe.modules.planner import AzureBlobStore, build_plan
+from rnaseqpipe.modules.salmonindex import index_dir as salmon_index_dir
+from rnaseqpipe.modules.genomes import genome_dir
 
 app = App("rna-seq")
 
@@ -20,6 +34,58 @@ pipeline_img = Image.debian_slim().pip_install("azure-storage-blob", "tqdm")
 TIMEOUT = 60 * 1000
 
 
+def _download_reads(
+    container_client,
+    plid: str,
+    files: List[str],
+    no_cache: bool = False,
+    download_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+) -> bool:
+    """Downloads the read files of a sample to /data/{plid}/reads/.
+
+    Returns:
+        bool: whether any file was downloaded, i.e. the volume needs a commit
+    """
+    import os
+
+    print(f"{plid}:main: Downloading files...")
+    os.makedirs(f"/data/{plid}/reads", exist_ok=True)
+
+    downloaded = False
+
+    for file in files:
+
+        local_file_path = f"/data/{plid}/reads/{file}"
+        blob_client = container_client.get_blob_client(file)
+
+        download_required = True
+
+        if os.path.exists(local_file_path) and not no_cache:
+            local_file_size = os.path.getsize(local_file_path)
+            azure_file_size = blob_client.get_blob_properties().size
+
+            if local_file_size != 0 and local_file_size == azure_file_size:
+                download_required = False
+
+        if download_required:
+            print(f"{plid}: Downloading {file}...")
+            # Streams the blob to disk in chunks; a partial file from an earlier,
+            # interrupted run is resumed unless no_cache is set.
+            stream_download(
+                blob_client,
+                local_file_path,
+                max_concurrency=download_concurrency,
+                resume=not no_cache,
+            )
+            downloaded = True
+        else:
+            print(
+                f"{plid}: File {file} already exists and has the correct size. Skipping download."
+            )
+
+    return downloaded
+
+
 @app.function(
     image=pipeline_img,
     volumes={"/data": vol},
@@ -27,11 +93,30 @@ TIMEOUT = 60 * 1000
     cpu=1,
     timeout=TIMEOUT,
 )
-def run_pipeline(sample_id: Tuple[str, List[str]], no_cache: bool = False):
+def run_pipeline(
+    sample_id: Tuple[str, List[str]],
+    no_cache: bool = False,
+    download_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    run_strandedness: bool = False,
+    assembly_name: str = "R64-1-1",
+    trim_mode: str = "compressed",
+    run_salmon: bool = False,
+):
     """
     Example Input:
         sample_id example paired: ("DRR023784", ["DRR023784_1.fastq.gz", "DRR023784_2.fastq.gz"])
         sample_id example unpaired: ("DRR023784", ["DRR023784.fastq.gz"])
+
+    download_concurrency sets the number of parallel ranged GETs per read file.
+    assembly_name selects the STAR genome index, see modules/genomes.py.
+    run_strandedness additionally infers the strandedness against the salmon index
+    of assembly_name, off the critical path. run_salmon quantifies the transcripts
+    with salmon against the same index, in parallel with STAR.
+    trim_mode is one of
+        "uncompressed": Trim Galore writes plain FASTQ to the volume
+        "compressed": Trim Galore writes gzipped FASTQ that STAR decompresses on the fly
+        "fused": trimmed reads are streamed into STAR over named pipes and never land
+            on the volume
     """
 
     # Create a pipeline ID
@@ -45,6 +130,7 @@ def run_pipeline(sample_id: Tuple[str, List[str]], no_cache: bool = False):
     print(f"Running pipeline for {plid} with input {sample_id}...")
 
     import os
+    import time
     from azure.storage.blob import BlobServiceClient
 
     connect_str = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
@@ -52,201 +138,546 @@ def run_pipeline(sample_id: Tuple[str, List[str]], no_cache: bool = False):
     container_name = "rna-seq-reads"
     container_client = blob_service_client.get_container_client(container_name)
 
-    print(f"{plid}:main: Downloading files...")
-    os.makedirs(f"/data/{plid}/reads", exist_ok=True)
-
-    for file in sample_id[1]:
-
-        print(f"{plid}: Downloading {file}...")
-
-        local_file_path = f"/data/{plid}/reads/{file}"
-        blob_client = container_client.get_blob_client(file)
-
-        download_required = False
+    session = VolumeSession(vol, plid, "run_pipeline")
 
-        if not os.path.exists(local_file_path) or no_cache:
-            download_required = True
-        else:
-            local_file_size = os.path.getsize(local_file_path)
-            blob_properties = blob_client.get_blob_properties()
-            azure_file_size = blob_properties.size
-
-            if local_file_size == 0 or local_file_size != azure_file_size:
-                download_required = True
-                if os.path.exists(local_file_path):
-                    os.remove(local_file_path)
+    downloaded = _download_reads(
+        container_client, plid, sample_id[1], no_cache, download_concurrency
+    )
 
-        if download_required:
-            print(f"{plid}: Downloading {file}...")
-            with open(local_file_path, "wb") as f:
-                f.write(blob_client.download_blob().readall())
-            vol.commit()
-        else:
-            print(
-                f"{plid}: File {file} already exists and has the correct size. Skipping download."
-            )
+    # One commit for all read files, the stages below run in other containers
+    if downloaded:
+        session.commit()
 
     print(f"{plid}: Files downloaded successfully!")
 
     """
-    In parallel, run: 
-    - Read Quality Check: FastQC
-    - Inferring Strandednes: fq and salmon
-    - Read Trimming: Trim Galore!
+    Stages run as a DAG: each stage starts as soon as the artifacts it needs exist.
+    - Read Quality Check: FastQC and a native QC summary (off the critical path)
+    - Inferring Strandednes: a read sample against a k-mer index (off the critical path)
+    - Read Trimming: Trim Galore! -> STAR, which converts its signal to bigwig
+    - Transcript quantification: salmon on the trimmed reads, in parallel with STAR
+      (opt-in)
+    - Upload once the bigwigs exist and FastQC/strandedness have finished or failed
     """
 
-    vol.reload()
+    session.reload()
 
-    FASTQC = "fastqc"
-    INFER_STRANDEDNESS = "infer_strandedness"
-    TRIM_GALORE = "trimgalore"
+    read_files = [f"/data/{plid}/reads/{name}" for name in sample_id[1]]
 
-    fastqc = Function.lookup("rnaseq-fastqc", FASTQC)
-    # infer_strandedness = Function.lookup("rnaseq-strandedness", INFER_STRANDEDNESS)
-    trimgalore = Function.lookup("rnaseq-trim-galore", TRIM_GALORE)
+    if trim_mode not in ("uncompressed", "compressed", "fused"):
+        raise ValueError(f"{plid}: Unknown trim_mode {trim_mode}.")
 
-    fastqc_handle = fastqc.spawn(
-        plid=plid,
-        read_files=[f"/data/{plid}/reads/{name}" for name in sample_id[1]],
-        force_recompute=False,
+    trimmed_read_files = trimmed_read_files_for(
+        read_files,
+        f"/data/{plid}/trimgalore",
+        compressed=trim_mode == "compressed",
     )
 
-    # infer_strandedness_handle = infer_strandedness.spawn(
-    #     plid=plid,
-    #     read_files=[f"/data/{plid}/reads/{read_file}" for read_file in sample_id[1]],
-    #     assembly_name="R64-1-1",
-    # )
-
-    trimgalore_handle = trimgalore.spawn(
-        plid=plid,
-        read_files=[f"/data/{plid}/reads/{name}" for name in sample_id[1]],
-        force_recompute=False,
+    # Size the heavy stages from the input and genome index size
+    resource_model = load_model()
+    input_bytes = sum(os.path.getsize(f) for f in read_files)
+    trimgalore_resources = plan_resources(
+        "trimgalore", input_bytes, model=resource_model
+    )
+    staralign_resources = plan_resources(
+        "staralign",
+        input_bytes,
+        index_bytes=directory_bytes(genome_dir(assembly_name)),
+        model=resource_model,
+    )
+    print(
+        f"{plid}: {input_bytes / 1e6:.1f} MB input, trimgalore: {trimgalore_resources}, staralign: {staralign_resources}"
     )
 
-    import time
+    def run_fastqc():
+        fastqc = Function.lookup("rnaseq-fastqc", "fastqc")
+        return fastqc.remote(plid=plid, read_files=read_files, force_recompute=False)
 
-    results = {
-        FASTQC: "running",
-        # INFER_STRANDEDNESS: "running",
-        TRIM_GALORE: "running",
-    }
+    def run_qc_summary():
+        qc_summary = Function.lookup("rnaseq-fastqc", "qc_summary")
+        return qc_summary.remote(plid=plid, read_files=read_files)
 
-    while True:
+    def run_infer_strandedness():
+        infer_strandedness = Function.lookup(
+            "rnaseq-strandedness", "infer_strandedness"
+        )
+        library = infer_strandedness.remote(
+            plid=plid, read_files=read_files, assembly_name=assembly_name
+        )
         print(
-            f"{plid}: Waiting for {FASTQC}, {INFER_STRANDEDNESS} and {TRIM_GALORE} to finish..."
+            f"{plid}: Library type {library['library_type']} ({library['strand']}, "
+            f"sense fraction {library['sense_fraction']})"
+        )
+        return library
+
+    def run_trimgalore():
+        trimgalore = Function.lookup("rnaseq-trim-galore", "trimgalore")
+        return trimgalore.with_options(**trimgalore_resources).remote(
+            plid=plid,
+            read_files=read_files,
+            force_recompute=False,
+            compress=trim_mode == "compressed",
+            **trimgalore_resources,
         )
-        try:
-            result_fqc = fastqc_handle.get(timeout=10)
-            # result_inf_str = infer_strandedness_handle.get(timeout=10)
-            result_trimg = trimgalore_handle.get(timeout=10)
-
-            if results[FASTQC] == "running" and type(result_fqc) == bool:
-                print(f"{plid}:{FASTQC}: Completed successfully!")
-                results[FASTQC] = "completed"
-
-            # if (
-            #     results[INFER_STRANDEDNESS] == "running"
-            #     and type(result_inf_str) == bool
-            # ):
-            #     print(f"{plid}:{INFER_STRANDEDNESS}: Completed successfully!")
-            #     results[INFER_STRANDEDNESS] = "completed"
-
-            if results[TRIM_GALORE] == "running" and type(result_trimg) == bool:
-                print(f"{plid}:{TRIM_GALORE}: Completed successfully!")
-                results[TRIM_GALORE] = "completed"
-
-            if all([v == "completed" for v in results.values()]):
-                break
-
-        except TimeoutError as e:
-            print(e)
-        time.sleep(3)
 
     # =========================
     # STAR: map reads to genome
     # =========================
 
-    STARAlign = Cls.lookup("rnaseq-staralign", "STARAlign")
+    def run_staralign():
+        STARAlign = Cls.lookup("rnaseq-staralign", "STARAlign")
+
+        if STARAlign is None:
+            raise Exception("STARAlign class not found.")
+
+        STARAlign = STARAlign.with_options(**staralign_resources)
+
+        if trim_mode == "fused":
+            print(f"{plid}: Spawned STARAlign.trim_and_align on {read_files}...")
+            return STARAlign().trim_and_align.remote(
+                plid=plid,
+                read_files=read_files,
+                force_recompute=False,
+                assembly_name=assembly_name,
+                **staralign_resources,
+            )
 
-    if STARAlign is None:
-        raise Exception("STARAlign class not found.")
+        print(f"{plid}: Spawned STARAlign on {trimmed_read_files}...")
 
-    trimmed_read_files = []
-    if len(sample_id[1]) == 1:
-        trimmed_read_files.append(
-            f"/data/{plid}/trimgalore/{sample_id[1][0].split('.')[0]}_trimmed.fq"
+        return STARAlign().align.remote(
+            plid=plid,
+            read_files=trimmed_read_files,
+            force_recompute=False,
+            assembly_name=assembly_name,
+            **staralign_resources,
         )
-    elif len(sample_id[1]) == 2:
-        trimmed_read_files.append(
-            f"/data/{plid}/trimgalore/{sample_id[1][0].split('.')[0]}_val_1.fq"
+
+    # ====================================
+    # SALMON: quantify transcripts (opt-in)
+    # ====================================
+
+    def run_salmon_quant():
+        # Sized here, the index is only walked when salmon runs
+        salmon_resources = plan_resources(
+            "salmon_quant",
+            input_bytes,
+            index_bytes=directory_bytes(salmon_index_dir(assembly_name)),
+            model=resource_model,
         )
-        trimmed_read_files.append(
-            f"/data/{plid}/trimgalore/{sample_id[1][1].split('.')[0]}_val_2.fq"
+        SalmonQuant = Cls.lookup("rnaseq-salmon", "SalmonQuant")
+        SalmonQuant = SalmonQuant.with_options(**salmon_resources)
+
+        # In fused mode the trimmed reads never land on the volume
+        reads = read_files if trim_mode == "fused" else trimmed_read_files
+        return SalmonQuant().quant.remote(
+            plid=plid,
+            read_files=reads,
+            assembly_name=assembly_name,
+            **salmon_resources,
         )
-    else:
-        raise ValueError(f"{plid}: Invalid number of read files.")
 
-    print(trimmed_read_files)
+    # =======================
+    # UPLOAD RESULTS TO AZURE
+    # =======================
 
-    print(f"{plid}: Spawned STARAlign...")
+    def run_upload():
+        upload_results = Function.lookup("rnaseq-uploader", "upload_results")
 
-    align_result = STARAlign().align.remote(
-        plid=plid,
-        read_files=trimmed_read_files,
-        force_recompute=False,
-    )
+        if not upload_results.remote(plid):
+            raise Exception(f"{plid}: Results upload failed!")
 
-    # =====================
-    # CONVERT WIG TO BIGWIG
-    # =====================
-
-    wigToBigWig = Function.lookup("rnaseq-wigToBigWig", "wigToBigWig")
-    inputs = [
-        (
-            f"/data/{plid}/staralign/Signal.Unique.str1.out.wig",
-            "/data/chrom.sizes",
-            f"/data/{plid}/staralign/Signal.Unique.str1.out.bw",
-            False,
-        ),
-        (
-            f"/data/{plid}/staralign/Signal.Unique.str2.out.wig",
-            "/data/chrom.sizes",
-            f"/data/{plid}/staralign/Signal.Unique.str2.out.bw",
-            False,
-        ),
-    ]
-    result_wigToBigWig = list(wigToBigWig.starmap(inputs))
+        return True
 
-    # Check if all conversions were successful
-    if all(result_wigToBigWig):
-        print(f"{plid}:wigToBigWig: Completed successfully!")
+    nodes = [
+        Node("fastqc", run_fastqc, ["reads"], ["fastqc_report"], required=False),
+        Node("qc_summary", run_qc_summary, ["reads"], ["qc_summary"], required=False),
+    ]
+    # Upload waits for the side branches, but does not require them to succeed
+    upload_after = ["fastqc_report", "qc_summary"]
+
+    # STAR converts its signal tracks to bigwig in the same container
+    if trim_mode == "fused":
+        # STAR trims the reads itself
+        nodes.append(
+            Node("staralign", run_staralign, ["reads"], ["alignment", "bigwig"])
+        )
     else:
-        print(f"{plid}:wigToBigWig: Failed!")
-        print(result_wigToBigWig)
+        nodes.append(Node("trimgalore", run_trimgalore, ["reads"], ["trimmed_reads"]))
+        nodes.append(
+            Node("staralign", run_staralign, ["trimmed_reads"], ["alignment", "bigwig"])
+        )
 
-    # =======================
-    # UPLOAD RESULTS TO AZURE
-    # =======================
+    if run_strandedness:
+        nodes.append(
+            Node(
+                "infer_strandedness",
+                run_infer_strandedness,
+                ["reads"],
+                ["strandedness"],
+                required=False,
+            )
+        )
+        upload_after.append("strandedness")
+
+    if run_salmon:
+        nodes.append(
+            Node(
+                "salmon_quant",
+                run_salmon_quant,
+                ["reads" if trim_mode == "fused" else "trimmed_reads"],
+                ["transcript_quant"],
+                required=False,
+            )
+        )
+        upload_after.append("transcript_quant")
+
+    nodes.append(
+        Node(
+            "upload",
+            run_upload,
+            ["bigwig"],
+            ["uploaded"],
+            optional_inputs=upload_after,
+        )
+    )
 
-    upload_results = Function.lookup("rnaseq-uploader", "upload_results")
+    dag = DAGExecutor(nodes, log_prefix=plid)
+    run_started = time.time()
+
+    def record_timings(results):
+        print(f"{plid}: Stage timings:\n{format_report(results)}")
+        session.reload()
+        for name, result in results.items():
+            write_record(
+                metrics_dir(plid),
+                "dag",
+                {
+                    "plid": plid,
+                    "stage": "dag",
+                    "run": run_started,
+                    "node": name,
+                    "status": result.status,
+                    "started": result.started,
+                    "finished": result.finished,
+                    "wall_seconds": result.wall_seconds,
+                    "depends_on": dag.dependencies(name),
+                },
+            )
+        session.commit()
 
-    result = upload_results.remote(plid)
+    try:
+        results = dag.run(available=["reads"])
+    except DAGExecutionError as e:
+        record_timings(e.results)
+        raise
 
-    if result:
-        print(f"{plid}: Results uploaded successfully!")
-    else:
-        raise Exception(f"{plid}: Results upload failed!")
+    record_timings(results)
 
     print(f"{plid}: Pipeline completed successfully!")
 
 
+@app.function(image=pipeline_img, volumes={"/data": vol}, timeout=TIMEOUT)
+def calibrate_resources():
+    """Refit the resource model from the runtime and peak RSS recorded by all runs."""
+    from rnaseqpipe.modules.resources import calibrate, load_observations, save_model
+
+    session = VolumeSession(vol, stage="calibrate_resources")
+    session.reload()
+
+    observations = load_observations()
+    print(f"Calibrating resource model from {len(observations)} observations...")
+
+    model = calibrate(observations)
+    save_model(model)
+    session.commit()
+
+    return model
+
+
+@app.function(
+    image=pipeline_img,
+    volumes={"/data": vol},
+    secrets=[Secret.from_name("azure-connect-str")],
+    cpu=1,
+    timeout=TIMEOUT,
+)
+def run_batch(
+    sample_ids: List[Tuple[str, List[str]]],
+    no_cache: bool = False,
+    download_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    trim_mode: str = "compressed",
+    assembly_name: str = "R64-1-1",
+    run_salmon: bool = False,
+):
+    """
+    Runs the pipeline for a batch of small samples (see modules/batching.py) with one
+    container per stage instead of one per stage and sample. FastQC, Trim Galore,
+    STAR (which writes the bigwigs) and the upload are run by their `*_many`
+    functions, the heavy stages sized from the total input of the batch. Results are
+    written to the per-sample folders as with run_pipeline. A sample that fails a
+    stage is dropped from the later stages, the other samples continue. The gene
+    counts of the batch are merged into /data/batches/{batch_id}/gene_counts.npz, see
+    modules/counts.py, and the QC reports are parsed into the QC store, see
+    modules/qcstore.py.
+
+    sample_ids is a list of run_pipeline sample_ids. trim_mode is "uncompressed" or
+    "compressed", see run_pipeline. assembly_name selects the genome index STAR
+    aligns to and the chromosome sizes of the bigwigs, see modules/genomes.py.
+    run_salmon quantifies the transcripts with salmon in parallel with STAR and
+    merges them into TPM and counts tables of the batch.
+
+    Returns:
+        Dict[str, Union[bool, str]]: True per completed plid, the failed stage and
+            error otherwise
+    """
+    import os
+    import time
+    from azure.storage.blob import BlobServiceClient
+
+    if trim_mode not in ("uncompressed", "compressed"):
+        raise ValueError(f"run_batch: Unsupported trim_mode {trim_mode}.")
+
+    connect_str = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
+    blob_service_client = BlobServiceClient.from_connection_string(connect_str)
+    container_client = blob_service_client.get_container_client("rna-seq-reads")
+
+    session = VolumeSession(vol, stage="run_batch")
+
+    read_files = {}
+    failures = {}
+    downloaded = False
+    for accession, files in sample_ids:
+        plid = f"pl-{accession}"
+        try:
+            downloaded |= _download_reads(
+                container_client, plid, files, no_cache, download_concurrency
+            )
+            read_files[plid] = [f"/data/{plid}/reads/{name}" for name in files]
+        except Exception as e:
+            print(f"{plid}:run_batch: Download failed: {e}")
+            failures[plid] = f"download: {e!r}"
+
+    if downloaded:
+        session.commit()
+    session.reload()
+
+    def alive():
+        return [plid for plid in read_files if plid not in failures]
+
+    def collect(stage, results):
+        for plid, result in results.items():
+            if result is not True:
+                failures.setdefault(plid, f"{stage}: {result}")
+
+    resource_model = load_model()
+    input_bytes = sum(
+        os.path.getsize(f) for files in read_files.values() for f in files
+    )
+    trimgalore_resources = plan_resources(
+        "trimgalore", input_bytes, model=resource_model
+    )
+    staralign_resources = plan_resources(
+        "staralign",
+        input_bytes,
+        index_bytes=directory_bytes(genome_dir(assembly_name)),
+        model=resource_model,
+    )
+    print(
+        f"run_batch: {len(read_files)} samples, {input_bytes / 1e6:.1f} MB input, "
+        f"trimgalore: {trimgalore_resources}, staralign: {staralign_resources}"
+    )
+
+    def run_fastqc():
+        fastqc_many = Function.lookup("rnaseq-fastqc", "fastqc_many")
+        # FastQC is off the critical path, its failures do not drop samples
+        return fastqc_many.remote([(plid, read_files[plid]) for plid in alive()])
+
+    def run_trimgalore():
+        if not alive():
+            return
+        trimgalore_many = Function.lookup("rnaseq-trim-galore", "trimgalore_many")
+        collect(
+            "trimgalore",
+            trimgalore_many.with_options(**trimgalore_resources).remote(
+                [(plid, read_files[plid]) for plid in alive()],
+                compress=trim_mode == "compressed",
+                **trimgalore_resources,
+            ),
+        )
+
+    def run_staralign():
+        if not alive():
+            return
+        STARAlign = Cls.lookup("rnaseq-staralign", "STARAlign")
+        STARAlign = STARAlign.with_options(**staralign_resources)
+        samples = [
+            (
+                plid,
+                trimmed_read_files_for(
+                    read_files[plid],
+                    f"/data/{plid}/trimgalore",
+                    compressed=trim_mode == "compressed",
+                ),
+            )
+            for plid in alive()
+        ]
+        collect(
+            "staralign",
+            STARAlign().align_many.remote(
+                samples, assembly_name=assembly_name, **staralign_resources
+            ),
+        )
+
+    def run_salmon_quant():
+        if not alive():
+            return
+        salmon_resources = plan_resources(
+            "salmon_quant",
+            input_bytes,
+            index_bytes=directory_bytes(salmon_index_dir(assembly_name)),
+            model=resource_model,
+        )
+        SalmonQuant = Cls.lookup("rnaseq-salmon", "SalmonQuant")
+        SalmonQuant = SalmonQuant.with_options(**salmon_resources)
+        samples = [
+            (
+                plid,
+                trimmed_read_files_for(
+                    read_files[plid],
+                    f"/data/{plid}/trimgalore",
+                    compressed=trim_mode == "compressed",
+                ),
+            )
+            for plid in alive()
+        ]
+        # Salmon is optional, its failures do not drop samples from the batch
+        SalmonQuant().quant_many.remote(samples, assembly_name, **salmon_resources)
+        merge_salmon_quant = Function.lookup("rnaseq-salmon", "merge_salmon_quant")
+        merge_salmon_quant.remote(alive(), batch_id(list(read_files)))
+
+    def run_gene_counts():
+        if not alive():
+            return
+        merge_gene_counts = Function.lookup("rnaseq-genecounts", "merge_gene_counts")
+        # Samples without gene counts stay in the batch, the matrix is optional
+        merge_gene_counts.remote(alive(), batch_id(list(read_files)))
+
+    def run_qc_store():
+        store_qc = Function.lookup("rnaseq-qcstore", "store_qc")
+        # Failed samples are stored as well, their reports tell where they failed
+        store_qc.remote(list(read_files), batch_id(list(read_files)))
+
+    def run_upload():
+        if not alive():
+            return
+        upload_many = Function.lookup("rnaseq-uploader", "upload_many")
+        collect("upload", upload_many.remote(alive()))
+
+    # The nodes work on the samples still alive, so only a failure of a whole
+    # container fails the DAG
+    nodes = [
+        Node("fastqc", run_fastqc, ["reads"], ["fastqc_report"], required=False),
+        Node("trimgalore", run_trimgalore, ["reads"], ["trimmed_reads"]),
+        Node("staralign", run_staralign, ["trimmed_reads"], ["alignment", "bigwig"]),
+        Node(
+            "gene_counts",
+            run_gene_counts,
+            ["alignment"],
+            ["gene_counts"],
+            required=False,
+        ),
+    ]
+    upload_after = ["fastqc_report"]
+
+    if run_salmon:
+        nodes.append(
+            Node(
+                "salmon_quant",
+                run_salmon_quant,
+                ["trimmed_reads"],
+                ["transcript_quant"],
+                required=False,
+            )
+        )
+        upload_after.append("transcript_quant")
+
+    nodes.append(
+        Node(
+            "upload",
+            run_upload,
+            ["bigwig"],
+            ["uploaded"],
+            optional_inputs=upload_after,
+        )
+    )
+    nodes.append(
+        Node(
+            "qc_store",
+            run_qc_store,
+            [],
+            ["qc_store"],
+            optional_inputs=["alignment"] + upload_after,
+            required=False,
+        )
+    )
+    dag = DAGExecutor(nodes, log_prefix="run_batch")
+    run_started = time.time()
+
+    try:
+        results = dag.run(available=["reads"])
+    except DAGExecutionError as e:
+        results = e.results
+        for plid in alive():
+            failures[plid] = str(e)
+
+    print(f"run_batch: Stage timings:\n{format_report(results)}")
+
+    session.reload()
+    for plid in read_files:
+        for name, result in results.items():
+            write_record(
+                metrics_dir(plid),
+                "dag",
+                {
+                    "plid": plid,
+                    "stage": "dag",
+                    "run": run_started,
+                    "node": name,
+                    "status": result.status,
+                    "started": result.started,
+                    "finished": result.finished,
+                    "wall_seconds": result.wall_seconds,
+                    "depends_on": dag.dependencies(name),
+                    "batch_size": len(read_files),
+                },
+            )
+    session.commit()
+
+    for plid, reason in failures.items():
+        print(f"{plid}:run_batch: Failed in {reason}")
+    print(f"run_batch: {len(alive())} of {len(sample_ids)} samples completed.")
+
+    return {
+        f"pl-{accession}": failures.get(f"pl-{accession}", True)
+        for accession, _ in sample_ids
+    }
+
+
 distr_img = Image.debian_slim().pip_install("azure-storage-blob")
 
 
 @app.function(
     image=distr_img, secrets=[Secret.from_name("azure-connect-str")], timeout=TIMEOUT
 )
-def distribute_tasks(accesions: List[str]):
+def distribute_tasks(
+    accesions: List[str], batch_small_samples: bool = False, run_salmon: bool = False
+):
+    """Runs the pipeline for the given accessions, all in the container if empty.
+
+    With batch_small_samples, small samples are packed into batches that run_batch
+    processes with one container per stage (see modules/batching.py). run_salmon
+    quantifies the transcripts of every sample with salmon as well.
+    """
     import os
     from azure.storage.blob import BlobServiceClient
 
@@ -260,39 +691,50 @@ def distribute_tasks(accesions: List[str]):
     # Get the client for the container
     container_client = blob_service_client.get_container_client(container_name)
 
-    # List all blobs in the container and print their names
-    blob_list = container_client.list_blobs()
-    blob_names = []
-    for blob in blob_list:
-        if blob.name.endswith(".fastq.gz") and (
-            len(accesions) == 0 or any([acc in blob.name for acc in accesions])
-        ):
-            blob_names.append(blob.name)
+    # One prefix-scoped listing per accession, read files paired by mate
+    plan = build_plan(AzureBlobStore(container_client), accesions)
+    print(plan.summary())
 
-    print("Found", len(blob_names))
+    # Largest samples first, so the long tail starts as early as possible
+    plan.samples.sort(key=lambda sample: sample.input_bytes, reverse=True)
+    tasks = plan.tasks()
 
-    # Group files by prefix
-    task_groups = {}
-    for file in blob_names:
-        split = file.split("_")
+    print(f"Starting to process {len(tasks)} tasks...")
 
-        if len(split) == 1:
-            task_groups[file.split(".")[0]] = [file]
-            continue
+    if batch_small_samples:
+        batches, tasks = pack_batches(
+            [(sample.task(), sample.input_bytes) for sample in plan.samples]
+        )
+        print(
+            f"Running {sum(len(b) for b in batches)} small samples in {len(batches)} batches..."
+        )
+        batch_calls = [
+            run_batch.spawn(batch, run_salmon=run_salmon) for batch in batches
+        ]
 
-        prefix = split[0]
-        if prefix not in task_groups:
-            task_groups[prefix] = []
-        task_groups[prefix].append(file)
+    result = list(
+        run_pipeline.map(
+            tasks, kwargs={"run_salmon": run_salmon}, return_exceptions=True
+        )
+    )
 
-    print(f"Starting to process {len(task_groups)} tasks...")
+    # The samples run on their own go into the QC store and count matrices as
+    # one batch
+    if tasks:
+        plids = [f"pl-{accession}" for accession, _ in tasks]
+        store_qc = Function.lookup("rnaseq-qcstore", "store_qc")
+        print(store_qc.remote(plids, batch_id(plids)))
 
-    # Distribute tasks
-    tasks = list(task_groups.items())
+        merge_gene_counts = Function.lookup("rnaseq-genecounts", "merge_gene_counts")
+        print(merge_gene_counts.remote(plids, batch_id(plids)))
 
-    print(tasks)
+        if run_salmon:
+            merge_salmon_quant = Function.lookup("rnaseq-salmon", "merge_salmon_quant")
+            print(merge_salmon_quant.remote(plids, batch_id(plids)))
 
-    result = list(run_pipeline.map(tasks, return_exceptions=True))
+    if batch_small_samples:
+        for call in batch_calls:
+            print(call.get())
 
     pass
 
@@ -0,0 +1,187 @@
+"""
+Artifact policies that decide what upload_results does with each file of a run.
+
+Every file below /data/{plid}/ is matched against a list of (pattern, action) pairs
+and the first match wins:
+- publish: uploaded as is (the default for files no pattern matches)
+- compress: gzipped on local disk and uploaded as `{name}.gz`
+- discard: not uploaded, e.g. the raw reads that are already in blob storage
+
+Patterns are fnmatch patterns on the path relative to /data/{plid}/, where `*` also
+matches `/`. Policies in /data/resources/artifacts.json, a list of [pattern, action]
+pairs, take precedence over the defaults below, e.g.
+
+    [["trimgalore/*.fq.gz", "publish"]]
+
+To see what would be uploaded for a local copy of a run:
+
+    python -m rnaseqpipe.modules.artifacts ./rnaseq-vol/pl-SRR6059709
+"""
+
+import json
+import os
+from fnmatch import fnmatchcase
+from typing import Dict, List, Tuple
+
+PUBLISH = "publish"
+COMPRESS = "compress"
+DISCARD = "discard"
+ACTIONS = (PUBLISH, COMPRESS, DISCARD)
+
+POLICY_PATH = "/data/resources/artifacts.json"
+
+DEFAULT_POLICIES = [
+    # Raw and subsampled reads, the originals are in the reads container
+    ("reads/*", DISCARD),
+    # Trimmed reads can be recreated from the raw reads, only the reports are kept
+    ("trimgalore/*.fq", DISCARD),
+    ("trimgalore/*.fq.gz", DISCARD),
+    ("staralign/_STARtmp/*", DISCARD),
+    ("*.part", DISCARD),
+    # Local state of the stage cache, it refers to paths on the volume
+    (".stagecache/*", DISCARD),
+    # Text signal tracks of older runs compress ~5x, STAR now only keeps bigWigs
+    ("*.wig", COMPRESS),
+    ("*.fq", COMPRESS),
+    ("*.fastq", COMPRESS),
+]
+
+
+class Artifact:
+    def __init__(self, path: str, relative_path: str, action: str, size: int) -> None:
+        self.path = path
+        self.relative_path = relative_path
+        self.action = action
+        self.size = size
+
+    def blob_name(self, plid: str) -> str:
+        suffix = ".gz" if self.action == COMPRESS else ""
+        return f"{plid}/{self.relative_path}{suffix}"
+
+
+def load_policies(path: str = POLICY_PATH) -> List[Tuple[str, str]]:
+    """Returns the configured policies followed by the defaults."""
+    policies = []
+    if os.path.exists(path):
+        with open(path) as f:
+            policies = [tuple(policy) for policy in json.load(f)]
+    for pattern, action in policies:
+        if action not in ACTIONS:
+            raise ValueError(f"artifacts: Unknown action {action} for {pattern}")
+    return policies + DEFAULT_POLICIES
+
+
+def policy_for(relative_path: str, policies: List[Tuple[str, str]]) -> str:
+    for pattern, action in policies:
+        if fnmatchcase(relative_path, pattern):
+            return action
+    return PUBLISH
+
+
+def plan_artifacts(
+    base_path: str, policies: List[Tuple[str, str]], exclude: List[str] = ()
+) -> List[Artifact]:
+    """Returns every file below base_path with the action its policy assigns.
+
+    Args:
+        base_path (str): result directory of a run, i.e. /data/{plid}/
+        policies (List[Tuple[str, str]]): (pattern, action) pairs, see load_policies
+        exclude (List[str]): paths (and paths starting with them) to leave out
+    """
+    artifacts = []
+    for root, _, files in os.walk(base_path):
+        for file in sorted(files):
+            path = os.path.join(root, file)
+            if any(path.startswith(e) for e in exclude):
+                continue
+            relative_path = os.path.relpath(path, base_path)
+            artifacts.append(
+                Artifact(
+                    path,
+                    relative_path,
+                    policy_for(relative_path, policies),
+                    os.path.getsize(path),
+                )
+            )
+    return artifacts
+
+
+def compress_file(path: str, dest_path: str, threads: int = 4) -> int:
+    """Gzips path to dest_path and returns the compressed size.
+
+    pigz is used if available. Neither it nor gzip store a name or timestamp, so the
+    same content always yields the same bytes (and MD5).
+    """
+    import gzip
+    import shutil
+    import subprocess
+
+    if shutil.which("pigz"):
+        with open(dest_path, "wb") as out:
+            subprocess.run(
+                ["pigz", "-c", "-n", "-p", str(threads), path], stdout=out, check=True
+            )
+    else:
+        with open(path, "rb") as src, open(dest_path, "wb") as out:
+            with gzip.GzipFile(filename="", fileobj=out, mode="wb", mtime=0) as gz:
+                shutil.copyfileobj(src, gz, 1024 * 1024)
+
+    return os.path.getsize(dest_path)
+
+
+def savings(artifacts: List[Artifact], compressed_sizes: Dict[str, int]) -> Dict:
+    """Sums up files and bytes per action and the bytes not uploaded.
+
+    Args:
+        compressed_sizes (Dict[str, int]): path -> compressed size of compressed
+            artifacts whose size is known
+    """
+    totals = {action: {"files": 0, "bytes": 0} for action in ACTIONS}
+    uploaded_bytes = 0
+    for artifact in artifacts:
+        totals[artifact.action]["files"] += 1
+        totals[artifact.action]["bytes"] += artifact.size
+        if artifact.action == COMPRESS:
+            uploaded_bytes += compressed_sizes.get(artifact.path, artifact.size)
+        elif artifact.action == PUBLISH:
+            uploaded_bytes += artifact.size
+
+    total_bytes = sum(t["bytes"] for t in totals.values())
+    return {
+        **totals,
+        "total_bytes": total_bytes,
+        "uploaded_bytes": uploaded_bytes,
+        "saved_bytes": total_bytes - uploaded_bytes,
+    }
+
+
+def format_savings(summary: Dict) -> str:
+    lines = [
+        f"{action:<10}{summary[action]['files']:>7} files{summary[action]['bytes'] / 1e6:>12.1f} MB"
+        for action in ACTIONS
+    ]
+    lines.append(
+        f"uploaded {summary['uploaded_bytes'] / 1e6:.1f} MB of {summary['total_bytes'] / 1e6:.1f} MB, "
+        f"{summary['saved_bytes'] / 1e6:.1f} MB saved"
+    )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Show which files of a run would be published, compressed or discarded."
+    )
+    parser.add_argument("base_path", help="local copy of /data/{plid}")
+    parser.add_argument("--policies", default=POLICY_PATH)
+    args = parser.parse_args()
+
+    artifacts = plan_artifacts(args.base_path, load_policies(args.policies))
+    for artifact in artifacts:
+        print(
+            f"{artifact.action:<10}{artifact.size / 1e6:>10.1f} MB  {artifact.relative_path}"
+        )
+    print()
+    # Compressed sizes are not known without compressing, they count as uncompressed
+    print(format_savings(savings(artifacts, {})))
@@ -0,0 +1,111 @@
+"""
+Batched processing of small samples.
+
+For small libraries (e.g. yeast) container start-up and image pulls take longer than
+the tools themselves. Small samples are therefore packed into batches that run_batch
+processes with a single container per stage: every stage's `*_many` function loops
+over the samples of the batch in one warm container (for STAR, against one loaded
+genome index). Outputs stay in the per-sample folders /data/{plid}/ and a failing
+sample only drops out of the batch, the others continue.
+
+Batches are packed first-fit decreasing by input bytes, so that their containers can
+be sized from the total input of the batch with resources.plan_resources.
+
+Results that span the samples of a batch (e.g. the gene counts matrix) are written to
+/data/batches/{batch_id}/, with the ID derived from the plids of the batch.
+"""
+
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Tuple, Union
+
+# Samples with more input than this are run on their own
+SMALL_SAMPLE_BYTES = 512 * 1024**2
+MAX_BATCH_BYTES = 4 * 1024**3
+MAX_BATCH_SAMPLES = 32
+
+BATCH_ROOT = "/data/batches"
+
+
+def pack_batches(
+    samples: List[Tuple[object, int]],
+    max_batch_bytes: int = MAX_BATCH_BYTES,
+    max_batch_samples: int = MAX_BATCH_SAMPLES,
+    small_sample_bytes: int = SMALL_SAMPLE_BYTES,
+) -> Tuple[List[List[object]], List[object]]:
+    """Packs the small samples into batches.
+
+    Args:
+        samples (List[Tuple[object, int]]): (sample, input bytes) pairs, e.g. the
+            sample_id tuples run_pipeline expects
+        max_batch_bytes (int): total input bytes of a batch
+        max_batch_samples (int): number of samples of a batch
+        small_sample_bytes (int): samples larger than this are not batched
+
+    Returns:
+        Tuple[List[List[object]], List[object]]: the batches (largest first) and the
+            samples that are run on their own. A batch of a single sample is returned
+            as a sample run on its own.
+    """
+    singles = [sample for sample, size in samples if size > small_sample_bytes]
+    small = sorted(
+        ((sample, size) for sample, size in samples if size <= small_sample_bytes),
+        key=lambda item: item[1],
+        reverse=True,
+    )
+
+    batches = []
+    batch_bytes = []
+    for sample, size in small:
+        for i, batch in enumerate(batches):
+            if (
+                len(batch) < max_batch_samples
+                and batch_bytes[i] + size <= max_batch_bytes
+            ):
+                batch.append(sample)
+                batch_bytes[i] += size
+                break
+        else:
+            batches.append([sample])
+            batch_bytes.append(size)
+
+    singles += [batch[0] for batch in batches if len(batch) == 1]
+    return [batch for batch in batches if len(batch) > 1], singles
+
+
+def run_per_sample(
+    stage: str,
+    samples: Iterable[Tuple],
+    fn: Callable,
+    max_workers: int = 1,
+) -> Dict[str, Union[bool, str]]:
+    """Calls fn(plid, *args) for every (plid, *args) in samples.
+
+    An exception only fails its own sample. With max_workers > 1 the samples are run
+    on a thread pool, for tools that do not use all CPUs of the container.
+
+    Returns:
+        Dict[str, Union[bool, str]]: result of fn per plid, the error if it raised
+    """
+
+    def call(sample):
+        plid, *args = sample
+        try:
+            return str(plid), fn(plid, *args)
+        except Exception as e:
+            print(f"{plid}:{stage}: Failed: {e}")
+            return str(plid), repr(e)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(executor.map(call, list(samples)))
+
+
+def batch_id(plids: Iterable[str]) -> str:
+    """Returns an ID that only depends on the set of plids of a batch."""
+    digest = hashlib.sha1("\n".join(sorted(map(str, plids))).encode()).hexdigest()
+    return f"batch-{digest[:10]}"
+
+
+def batch_dir(batch_id: str, root: str = BATCH_ROOT) -> str:
+    return os.path.join(root, batch_id)
@@ -0,0 +1,161 @@
+"""
+Native conversion of STAR's wiggle signal tracks to bigWig.
+
+STAR can only write its signal as text (--outWigType wiggle). Instead of re-parsing
+every track with the UCSC wigToBigWig binary in a container of its own, the tracks
+are streamed in chunks of lines, parsed with NumPy and written with pyBigWig, which
+also computes the zoom levels. STARAlign converts all tracks of a sample on local
+disk right after STAR finished, only the bigWigs reach the volume:
+
+    convert_star_signal(scratch.path, read_chrom_sizes(".../chrNameLength.txt"))
+
+Only variableStep and fixedStep sections are supported, STAR writes variableStep.
+The sections have to follow the order of the chromosome sizes, as STAR writes them
+in the order of the genome index.
+"""
+
+import os
+from typing import Dict, Iterable, List, Tuple
+
+# Signal tracks STAR writes with --outWigType wiggle --outWigStrand Stranded
+STAR_SIGNAL_TRACKS = [
+    "Unique.str1",
+    "Unique.str2",
+    "UniqueMultiple.str1",
+    "UniqueMultiple.str2",
+]
+
+# Lines parsed at once, ~30 MB of STAR wiggle
+CHUNK_LINES = 1_000_000
+MAX_ZOOMS = 10
+
+
+def signal_paths(star_dir: str, track: str) -> Tuple[str, str]:
+    """Returns the wig STAR writes for a track and the bigWig it is converted to."""
+    wig = os.path.join(star_dir, f"Signal.{track}.out.wig")
+    return wig, wig[: -len(".wig")] + ".bw"
+
+
+def _header_value(header: bytes, key: bytes, default: int = None) -> int:
+    for field in header.split()[1:]:
+        name, _, value = field.partition(b"=")
+        if name == key:
+            return int(value)
+    if default is None:
+        raise ValueError(f"bigwig: {key.decode()} missing in {header!r}")
+    return default
+
+
+def iter_wig(path: str, chunk_lines: int = CHUNK_LINES) -> Iterable:
+    """Streams the intervals of a wig file in chunks.
+
+    Yields:
+        Tuple[str, np.ndarray, np.ndarray, int]: chromosome, 0-based starts (int64),
+            values (float64) and span of a chunk of one section
+    """
+    import numpy as np
+
+    chrom, span, fixed = None, 1, None
+
+    def parse(lines: List[bytes], offset: int):
+        numbers = np.array(b"".join(lines).split(), dtype=np.float64)
+        if fixed is None:
+            pairs = numbers.reshape(-1, 2)
+            return pairs[:, 0].astype(np.int64) - 1, pairs[:, 1]
+        start, step = fixed
+        starts = start - 1 + step * (offset + np.arange(len(numbers), dtype=np.int64))
+        return starts, numbers
+
+    with open(path, "rb") as f:
+        lines, offset = [], 0
+        for line in f:
+            if line[:1].isdigit() or line[:1] in (b"-", b"."):
+                lines.append(line)
+                if len(lines) == chunk_lines:
+                    yield (chrom, *parse(lines, offset), span)
+                    offset += len(lines)
+                    lines = []
+                continue
+
+            if lines:
+                yield (chrom, *parse(lines, offset), span)
+                lines = []
+            if line.startswith((b"variableStep", b"fixedStep")):
+                chrom = line.split(b"chrom=")[1].split()[0].decode()
+                span = _header_value(line, b"span", 1)
+                fixed = (
+                    (_header_value(line, b"start"), _header_value(line, b"step"))
+                    if line.startswith(b"fixedStep")
+                    else None
+                )
+                offset = 0
+            elif line.strip() and not line.startswith((b"track", b"browser", b"#")):
+                raise ValueError(f"bigwig: Unsupported line in {path}: {line[:80]!r}")
+
+        if lines:
+            yield (chrom, *parse(lines, offset), span)
+
+
+def wig_to_bigwig(
+    wig_file: str,
+    chrom_sizes: Dict[str, int],
+    output_file: str,
+    chunk_lines: int = CHUNK_LINES,
+) -> int:
+    """Converts a wig file to bigWig in one streaming pass.
+
+    The header lists all chromosomes of chrom_sizes, so the wig is read only once.
+    The output is written next to output_file and renamed once complete.
+
+    Returns:
+        int: number of intervals written
+
+    Raises:
+        ValueError: if the wig has chromosomes that are not in chrom_sizes or are
+            out of their order
+    """
+    import pyBigWig
+
+    # Without NumPy support addEntries rejects the arrays iter_wig yields
+    if not pyBigWig.numpy:
+        raise RuntimeError("bigwig: pyBigWig was built without NumPy support")
+
+    # Entries have to be added in the order of the header
+    order = {chrom: i for i, chrom in enumerate(chrom_sizes)}
+
+    tmp_file = f"{output_file}.tmp"
+    intervals, position = 0, 0
+    bw = pyBigWig.open(tmp_file, "w")
+    try:
+        bw.addHeader(list(chrom_sizes.items()), maxZooms=MAX_ZOOMS)
+        for chrom, starts, values, span in iter_wig(wig_file, chunk_lines):
+            if chrom not in order:
+                raise ValueError(f"bigwig: {chrom} of {wig_file} is not in chrom sizes")
+            if order[chrom] < position:
+                raise ValueError(f"bigwig: {chrom} of {wig_file} is out of order")
+            position = order[chrom]
+            if len(starts):
+                bw.addEntries(chrom, starts, values=values, span=span)
+                intervals += len(starts)
+    finally:
+        bw.close()
+    os.replace(tmp_file, output_file)
+
+    return intervals
+
+
+def convert_star_signal(
+    star_dir: str, chrom_sizes: Dict[str, int], tracks: List[str] = STAR_SIGNAL_TRACKS
+) -> Dict[str, str]:
+    """Converts the signal tracks STAR wrote to star_dir to bigWig.
+
+    Returns:
+        Dict[str, str]: the bigWig per wig file
+    """
+    converted = {}
+    for track in tracks:
+        wig, bigwig = signal_paths(star_dir, track)
+        intervals = wig_to_bigwig(wig, chrom_sizes, bigwig)
+        print(f"bigwig: {wig} -> {bigwig} ({intervals} intervals)")
+        converted[wig] = bigwig
+    return converted
@@ -0,0 +1,224 @@
+"""
+Gene counts from STAR's --quantMode GeneCounts, merged into a batch-level matrix.
+
+STAR counts the reads per gene while aligning and writes ReadsPerGene.out.tab:
+four summary rows (N_unmapped, N_multimapping, N_noFeature, N_ambiguous), then one
+row per gene with the counts for an unstranded library, for reads on the gene's
+strand (forward, htseq-count -s yes) and on the opposite strand (reverse, -s reverse).
+
+The column is picked from the sample's library type (strandedness.json) if it was
+inferred, otherwise from the counts themselves with the same threshold as the
+strandedness inference. The samples of a batch are stored as one sparse gene x
+sample matrix in compressed sparse column layout:
+
+    counts = load_counts("/data/batches/batch-1a2b3c4d5e/gene_counts.npz")
+    matrix = scipy.sparse.csc_matrix(
+        (counts["data"], counts["indices"], counts["indptr"]), shape=counts["shape"]
+    )
+
+The salmon quantifications (quant.sf) of a batch are merged into transcript x sample
+tables of TPM and estimated read counts, stored as Parquet with one column per
+sample, so a sample or transcript subset can be read without the rest:
+
+    tpm = pyarrow.parquet.read_table(path, columns=["Name", "pl-SRR6059709"])
+"""
+
+import json
+import os
+from typing import Dict, List, Tuple
+
+from rnaseqpipe.modules.strandedness import STRANDED_FRACTION
+
+SUMMARY_ROWS = ["N_unmapped", "N_multimapping", "N_noFeature", "N_ambiguous"]
+STRAND_COLUMNS = {"unstranded": 0, "forward": 1, "reverse": 2}
+
+
+def reads_per_gene_path(plid: str) -> str:
+    return f"/data/{plid}/staralign/ReadsPerGene.out.tab"
+
+
+def read_reads_per_gene(path: str) -> Tuple[List[str], "np.ndarray", "np.ndarray"]:
+    """Reads a ReadsPerGene.out.tab.
+
+    Returns:
+        Tuple[List[str], np.ndarray, np.ndarray]: gene IDs, counts (genes x 3) and
+            the summary rows (4 x 3)
+    """
+    import numpy as np
+
+    with open(path) as f:
+        rows = [line.rstrip("\n").split("\t") for line in f if line.strip()]
+
+    summary = [row for row in rows if row[0] in SUMMARY_ROWS]
+    genes = [row for row in rows if row[0] not in SUMMARY_ROWS]
+    return (
+        [row[0] for row in genes],
+        np.array([row[1:4] for row in genes], dtype=np.int64).reshape(-1, 3),
+        np.array([row[1:4] for row in summary], dtype=np.int64).reshape(-1, 3),
+    )
+
+
+def library_strand(plid: str) -> str:
+    """Returns the strand from the sample's strandedness.json, None if not inferred."""
+    path = f"/data/{plid}/strandedness/strandedness.json"
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        strand = json.load(f).get("strand")
+    return strand if strand in STRAND_COLUMNS else None
+
+
+def infer_strand(counts) -> str:
+    """Picks the strand from the counts on the gene's and the opposite strand."""
+    forward, reverse = int(counts[:, 1].sum()), int(counts[:, 2].sum())
+    if forward + reverse == 0:
+        return "unstranded"
+    fraction = forward / (forward + reverse)
+    if fraction >= STRANDED_FRACTION:
+        return "forward"
+    if fraction <= 1 - STRANDED_FRACTION:
+        return "reverse"
+    return "unstranded"
+
+
+def merge_counts(samples: Dict[str, str], strands: Dict[str, str] = None) -> Dict:
+    """Merges the ReadsPerGene.out.tab of several samples into a sparse matrix.
+
+    Args:
+        samples (Dict[str, str]): ReadsPerGene.out.tab per sample name
+        strands (Dict[str, str]): "unstranded", "forward" or "reverse" per sample,
+            inferred from the counts for samples without
+
+    Returns:
+        Dict: CSC arrays data, indices, indptr and shape (genes x samples), genes,
+            samples, strands, and summary (samples x 4, the column's summary rows)
+    """
+    import numpy as np
+
+    strands = strands or {}
+    gene_index = {}
+    data, indices, indptr = [], [], [0]
+    summaries, used_strands = [], []
+
+    for sample, path in samples.items():
+        genes, counts, summary = read_reads_per_gene(path)
+        strand = strands.get(sample) or infer_strand(counts)
+        column = counts[:, STRAND_COLUMNS[strand]]
+
+        rows = np.array(
+            [gene_index.setdefault(gene, len(gene_index)) for gene in genes],
+            dtype=np.int64,
+        )
+        nonzero = np.flatnonzero(column)
+        order = np.argsort(rows[nonzero], kind="stable")
+        indices.append(rows[nonzero][order])
+        data.append(column[nonzero][order])
+        indptr.append(indptr[-1] + len(nonzero))
+
+        summaries.append(summary[:, STRAND_COLUMNS[strand]])
+        used_strands.append(strand)
+
+    return {
+        "data": np.concatenate(data) if data else np.zeros(0, np.int64),
+        "indices": (
+            np.concatenate(indices).astype(np.int32)
+            if indices
+            else np.zeros(0, np.int32)
+        ),
+        "indptr": np.array(indptr, dtype=np.int64),
+        "shape": np.array([len(gene_index), len(samples)], dtype=np.int64),
+        "genes": np.array(list(gene_index), dtype=str),
+        "samples": np.array(list(samples), dtype=str),
+        "strands": np.array(used_strands, dtype=str),
+        "summary": np.array(summaries, dtype=np.int64).reshape(-1, len(SUMMARY_ROWS)),
+    }
+
+
+def save_counts(counts: Dict, path: str) -> None:
+    """Writes the merged counts as a compressed .npz, atomically."""
+    import numpy as np
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez_compressed(f, **counts)
+    os.replace(tmp_path, path)
+
+
+def load_counts(path: str) -> Dict:
+    import numpy as np
+
+    with np.load(path) as npz:
+        return {name: npz[name] for name in npz.files}
+
+
+def quant_sf_path(plid: str) -> str:
+    return f"/data/{plid}/salmon/quant.sf"
+
+
+def read_quant_sf(path: str) -> Dict:
+    """Reads salmon's quant.sf.
+
+    Returns:
+        Dict: Name (List[str]), Length (int64), TPM and NumReads (float64 arrays)
+    """
+    import numpy as np
+
+    with open(path) as f:
+        header = f.readline().rstrip("\n").split("\t")
+        rows = [line.rstrip("\n").split("\t") for line in f if line.strip()]
+
+    columns = dict(zip(header, zip(*rows))) if rows else {name: () for name in header}
+    return {
+        "Name": list(columns["Name"]),
+        "Length": np.array(columns["Length"], dtype=np.int64),
+        "TPM": np.array(columns["TPM"], dtype=np.float64),
+        "NumReads": np.array(columns["NumReads"], dtype=np.float64),
+    }
+
+
+def merge_quant(samples: Dict[str, str]) -> Dict[str, "pyarrow.Table"]:
+    """Merges the quant.sf of several samples into a TPM and a counts table.
+
+    All samples must be quantified against the same index, i.e. list the same
+    transcripts in the same order.
+
+    Args:
+        samples (Dict[str, str]): quant.sf per sample name
+
+    Returns:
+        Dict[str, pyarrow.Table]: "tpm" and "counts", with the columns Name, Length
+            and one per sample
+    """
+    import numpy as np
+    import pyarrow as pa
+
+    if not samples:
+        raise ValueError("counts: No samples to merge")
+
+    names, length = None, None
+    tpm, counts = {}, {}
+    for sample, path in samples.items():
+        quant = read_quant_sf(path)
+        if names is None:
+            names, length = quant["Name"], quant["Length"]
+        elif quant["Name"] != names:
+            raise ValueError(f"counts: {path} was quantified against another index")
+        tpm[sample] = quant["TPM"].astype(np.float32)
+        counts[sample] = quant["NumReads"].astype(np.float32)
+
+    index = {"Name": pa.array(names, pa.string()), "Length": length}
+    return {
+        "tpm": pa.table({**index, **tpm}),
+        "counts": pa.table({**index, **counts}),
+    }
+
+
+def save_parquet(table, path: str) -> None:
+    """Writes a table as Parquet, atomically."""
+    import pyarrow.parquet as pq
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    pq.write_table(table, tmp_path, compression="zstd")
+    os.replace(tmp_path, path)
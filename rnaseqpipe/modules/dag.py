@@ -0,0 +1,219 @@
+"""
+Minimal DAG executor for pipeline stages.
+
+Each node declares the artifacts it consumes (inputs) and produces (outputs). A node
+is started as soon as all of its inputs have been produced, so independent stages
+run concurrently and nothing waits on a stage it does not depend on.
+
+Nodes are plain callables that are run on a concurrent.futures executor. In the
+pipeline they block on `.remote()` calls of Modal functions; locally they can be any
+Python function, which keeps the scheduling logic independent of Modal.
+"""
+
+import time
+from concurrent.futures import FIRST_COMPLETED, Executor, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterable, List
+
+COMPLETED = "completed"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+
+class DAGExecutionError(Exception):
+    def __init__(self, message: str, results: Dict) -> None:
+        super().__init__(message)
+        self.results = results
+
+
+class Node:
+    """A stage in the DAG.
+
+    Args:
+        name (str): unique name of the node
+        fn (Callable): called without arguments when the node is started
+        inputs (List[str]): artifacts that must be produced before the node starts
+        outputs (List[str]): artifacts the node produces when it succeeds
+        optional_inputs (List[str]): artifacts the node waits for, but which may fail
+        required (bool): whether a failure of this node fails the whole DAG
+    """
+
+    def __init__(
+        self,
+        name: str,
+        fn: Callable,
+        inputs: Iterable[str] = (),
+        outputs: Iterable[str] = (),
+        optional_inputs: Iterable[str] = (),
+        required: bool = True,
+    ) -> None:
+        self.name = name
+        self.fn = fn
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.optional_inputs = list(optional_inputs)
+        self.required = required
+
+
+class NodeResult:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.status = None
+        self.result = None
+        self.error = None
+        self.started = None
+        self.finished = None
+
+    @property
+    def wall_seconds(self) -> float:
+        if self.started is None or self.finished is None:
+            return 0.0
+        return self.finished - self.started
+
+
+class DAGExecutor:
+    def __init__(self, nodes: List[Node], log_prefix: str = "dag") -> None:
+        self.nodes = {}
+        self.producers = {}
+        self.log_prefix = log_prefix
+
+        for node in nodes:
+            if node.name in self.nodes:
+                raise ValueError(f"Duplicate node name: {node.name}")
+            self.nodes[node.name] = node
+            for artifact in node.outputs:
+                if artifact in self.producers:
+                    raise ValueError(
+                        f"Artifact {artifact} is produced by {self.producers[artifact]} and {node.name}"
+                    )
+                self.producers[artifact] = node.name
+
+    def dependencies(self, name: str) -> List[str]:
+        """Returns the names of the nodes that produce the inputs of a node."""
+        node = self.nodes[name]
+        return sorted(
+            {
+                self.producers[artifact]
+                for artifact in node.inputs + node.optional_inputs
+                if artifact in self.producers
+            }
+        )
+
+    def run(
+        self, available: Iterable[str] = (), executor: Executor = None
+    ) -> Dict[str, NodeResult]:
+        """Runs all nodes, each as soon as its inputs are available.
+
+        Args:
+            available (Iterable[str]): artifacts that exist before the DAG starts
+            executor (Executor): executor the nodes run on. Defaults to a thread pool
+                with one thread per node.
+
+        Returns:
+            Dict[str, NodeResult]: result of every node, in order of completion
+
+        Raises:
+            DAGExecutionError: if a required node failed or could not be run
+        """
+        produced = set(available)
+        failed = set()
+
+        for node in self.nodes.values():
+            for artifact in node.inputs + node.optional_inputs:
+                if artifact not in produced and artifact not in self.producers:
+                    raise ValueError(
+                        f"Input {artifact} of {node.name} is never produced"
+                    )
+
+        own_executor = executor is None
+        if own_executor:
+            executor = ThreadPoolExecutor(max_workers=max(len(self.nodes), 1))
+
+        pending = dict(self.nodes)
+        running = {}
+        results = {}
+
+        def start(node: Node):
+            result = NodeResult(node.name)
+
+            def call():
+                result.started = time.time()
+                try:
+                    return node.fn()
+                finally:
+                    result.finished = time.time()
+
+            print(f"{self.log_prefix}: Starting {node.name}...")
+            running[executor.submit(call)] = (node, result)
+
+        try:
+            while pending or running:
+                # Skip nodes whose required inputs can no longer be produced
+                changed = True
+                while changed:
+                    changed = False
+                    for name, node in list(pending.items()):
+                        if any(artifact in failed for artifact in node.inputs):
+                            result = NodeResult(name)
+                            result.status = SKIPPED
+                            results[name] = result
+                            failed.update(node.outputs)
+                            del pending[name]
+                            changed = True
+                            print(f"{self.log_prefix}: Skipping {name}.")
+
+                for name, node in list(pending.items()):
+                    resolved = produced | failed
+                    if all(a in produced for a in node.inputs) and all(
+                        a in resolved for a in node.optional_inputs
+                    ):
+                        del pending[name]
+                        start(node)
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node, result = running.pop(future)
+                    try:
+                        result.result = future.result()
+                        result.status = COMPLETED
+                        produced.update(node.outputs)
+                        print(
+                            f"{self.log_prefix}:{node.name}: Completed in {result.wall_seconds:.1f}s"
+                        )
+                    except Exception as e:
+                        result.error = e
+                        result.status = FAILED
+                        failed.update(node.outputs)
+                        print(f"{self.log_prefix}:{node.name}: Failed: {e!r}")
+                    results[node.name] = result
+        finally:
+            if own_executor:
+                executor.shutdown(wait=True)
+
+        if pending:
+            raise ValueError(f"Nodes with cyclic dependencies: {list(pending)}")
+
+        unsuccessful = [
+            name
+            for name, result in results.items()
+            if result.status != COMPLETED and self.nodes[name].required
+        ]
+        if unsuccessful:
+            raise DAGExecutionError(
+                f"{self.log_prefix}: Required nodes did not complete: {unsuccessful}",
+                results,
+            )
+
+        return results
+
+
+def format_report(results: Dict[str, NodeResult]) -> str:
+    """Formats the status and wall-clock time of every node as a table."""
+    lines = [f"{'node':<24}{'status':<12}{'wall [s]':>10}"]
+    for result in results.values():
+        lines.append(
+            f"{result.name:<24}{result.status:<12}{result.wall_seconds:>10.1f}"
+        )
+    return "\n".join(lines)
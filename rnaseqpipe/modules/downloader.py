@@ -1,6 +1,8 @@
 from modal import App, Image, Secret
 from rnaseqpipe.config import vol
 from rnaseqpipe.modules.utils import PLID
+from rnaseqpipe.modules.transfer import stream_download, DEFAULT_MAX_CONCURRENCY
+from rnaseqpipe.modules.volsession import VolumeSession
 from pathlib import Path
 
 app = App("rnaseq-downloader")
@@ -14,10 +16,15 @@ downloader_img = Image.debian_slim().pip_install("azure-storage-blob")
     secrets=[Secret.from_name("azure-connect-str")],
 )
 def download_from_azure(
-    plid: PLID, container_name: str, blob_name: str, dest_dir: Path
+    plid: PLID,
+    container_name: str,
+    blob_name: str,
+    dest_dir: Path,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    resume: bool = True,
 ):
     # Check if the blob was already downloaded
-    if Path(f"/data/{plid}/{dest_dir}") / Path(blob_name):
+    if (Path(f"/data/{plid}") / Path(dest_dir) / Path(blob_name)).exists():
         print(f"{blob_name} already exists in {dest_dir}")
         return dest_dir
 
@@ -38,10 +45,11 @@ def download_from_azure(
 
     dest_path = Path(f"/data/{plid}") / Path(dest_dir) / Path(blob_name)
 
-    with open(dest_path, "wb") as f:
-        f.write(blob_client.download_blob().readall())
+    stream_download(
+        blob_client, str(dest_path), max_concurrency=max_concurrency, resume=resume
+    )
 
-    vol.commit()
+    VolumeSession(vol, plid, "download").commit()
 
     print(f"Downloaded {blob_name} to {dest_dir}")
 
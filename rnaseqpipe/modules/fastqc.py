@@ -5,11 +5,22 @@ Usage doc for FastQC here: https://www.bioinformatics.babraham.ac.uk/projects/fa
 """
 
 from modal import Image, App
-from typing import List
+from typing import List, Tuple
 
 from rnaseqpipe.config import vol
+from rnaseqpipe.modules.stagecache import StageCache, cache_dir
+from rnaseqpipe.modules.metrics import run_stage, measure
+from rnaseqpipe.modules.volsession import VolumeSession
+from rnaseqpipe.modules.batching import run_per_sample
 
 app = App("rnaseq-fastqc")
+
+CPUS = 2.0
+TOOL_VERSION = "FastQC-0.12.1"
+FASTQC_BIN = "/FastQC/fastqc"
+# Samples fastqc_many runs in parallel
+BATCH_WORKERS = 4
+
 fastqc_img = (
     Image.debian_slim()
     .apt_install("default-jre")
@@ -20,23 +31,41 @@ fastqc_img = (
         "unzip fastqc_v0.12.1.zip",
     )
 )
+qcsummary_img = Image.debian_slim().pip_install("numpy")
 
 
 @app.function(
     image=fastqc_img,
     volumes={"/data": vol},
+    cpu=CPUS,
     timeout=60 * 100,
 )
-def fastqc(plid: str, read_files: List[str], force_recompute: bool = False):
+def fastqc(
+    plid: str,
+    read_files: List[str],
+    force_recompute: bool = False,
+    mode: str = "per_file",
+):
     """Run FastQC on the read files.
 
     Args:
         plid (str): pipeline ID
         read_files (List[str]): list of (un-)zipped read files (2 max for paired reads)
+        mode (str): "per_file" runs FastQC on every read file in parallel threads,
+            "stdin" streams the concatenated reads into a single FastQC process
     """
+    session = VolumeSession(vol, plid, "fastqc")
+    session.reload()
+
+    result = _fastqc(plid, read_files, force_recompute, mode)
+
+    session.commit()
+    return result
 
+
+def _fastqc(plid: str, read_files: List[str], force_recompute: bool, mode: str):
+    """Runs FastQC, the caller reloads and commits the volume."""
     print(f"{plid}:rnaseq-fastqc:fastqc: Running FastQC!")
-    vol.reload()
 
     import subprocess
     import os
@@ -51,29 +80,134 @@ def fastqc(plid: str, read_files: List[str], force_recompute: bool = False):
     else:
         raise Exception(f"{plid}:fastqc: Invalid number of read files")
 
+    read_files_str = " ".join(map(str, read_files))
+
+    print("read files: ", read_files_str)
+    print("result path: ", result_path)
+
+    if mode == "per_file":
+        cmd = f"{FASTQC_BIN} --threads {len(read_files)} --outdir {result_path} {read_files_str}"
+    elif mode == "stdin":
+        cmd = f"zcat {read_files_str} | {FASTQC_BIN} stdin --outdir {result_path}"
+    else:
+        raise ValueError(f"{plid}:fastqc: Unknown mode {mode}")
+
     # Check if the results files can already be skipped
-    if os.path.exists(f"{result_path}stdin_fastqc.html") and not force_recompute:
+    cache = StageCache(cache_dir(plid), "fastqc", TOOL_VERSION, cmd, read_files)
+    if cache.hit() and not force_recompute:
         print(f"{plid}:fastqc: FastQC results already exist! Skipping.")
         return True
 
+    cache.invalidate()
     os.makedirs(result_path, exist_ok=True)
 
-    read_files_str = " ".join(map(str, read_files))
+    try:
+        run_stage(
+            plid,
+            "fastqc",
+            cmd,
+            inputs=read_files,
+            outputs=[result_path],
+            cpu=CPUS,
+        )
+
+        cache.record([result_path])
+
+        print(f"{plid}:fastqc: Succeeded!")
+    except subprocess.CalledProcessError as e:
+        print(f"Failed to run FastQC: {e}")
+        raise e
 
-    print("read files: ", read_files_str)
-    print("result path: ", result_path)
+    return True
 
-    cmd = f"zcat {read_files_str} | /FastQC/fastqc stdin --outdir {result_path}"
 
-    try:
-        result = subprocess.run(cmd, shell=True)
+@app.function(
+    image=fastqc_img,
+    volumes={"/data": vol},
+    cpu=CPUS * BATCH_WORKERS,
+    timeout=60 * 1000,
+)
+def fastqc_many(samples: List[Tuple[str, List[str]]], force_recompute: bool = False):
+    """Run FastQC on several samples in one container, BATCH_WORKERS at a time.
 
-        vol.commit()
+    The volume is reloaded once before and committed once after all samples, a
+    reload fails while other threads have files on the volume open.
 
-        print(f"Succeeded: {result.stdout}")
-    except subprocess.CalledProcessError as e:
-        print(f"Failed to run FastQC: {e.stderr}")
-        raise e
+    Args:
+        samples (List[Tuple[str, List[str]]]): (plid, read_files) per sample
+
+    Returns:
+        Dict[str, Union[bool, str]]: True per successful plid, the error otherwise
+    """
+    session = VolumeSession(vol, stage="fastqc_many")
+    session.reload()
+
+    results = run_per_sample(
+        "fastqc",
+        samples,
+        lambda plid, read_files: _fastqc(plid, read_files, force_recompute, "per_file"),
+        max_workers=BATCH_WORKERS,
+    )
+
+    session.commit()
+    return results
+
+
+@app.function(
+    image=qcsummary_img,
+    volumes={"/data": vol},
+    cpu=CPUS,
+    timeout=60 * 100,
+)
+def qc_summary(plid: str, read_files: List[str], force_recompute: bool = False):
+    """Compute a lightweight QC summary (per-base quality, GC content, length
+    distribution) for every read file and write it as JSON.
+
+    Args:
+        plid (str): pipeline ID
+        read_files (List[str]): list of (un-)zipped read files (2 max for paired reads)
+    """
+    import json
+    import os
+    from concurrent.futures import ThreadPoolExecutor
+    from rnaseqpipe.modules.qcsummary import summarize_fastq
+
+    session = VolumeSession(vol, plid, "qc_summary")
+    session.reload()
+
+    result_path = f"/data/{plid}/qcsummary/"
+    summary_files = [
+        f"{result_path}{os.path.basename(f).split('.')[0]}_summary.json"
+        for f in read_files
+    ]
+
+    cache = StageCache(
+        cache_dir(plid), "qc_summary", "qcsummary-1", "summarize_fastq", read_files
+    )
+    if cache.hit() and not force_recompute:
+        print(f"{plid}:qc_summary: QC summary already exists! Skipping.")
+        return True
+
+    cache.invalidate()
+    os.makedirs(result_path, exist_ok=True)
+
+    # zlib decompression and most NumPy kernels release the GIL
+    with measure(plid, "qc_summary", cpu=CPUS) as record:
+        with ThreadPoolExecutor(max_workers=len(read_files)) as executor:
+            summaries = list(executor.map(summarize_fastq, read_files))
+        record["input_bytes"] = sum(os.path.getsize(f) for f in read_files)
+
+    for summary, summary_file in zip(summaries, summary_files):
+        with open(summary_file, "w") as f:
+            json.dump(summary, f)
+        print(
+            f"{plid}:qc_summary: {summary['file']}: {summary['reads']} reads, "
+            f"mean quality {summary.get('mean_quality', 0):.1f}, "
+            f"GC {summary.get('mean_gc', 0):.3f}"
+        )
+
+    cache.record(summary_files)
+    session.commit()
 
     return True
 
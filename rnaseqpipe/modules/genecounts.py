@@ -0,0 +1,107 @@
+"""
+Merges the gene counts STAR wrote for the samples of a batch into one matrix.
+
+STARAlign.align counts the reads per gene while aligning (--quantMode GeneCounts)
+when the genome index has annotations, so this stage only reads the small
+ReadsPerGene.out.tab files, see modules/counts.py.
+
+Run this on modal with: modal run rnaseqpipe/modules/genecounts.py
+"""
+
+from modal import Image, App
+from typing import List
+
+from rnaseqpipe.config import vol
+from rnaseqpipe.modules.stagecache import StageCache
+from rnaseqpipe.modules.metrics import measure
+from rnaseqpipe.modules.volsession import VolumeSession
+from rnaseqpipe.modules.batching import batch_dir, batch_id as make_batch_id
+from rnaseqpipe.modules.counts import (
+    library_strand,
+    merge_counts,
+    reads_per_gene_path,
+    save_counts,
+)
+
+app = App("rnaseq-genecounts")
+
+image = Image.debian_slim().pip_install("numpy")
+
+TOOL_VERSION = "STAR-2.7.11b-GeneCounts+counts-1"
+
+
+@app.function(image=image, volumes={"/data": vol}, timeout=60 * 30)
+def merge_gene_counts(
+    plids: List[str], batch_id: str = None, force_recompute: bool = False
+):
+    """Merge the gene counts of the samples of a batch.
+
+    The matrix is written to /data/batches/{batch_id}/gene_counts.npz.
+
+    Args:
+        plids (List[str]): samples of the batch
+        batch_id (str): ID of the batch, derived from the plids by default
+
+    Returns:
+        Dict[str, Union[bool, str]]: True per plid in the matrix, the error otherwise
+    """
+    import os
+
+    batch_id = batch_id or make_batch_id(plids)
+    # Metrics of the batch go to /data/batches/{batch_id}/metrics
+    metrics_id = os.path.join("batches", batch_id)
+    session = VolumeSession(vol, metrics_id, "gene_counts")
+    session.reload()
+
+    output_dir = batch_dir(batch_id)
+    output_file = os.path.join(output_dir, "gene_counts.npz")
+
+    samples = {
+        plid: reads_per_gene_path(plid)
+        for plid in plids
+        if os.path.exists(reads_per_gene_path(plid))
+    }
+    results = {
+        plid: True if plid in samples else "no ReadsPerGene.out.tab" for plid in plids
+    }
+    if not samples:
+        print(f"{batch_id}:gene_counts: No gene counts, is the index annotated?")
+        return results
+
+    strands = {plid: library_strand(plid) for plid in samples}
+
+    cache = StageCache(
+        os.path.join(output_dir, ".stagecache"),
+        "gene_counts",
+        TOOL_VERSION,
+        f"merge_counts {sorted(strands.items())}",
+        list(samples.values()),
+    )
+    if cache.hit() and not force_recompute:
+        print(f"{batch_id}:gene_counts: {output_file} is up to date! Skipping.")
+        return results
+
+    cache.invalidate()
+
+    with measure(metrics_id, "gene_counts") as record:
+        counts = merge_counts(samples, strands)
+        save_counts(counts, output_file)
+        record["input_bytes"] = sum(os.path.getsize(p) for p in samples.values())
+        record["output_bytes"] = os.path.getsize(output_file)
+
+    print(
+        f"{batch_id}:gene_counts: {counts['shape'][0]} genes x {counts['shape'][1]} "
+        f"samples, {len(counts['data'])} non-zero counts -> {output_file}"
+    )
+
+    cache.record([output_file])
+    session.commit()
+
+    return results
+
+
+@app.local_entrypoint()
+def run():
+    plids = ["pl-SRR6059709", "pl-DRR023785"]
+
+    print(merge_gene_counts.remote(plids))
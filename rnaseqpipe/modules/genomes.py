@@ -0,0 +1,181 @@
+"""
+Registry of the genome assemblies on the volume and their chromosome sizes.
+
+Every assembly has a STAR genome index directory. Indices built by
+scripts/make_star_index.py are versioned like the salmon indices:
+
+    {GENOME_ROOT}/{assembly}/star-{version}/  STAR index, named by the key of its build
+    {GENOME_ROOT}/{assembly}/CURRENT           name of the index the pipeline uses
+
+A new index is built next to the current one and published by rewriting CURRENT,
+so running pipelines keep the index they resolved. Assemblies without CURRENT use
+the index in GENOME_DIRS, e.g. the one R64-1-1 was aligned to before, or
+{GENOME_ROOT}/{assembly}.
+
+The chromosome sizes are derived from the index (STAR's chrNameLength.txt) or a
+FASTA index (.fai) and stored as chrom.sizes in the index directory, so they always
+match the genome the reads were aligned to:
+
+    sizes = chrom_sizes("R64-1-1")  # -> {"I": 230218, "II": 813184, ...}
+
+The file is written to a temporary name and renamed, so containers deriving it at
+the same time do not see partial files. Sizes are cached per process.
+"""
+
+import gzip
+import math
+import os
+from typing import Dict
+
+GENOME_ROOT = "/data/genome-index"
+DEFAULT_ASSEMBLY = "R64-1-1"
+
+# Index directories of assemblies indexed before indices were versioned
+GENOME_DIRS = {"R64-1-1": f"{GENOME_ROOT}/genome-index"}
+
+# Genome FASTA and annotation (GTF) per assembly, paths in config.reference_img or URLs
+SOURCES = {
+    "R64-1-1": (
+        "/R64-1-1.fa.gz",
+        "https://ftp.ensembl.org/pub/release-112/gtf/saccharomyces_cerevisiae/Saccharomyces_cerevisiae.R64-1-1.112.gtf.gz",
+    ),
+}
+
+# Bytes per suffix of STAR's suffix array, which holds the suffixes of both strands
+SA_BYTES_PER_SUFFIX = 8
+# Share of the container memory genomeGenerate may plan with
+GENERATE_MEMORY_FRACTION = 0.8
+
+# Chromosome sizes loaded by this process, by chrom.sizes path
+_chrom_sizes = {}
+
+
+def assembly_dir(assembly_name: str) -> str:
+    return os.path.join(GENOME_ROOT, assembly_name)
+
+
+def genome_dir(assembly_name: str) -> str:
+    """Returns the STAR genome index directory of an assembly."""
+    current = os.path.join(assembly_dir(assembly_name), "CURRENT")
+    if os.path.exists(current):
+        with open(current) as f:
+            return os.path.join(assembly_dir(assembly_name), f.read().strip())
+    return GENOME_DIRS.get(assembly_name, assembly_dir(assembly_name))
+
+
+def publish_genome(assembly_name: str, name: str) -> None:
+    """Makes the index {assembly}/{name} the one the pipeline uses."""
+    current = os.path.join(assembly_dir(assembly_name), "CURRENT")
+    with open(f"{current}.tmp", "w") as f:
+        f.write(f"{name}\n")
+    os.replace(f"{current}.tmp", current)
+
+
+def decompress_fasta(source: str, output: str, block_size: int = 16 * 1024**2) -> int:
+    """Writes a (gzipped) FASTA uncompressed, as genomeGenerate needs it.
+
+    Returns:
+        int: length of the genome, i.e. number of bases
+    """
+    opener = gzip.open if str(source).endswith(".gz") else open
+    length = 0
+    with opener(source, "rb") as f, open(f"{output}.tmp", "wb") as out:
+        for line in iter(lambda: f.readline(block_size), b""):
+            out.write(line)
+            if not line.startswith(b">"):
+                length += len(line.strip())
+    os.replace(f"{output}.tmp", output)
+    return length
+
+
+def star_index_params(genome_length: int, memory: int) -> Dict[str, int]:
+    """Picks the genomeGenerate parameters for a genome and a container.
+
+    genomeSAindexNbases follows the STAR manual, min(14, log2(length) / 2 - 1). The
+    suffix array is made as sparse (genomeSAsparseD) as needed to fit into the memory
+    left after the genome and the SAindex, so large genomes can be indexed (and
+    aligned to) on smaller containers at the cost of slower alignment.
+
+    Args:
+        genome_length (int): number of bases of the genome
+        memory (int): memory of the container in MB
+
+    Returns:
+        Dict[str, int]: genomeSAindexNbases and genomeSAsparseD
+    """
+    nbases = max(4, min(14, int(math.log2(max(genome_length, 2)) / 2 - 1)))
+    suffix_array = 2 * genome_length * SA_BYTES_PER_SUFFIX
+    available = (
+        memory * 1024**2 * GENERATE_MEMORY_FRACTION
+        - genome_length
+        - SA_BYTES_PER_SUFFIX * 4**nbases
+    )
+    if available <= 0:
+        raise ValueError(
+            f"genomes: {memory} MB is not enough for a genome of {genome_length} bases"
+        )
+    return {
+        "genomeSAindexNbases": nbases,
+        "genomeSAsparseD": max(1, math.ceil(suffix_array / available)),
+    }
+
+
+def chrom_sizes_path(assembly_name: str) -> str:
+    return os.path.join(genome_dir(assembly_name), "chrom.sizes")
+
+
+def read_chrom_sizes(path: str) -> Dict[str, int]:
+    """Reads a chrom.sizes, chrNameLength.txt or .fai file, keeping its order."""
+    with open(path) as f:
+        return {
+            chrom: int(size)
+            for chrom, size in (line.split()[:2] for line in f if line.strip())
+        }
+
+
+def write_chrom_sizes(sizes: Dict[str, int], path: str) -> None:
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.writelines(f"{chrom}\t{size}\n" for chrom, size in sizes.items())
+    os.replace(tmp_path, path)
+
+
+def _source(assembly_name: str, fasta_index: str = None) -> str:
+    """Returns the file the chromosome sizes of an assembly are derived from."""
+    candidates = [os.path.join(genome_dir(assembly_name), "chrNameLength.txt")]
+    if fasta_index:
+        candidates.append(fasta_index)
+    for path in candidates:
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(
+        f"genomes: No chrNameLength.txt or FASTA index for {assembly_name} in "
+        f"{genome_dir(assembly_name)}"
+    )
+
+
+def ensure_chrom_sizes(assembly_name: str, fasta_index: str = None) -> str:
+    """Writes chrom.sizes of an assembly if it is missing or older than its source.
+
+    Args:
+        assembly_name (str): assembly, e.g. "R64-1-1"
+        fasta_index (str): .fai of the genome FASTA, used without a STAR index
+
+    Returns:
+        str: path of chrom.sizes
+    """
+    path = chrom_sizes_path(assembly_name)
+    source = _source(assembly_name, fasta_index)
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(source):
+        print(f"genomes: Writing {path} from {source}")
+        write_chrom_sizes(read_chrom_sizes(source), path)
+        _chrom_sizes.pop(path, None)
+    return path
+
+
+def chrom_sizes(assembly_name: str, fasta_index: str = None) -> Dict[str, int]:
+    """Returns the chromosome sizes of an assembly, loaded once per index and process."""
+    path = ensure_chrom_sizes(assembly_name, fasta_index)
+    if path not in _chrom_sizes:
+        _chrom_sizes[path] = read_chrom_sizes(path)
+    return _chrom_sizes[path]
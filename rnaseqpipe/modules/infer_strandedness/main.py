@@ -1,131 +1,256 @@
 """
 Infers the strandedness of the reads to determine, if the reads can be mapped to the correct strand.
 
-This is done in two steps:
-1. Subsample X% of the reads from the fastq file to reduce computation time.
-2. Run salmon to infer the strandedness of the reads.
+By default ("kmer" engine) the k-mers of the first reads are looked up in a compact
+index of transcript ends, see modules/strandedness.py. This takes seconds on a single
+core. The index is built with the salmon index by scripts/make_salmon_index.py,
+without one the "salmon" engine is used.
 
-Step 1: Subsample reads to reduce compute
+The "salmon" engine does this in two steps:
+1. Subsample SUBSAMPLE_RECORD_COUNT reads in memory (see modules/subsample.py).
+2. Run salmon on the sample, fed through named pipes, to infer the strandedness.
 
-Step 2: Run Salmon to infer strandedness
-
-Open Question
-1. What to do with multiple files? E.g. paired RNA-seq
+Both return the library type as a dict (see strandedness.infer_library_type), which
+is also written to /data/{plid}/strandedness/strandedness.json.
 """
 
 from modal import App, Image, Secret, method, build, enter, Cls, Volume
-from typing import List
+from typing import Dict, List
 
 from rnaseqpipe.config import vol, salmon_image
 from rnaseqpipe.modules.utils import PLID
+from rnaseqpipe.modules.stagecache import StageCache, cache_dir
+from rnaseqpipe.modules.metrics import run_stage, measure
+from rnaseqpipe.modules.volsession import VolumeSession
+from rnaseqpipe.modules.scratch import Scratch
+from rnaseqpipe.modules.salmonindex import index_dir
+from rnaseqpipe.modules.strandedness import (
+    INDEX_VERSION,
+    SAMPLE_READS,
+    from_lib_format_counts,
+    index_path,
+    infer_library_type,
+    load_index,
+)
 
 app = App("rnaseq-strandedness")
 
 CPUS = 8
+KMER_CPUS = 1.0
+TOOL_VERSION = "salmon-1.10.0"
+TOOL_VERSION_KMER = INDEX_VERSION
+SUBSAMPLE_RECORD_COUNT = 60000
+# "head" or "reservoir", see subsample.subsample
+SUBSAMPLE_METHOD = "head"
+SUBSAMPLE_SEED = 0
+
+SALMON_BIN = "/salmon-latest_linux_x86_64/bin/salmon"
+SALMON_INDEX_DIR = "/data/salmon_index"
+
+# Salmon outputs that are copied to the volume
+SALMON_OUTPUTS = [
+    "lib_format_counts.json",
+    "quant.sf",
+    "cmd_info.json",
+    "aux_info/meta_info.json",
+    "logs/salmon_quant.log",
+]
 
 image = (
     Image.from_dockerfile("rnaseqpipe/modules/infer_strandedness/Dockerfile")
     .apt_install("wget", "tar", "libc6")
-    .run_commands(
-        "wget https://github.com/stjude-rust-labs/fq/releases/download/v0.11.0/fq-0.11.0-x86_64-unknown-linux-gnu.tar.gz"
-    )
-    .run_commands("tar -xvf fq-0.11.0-x86_64-unknown-linux-gnu.tar.gz")
     .run_commands(
         "wget https://github.com/COMBINE-lab/salmon/releases/download/v1.10.0/salmon-1.10.0_linux_x86_64.tar.gz"
     )
     .run_commands("tar -xzf salmon-1.10.0_linux_x86_64.tar.gz")
+    .pip_install("numpy")
 )
 
 
-@app.function(image=image, volumes={"/data": vol}, cpu=CPUS, timeout=60 * 100)
+@app.function(image=image, volumes={"/data": vol}, cpu=KMER_CPUS, timeout=60 * 100)
 def infer_strandedness(
-    plid: PLID, read_files: List[str], assembly_name: str, force_recompute: bool = False
-):
+    plid: PLID,
+    read_files: List[str],
+    assembly_name: str,
+    force_recompute: bool = False,
+    scratch: bool = True,
+    engine: str = "kmer",
+) -> Dict:
     """
-    Run salmon to infer strandedness
-    - can be infered from produced lib_format_counts.json
+    Infer the library type of the reads.
+
+    engine is one of
+        "kmer": look up the k-mers of the first reads in the index of transcript ends
+        "salmon": run salmon on a read sample and parse lib_format_counts.json. It
+            needs CPUS cores, i.e. infer_strandedness.with_options(cpu=CPUS)
+    With scratch, salmon's output stays on local disk and only SALMON_OUTPUTS are
+    copied to the volume. The read sample is never written to disk.
 
     Library type meaning is explained here:
     - https://salmon.readthedocs.io/en/latest/library_type.html
-    """
 
-    import subprocess
+    Returns:
+        Dict: library_type, strand, stranded, paired, sense_fraction,
+            informative_reads and reads, see strandedness.infer_library_type
+    """
+    import json
     import os
 
-    vol.reload()
+    session = VolumeSession(vol, plid, "infer_strandedness")
+    session.reload()
 
-    # Create the directory for subsampled reads
-    subsampled_path = f"/data/{plid}/reads/subsampled"
     result_path = f"/data/{plid}/strandedness/"
 
-    # Check if lib_format_counts.json already exists. If so infer_strandedness was already run and we can return
-    if os.path.exists(f"{result_path}/lib_format_counts.json") and not force_recompute:
+    salmon_index = index_dir(assembly_name, SALMON_INDEX_DIR)
+    kmer_index = index_path(salmon_index)
+    result_file = f"{result_path}strandedness.json"
+
+    if engine == "kmer" and not os.path.exists(kmer_index):
+        print(
+            f"{plid}:infer_strandedness: No k-mer index in {salmon_index}, run "
+            "scripts/make_salmon_index.py. Falling back to salmon."
+        )
+        engine = "salmon"
+
+    if engine == "kmer":
+        cache_args = (
+            TOOL_VERSION_KMER,
+            f"kmer {SAMPLE_READS} reads {SUBSAMPLE_METHOD} {SUBSAMPLE_SEED}",
+        )
+        cache_inputs = read_files + [kmer_index]
+    elif engine == "salmon":
+        cache_args = (
+            TOOL_VERSION,
+            f"subsample {SUBSAMPLE_RECORD_COUNT} {SUBSAMPLE_METHOD} {SUBSAMPLE_SEED} "
+            f"| salmon quant -i {salmon_index} --libType A",
+        )
+        cache_inputs = read_files + [f"{salmon_index}/versionInfo.json"]
+    else:
+        raise ValueError(f"{plid}:infer_strandedness: Unknown engine {engine}")
+
+    # Check if infer_strandedness was already run with the same reads and index
+    cache = StageCache(cache_dir(plid), "infer_strandedness", *cache_args, cache_inputs)
+    if cache.hit() and not force_recompute:
         print(
-            f"{plid}:infer_strandedness: lib_format_counts.json already exists! Skipping.\nIf you want to recompute, set force_recompute=True."
+            f"{plid}:infer_strandedness: Library type already inferred! Skipping.\nIf you want to recompute, set force_recompute=True."
         )
-        return True
+        # Runs from before strandedness.json only have lib_format_counts.json
+        if os.path.exists(result_file):
+            with open(result_file) as f:
+                return json.load(f)
+        return from_lib_format_counts(f"{result_path}lib_format_counts.json")
+
+    cache.invalidate()
+
+    if engine == "kmer":
+        with measure(plid, "strandedness_kmer", cpu=KMER_CPUS) as record:
+            library = infer_library_type(
+                load_index(kmer_index),
+                read_files,
+                method=SUBSAMPLE_METHOD,
+                seed=SUBSAMPLE_SEED,
+            )
+            record["reads"] = library["reads"]
+        outputs = []
+    else:
+        work_dir = Scratch(plid, "strandedness", result_path, enabled=scratch)
+        with work_dir:
+            outputs = _subsample_and_quant(plid, read_files, salmon_index, work_dir)
+        library = from_lib_format_counts(f"{result_path}lib_format_counts.json")
 
-    os.makedirs(subsampled_path, exist_ok=True)
+    library["engine"] = engine
+    print(f"{plid}:infer_strandedness: {library}")
 
-    subsampled_files = [
-        os.path.join(subsampled_path, os.path.basename(f)) for f in read_files
-    ]
+    os.makedirs(result_path, exist_ok=True)
+    with open(f"{result_file}.tmp", "w") as f:
+        json.dump(library, f, indent=2)
+    os.replace(f"{result_file}.tmp", result_file)
 
-    subsample_cmd = f"""/fq-0.11.0-x86_64-unknown-linux-gnu/fq subsample {' '.join(read_files)} \
-        --record-count 60000 \
-        --r1-dst {subsampled_files[0]} {f'--r2-dst {subsampled_files[1]}' if len(read_files) == 2 else ''}"""
+    cache.record(outputs + [result_file])
+    session.commit()
 
-    print(f"Subsampling reads: \n\t{subsample_cmd}")
+    return library
 
-    subprocess.run(subsample_cmd, check=True, shell=True)
 
-    vol.commit()
+def _subsample_and_quant(
+    plid: PLID,
+    read_files: List[str],
+    salmon_index: str,
+    work_dir: Scratch,
+) -> List[str]:
+    """Subsamples the reads and runs salmon on them in work_dir.
 
-    os.makedirs(result_path, exist_ok=True)
+    Returns:
+        List[str]: the published salmon outputs
+    """
+    import tempfile
+    from rnaseqpipe.modules.subsample import FifoFeeder, subsample
+
+    if len(read_files) not in (1, 2):
+        raise ValueError("Unsupported number of read files. Expected 1 or 2.")
+
+    with measure(plid, "subsample", cpu=1.0) as record:
+        mates = subsample(
+            read_files, SUBSAMPLE_RECORD_COUNT, SUBSAMPLE_METHOD, SUBSAMPLE_SEED
+        )
+        record["reads"] = len(mates[0])
+        record["method"] = SUBSAMPLE_METHOD
 
-    vol.commit()
+    # Named pipes only work on a local file system, not on the volume
+    with tempfile.TemporaryDirectory() as fifo_dir, FifoFeeder(
+        mates, fifo_dir
+    ) as subsampled_files:
+        return _salmon_quant(plid, subsampled_files, salmon_index, work_dir)
+
+
+def _salmon_quant(
+    plid: PLID,
+    subsampled_files: List[str],
+    salmon_index: str,
+    work_dir: Scratch,
+) -> List[str]:
+    """Runs salmon on the subsampled reads and publishes its outputs."""
+    import shlex
 
     # Configure salmon command based on the number of input files (single vs. paired)
-    if len(read_files) == 1:
+    if len(subsampled_files) == 1:
         salmon_lib_spec = ["-r", subsampled_files[0]]
-    elif len(read_files) == 2:
-        salmon_lib_spec = ["-1", subsampled_files[0], "-2", subsampled_files[1]]
     else:
-        raise ValueError("Unsupported number of read files. Expected 1 or 2.")
+        salmon_lib_spec = ["-1", subsampled_files[0], "-2", subsampled_files[1]]
 
-    prefix = result_path  # Output directory for Salmon
+    prefix = work_dir.path  # Output directory for Salmon
 
     salmon_cmd = (
         [
-            "/salmon-latest_linux_x86_64/bin/salmon",
+            SALMON_BIN,
             "quant",
             "-i",
-            f"/data/salmon_index/{assembly_name}/transcripts_index",
+            salmon_index,
             "--libType",
             "A",  # 'Auto' determining of library type
             "--threads",
             str(CPUS),
         ]
         + salmon_lib_spec
-        + ["--validateMappings", "-o", prefix, prefix]
+        + ["--validateMappings", "-o", prefix]
     )
 
-    # Execute Salmon quantification
-    process = subprocess.Popen(
-        salmon_cmd,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
+    # Execute Salmon quantification, its log goes to the container output
+    record = run_stage(
+        plid,
+        "salmon",
+        shlex.join(salmon_cmd),
+        inputs=subsampled_files,
+        outputs=[work_dir.path],
+        cpu=CPUS,
+        check=False,
     )
-    stdout, stderr = process.communicate()
 
     # Check for errors
-    if process.returncode != 0:
-        raise Exception(f"Salmon quantification failed: {stderr.decode('utf-8')}")
-
-    print(f"Output of salmon quant: {stdout.decode('utf-8')}")
+    if record["exit_code"] != 0:
+        raise Exception(f"Salmon quantification failed with {record['exit_code']}")
 
-    # Return path to results for further processing
-    return True
+    return work_dir.publish(SALMON_OUTPUTS)
 
 
 @app.local_entrypoint()
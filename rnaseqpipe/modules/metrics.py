@@ -0,0 +1,288 @@
+"""
+Per-stage timing and resource instrumentation.
+
+Every subprocess stage is run through `run_stage`, and in-process stages (e.g. the
+upload) are wrapped in `measure`. Both append one JSON record per invocation to
+/data/{plid}/metrics/{stage}.jsonl with
+
+- started / finished (epoch seconds) and wall_seconds
+- cpu_seconds (user + system) and peak_rss_kb
+- io_read_bytes / io_write_bytes: block I/O reported by the kernel
+- input_bytes / output_bytes: size of the declared input and output files
+- exit_code, plus the cpu / memory the container was given and any extra fields
+
+run_pipeline additionally writes the timings of its DAG nodes to dag.jsonl. The
+summary CLI reads these files from a local copy of the volume, e.g.
+
+    modal volume get rnaseq-vol / ./rnaseq-vol
+    python -m rnaseqpipe.modules.metrics ./rnaseq-vol
+
+and prints the critical path, wall time and estimated cost of every sample.
+"""
+
+import glob
+import json
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, List
+
+# Modal list prices, override with --cpu-price / --memory-price
+CPU_PRICE_PER_SECOND = 0.0000131  # per core
+MEMORY_PRICE_PER_GIB_SECOND = 0.00000222
+
+
+def metrics_dir(plid: str, root: str = "/data") -> str:
+    return os.path.join(root, str(plid), "metrics")
+
+
+def _size(paths: Iterable[str]) -> int:
+    total = 0
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                total += sum(os.path.getsize(os.path.join(root, n)) for n in names)
+        elif os.path.exists(path):
+            total += os.path.getsize(path)
+    return total
+
+
+def write_record(directory: str, stage: str, record: Dict) -> None:
+    """Appends a record to {directory}/{stage}.jsonl."""
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, f"{stage}.jsonl"), "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def run_stage(
+    plid: str,
+    stage: str,
+    cmd: str,
+    inputs: Iterable[str] = (),
+    outputs: Iterable[str] = (),
+    cpu: float = None,
+    memory: int = None,
+    extra: Dict = None,
+    check: bool = True,
+    **kwargs,
+) -> Dict:
+    """Runs a shell command and records its metrics.
+
+    The resource usage is taken from wait4 on the process, which covers the shell
+    and every descendant it waited for, independent of other calls in the container.
+
+    Args:
+        plid (str): pipeline ID, None to only measure without recording
+        stage (str): name of the stage, also the name of the metrics file
+        cmd (str): shell command
+        inputs, outputs (Iterable[str]): files or directories read / written
+        cpu (float), memory (int): resources of the container, recorded for cost
+        extra (Dict): additional fields of the record
+        check (bool): raise CalledProcessError on a non-zero exit code
+
+    Returns:
+        Dict: the record
+    """
+    import subprocess
+
+    started = time.time()
+    process = subprocess.Popen(cmd, shell=True, **kwargs)
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    finished = time.time()
+
+    record = {
+        "plid": str(plid) if plid else None,
+        "stage": stage,
+        "started": started,
+        "finished": finished,
+        "wall_seconds": finished - started,
+        "cpu_seconds": rusage.ru_utime + rusage.ru_stime,
+        "peak_rss_kb": rusage.ru_maxrss,
+        "io_read_bytes": rusage.ru_inblock * 512,
+        "io_write_bytes": rusage.ru_oublock * 512,
+        "input_bytes": _size(inputs),
+        "output_bytes": _size(outputs),
+        "exit_code": process.returncode,
+        "cpu": cpu,
+        "memory": memory,
+        **(extra or {}),
+    }
+
+    if plid:
+        write_record(metrics_dir(plid), stage, record)
+
+    print(
+        f"{plid}:{stage}: exit code {record['exit_code']} after {record['wall_seconds']:.1f}s, "
+        f"peak RSS {record['peak_rss_kb'] / 1024:.0f} MB"
+    )
+
+    if check and process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+
+    return record
+
+
+@contextmanager
+def measure(
+    plid: str,
+    stage: str,
+    cpu: float = None,
+    memory: int = None,
+    children: bool = False,
+):
+    """Records the metrics of an in-process stage.
+
+    The yielded dict can be updated with input_bytes, output_bytes or other fields.
+    CPU time and peak RSS are those of the whole process, or with children=True those
+    of all child processes reaped in the meantime (for stages that manage several
+    subprocesses themselves).
+
+        with measure(plid, "upload") as record:
+            record["output_bytes"] = upload(...)
+    """
+    import resource
+
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    usage_before = resource.getrusage(who)
+    record = {
+        "plid": str(plid),
+        "stage": stage,
+        "started": time.time(),
+        "input_bytes": 0,
+        "output_bytes": 0,
+        "cpu": cpu,
+        "memory": memory,
+    }
+    exit_code = 1
+    try:
+        yield record
+        exit_code = 0
+    finally:
+        usage = resource.getrusage(who)
+        record["finished"] = time.time()
+        record["wall_seconds"] = record["finished"] - record["started"]
+        record["cpu_seconds"] = (usage.ru_utime + usage.ru_stime) - (
+            usage_before.ru_utime + usage_before.ru_stime
+        )
+        record["peak_rss_kb"] = usage.ru_maxrss
+        record["io_read_bytes"] = (usage.ru_inblock - usage_before.ru_inblock) * 512
+        record["io_write_bytes"] = (usage.ru_oublock - usage_before.ru_oublock) * 512
+        record["exit_code"] = exit_code
+        write_record(metrics_dir(plid), stage, record)
+
+
+def load_records(directory: str) -> List[Dict]:
+    records = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.jsonl"))):
+        with open(path) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+
+def critical_path(dag_records: List[Dict]) -> List[Dict]:
+    """Returns the chain of DAG nodes that determined the end-to-end wall time.
+
+    Starting from the node that finished last, repeatedly follow the dependency that
+    finished last, since that is the one the node was waiting for.
+    """
+    completed = [r for r in dag_records if r.get("finished")]
+    if not completed:
+        return []
+
+    by_name = {r["node"]: r for r in completed}
+    node = max(completed, key=lambda r: r["finished"])
+    path = [node]
+    while True:
+        deps = [by_name[d] for d in node.get("depends_on", []) if d in by_name]
+        if not deps:
+            break
+        node = max(deps, key=lambda r: r["finished"])
+        path.append(node)
+
+    return list(reversed(path))
+
+
+def stage_cost(
+    record: Dict,
+    cpu_price: float = CPU_PRICE_PER_SECOND,
+    memory_price: float = MEMORY_PRICE_PER_GIB_SECOND,
+) -> float:
+    """Estimated cost of a stage invocation from its reserved resources."""
+    cpu = record.get("cpu") or 1.0
+    memory_gib = (record.get("memory") or 0) / 1024
+    return record["wall_seconds"] * (cpu * cpu_price + memory_gib * memory_price)
+
+
+def summarize(
+    root: str,
+    cpu_price: float = CPU_PRICE_PER_SECOND,
+    memory_price: float = MEMORY_PRICE_PER_GIB_SECOND,
+) -> str:
+    """Summarizes the metrics of all pipeline runs below root (a copy of /data)."""
+    lines = [
+        f"{'sample':<20}{'wall [s]':>10}{'cost [$]':>10}  critical path",
+    ]
+    stage_totals = {}
+
+    for directory in sorted(glob.glob(os.path.join(root, "pl-*", "metrics"))):
+        plid = os.path.basename(os.path.dirname(directory))
+        records = load_records(directory)
+
+        # Only the latest run of the pipeline determines its critical path
+        dag_records = [r for r in records if r["stage"] == "dag"]
+        if dag_records:
+            latest = max(r["run"] for r in dag_records)
+            dag_records = [r for r in dag_records if r["run"] == latest]
+        stage_records = [r for r in records if r["stage"] != "dag"]
+
+        cost = sum(stage_cost(r, cpu_price, memory_price) for r in stage_records)
+        path = critical_path(dag_records)
+        wall = (
+            max(r["finished"] for r in path) - min(r["started"] for r in path)
+            if path
+            else 0.0
+        )
+        lines.append(
+            f"{plid:<20}{wall:>10.0f}{cost:>10.4f}  "
+            + " -> ".join(f"{r['node']} ({r['wall_seconds']:.0f}s)" for r in path)
+        )
+
+        for record in stage_records:
+            totals = stage_totals.setdefault(
+                record["stage"], {"n": 0, "wall": 0.0, "cost": 0.0, "rss": 0}
+            )
+            totals["n"] += 1
+            totals["wall"] += record["wall_seconds"]
+            totals["cost"] += stage_cost(record, cpu_price, memory_price)
+            totals["rss"] = max(totals["rss"], record.get("peak_rss_kb") or 0)
+
+    lines.append("")
+    lines.append(
+        f"{'stage':<20}{'runs':>6}{'mean wall [s]':>15}{'max RSS [MB]':>14}{'cost [$]':>10}"
+    )
+    for stage, totals in sorted(
+        stage_totals.items(), key=lambda item: item[1]["cost"], reverse=True
+    ):
+        lines.append(
+            f"{stage:<20}{totals['n']:>6}{totals['wall'] / totals['n']:>15.1f}"
+            f"{totals['rss'] / 1024:>14.0f}{totals['cost']:>10.4f}"
+        )
+
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Summarize pipeline metrics from a local copy of the volume."
+    )
+    parser.add_argument("root", help="directory containing the pl-* folders")
+    parser.add_argument("--cpu-price", type=float, default=CPU_PRICE_PER_SECOND)
+    parser.add_argument(
+        "--memory-price", type=float, default=MEMORY_PRICE_PER_GIB_SECOND
+    )
+    args = parser.parse_args()
+
+    print(summarize(args.root, args.cpu_price, args.memory_price))
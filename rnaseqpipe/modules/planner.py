@@ -0,0 +1,156 @@
+"""
+Plans which samples to run from the read files in blob storage.
+
+The accession index is built with prefix-scoped listings (one per requested
+accession) instead of listing the whole container. Read file names are parsed as
+`{accession}.fastq.gz` (single-end) or `{accession}_{1,2}.fastq.gz` (paired-end), so
+accessions may contain underscores. Samples are validated for complete pairs and
+ordered largest-first, so the long tail of big samples starts as early as possible.
+
+The blob store is abstracted so planning can run against a local directory, e.g.:
+
+    plan = build_plan(DirectoryBlobStore("/tmp/reads"), ["SRR11808917"])
+"""
+
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Tuple
+
+READ_FILE_PATTERN = re.compile(
+    r"^(?P<accession>.+?)(?:_(?P<mate>[12]))?\.(?:fastq|fq)\.gz$"
+)
+
+
+class AzureBlobStore:
+    def __init__(self, container_client) -> None:
+        self.container_client = container_client
+
+    def list(self, prefix: str = "") -> Iterable[Tuple[str, int]]:
+        """Yields (name, size) of every blob starting with prefix."""
+        for blob in self.container_client.list_blobs(name_starts_with=prefix or None):
+            yield blob.name, blob.size
+
+
+class DirectoryBlobStore:
+    """Stand-in for a blob container backed by a local directory."""
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+
+    def list(self, prefix: str = "") -> Iterable[Tuple[str, int]]:
+        for name in sorted(os.listdir(self.root)):
+            path = os.path.join(self.root, name)
+            if name.startswith(prefix) and os.path.isfile(path):
+                yield name, os.path.getsize(path)
+
+
+class SamplePlan:
+    def __init__(self, accession: str, files: List[str], input_bytes: int) -> None:
+        self.accession = accession
+        self.files = files
+        self.input_bytes = input_bytes
+
+    @property
+    def paired(self) -> bool:
+        return len(self.files) == 2
+
+    def task(self) -> Tuple[str, List[str]]:
+        """Returns the sample_id tuple run_pipeline expects."""
+        return (self.accession, self.files)
+
+
+class Plan:
+    def __init__(self) -> None:
+        self.samples: List[SamplePlan] = []
+        self.invalid: Dict[str, str] = {}
+        self.missing: List[str] = []
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(sample.input_bytes for sample in self.samples)
+
+    def tasks(self) -> List[Tuple[str, List[str]]]:
+        return [sample.task() for sample in self.samples]
+
+    def summary(self) -> str:
+        lines = [
+            f"{len(self.samples)} samples, {self.total_bytes / 1e9:.2f} GB input, "
+            f"{len(self.invalid)} invalid, {len(self.missing)} missing"
+        ]
+        for sample in self.samples:
+            lines.append(
+                f"  {sample.accession:<20}{'paired' if sample.paired else 'single':<8}"
+                f"{sample.input_bytes / 1e6:>12.1f} MB"
+            )
+        for accession, reason in self.invalid.items():
+            lines.append(f"  {accession:<20}invalid: {reason}")
+        for accession in self.missing:
+            lines.append(f"  {accession:<20}missing")
+        return "\n".join(lines)
+
+
+def index_read_files(blobs: Iterable[Tuple[str, int]]) -> Dict[str, Dict]:
+    """Groups read files by accession.
+
+    Returns:
+        Dict[str, Dict]: accession -> {mate: (name, size)}, where mate is None for
+            single-end files
+    """
+    index = {}
+    for name, size in blobs:
+        match = READ_FILE_PATTERN.match(name)
+        if match is None:
+            continue
+        mate = match.group("mate")
+        index.setdefault(match.group("accession"), {})[mate] = (name, size)
+    return index
+
+
+def _plan_sample(accession: str, mates: Dict) -> Tuple[SamplePlan, str]:
+    """Returns the plan of a sample or the reason why it is invalid."""
+    if set(mates) == {"1", "2"}:
+        files = [mates["1"], mates["2"]]
+    elif set(mates) == {None}:
+        files = [mates[None]]
+    elif None in mates:
+        return None, "both single-end and paired-end read files"
+    else:
+        return None, f"incomplete pair, only mate {list(mates)[0]}"
+
+    return SamplePlan(accession, [n for n, _ in files], sum(s for _, s in files)), None
+
+
+def build_plan(store, accessions: List[str], max_workers: int = 16) -> Plan:
+    """Plans the samples for the given accessions, largest first.
+
+    Args:
+        store: blob store with a list(prefix) method yielding (name, size)
+        accessions (List[str]): accessions to run. All accessions in the store if empty.
+        max_workers (int): number of prefix listings run in parallel
+    """
+    if accessions:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            listings = executor.map(lambda acc: list(store.list(acc)), accessions)
+            index = {}
+            for accession, blobs in zip(accessions, listings):
+                # A prefix listing also returns longer accessions (SRR1 -> SRR10)
+                found = index_read_files(blobs).get(accession)
+                if found:
+                    index[accession] = found
+    else:
+        index = index_read_files(store.list())
+
+    plan = Plan()
+    plan.missing = [acc for acc in accessions if acc not in index]
+
+    for accession, mates in index.items():
+        sample, reason = _plan_sample(accession, mates)
+        if sample is None:
+            plan.invalid[accession] = reason
+        else:
+            plan.samples.append(sample)
+
+    plan.samples.sort(key=lambda sample: sample.input_bytes, reverse=True)
+
+    return plan
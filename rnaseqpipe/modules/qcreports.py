@@ -0,0 +1,211 @@
+"""
+Parsers that turn the QC reports of a run into typed records.
+
+Every report type becomes one table with a fixed Arrow schema:
+- star: STAR's Log.final.out, one record per sample
+- trimming: Trim Galore's (cutadapt's) *_trimming_report.txt, one per read file
+- fastqc: basic statistics and module status from fastqc_data.txt in the FastQC zip,
+  one per read file
+- library: salmon's lib_format_counts.json of the quantification or the strandedness
+  step, one per file
+
+    records = collect_records("pl-SRR6059709")  # -> {"star": [{...}], ...}
+    table = to_table("star", records["star"])
+
+Fields a report does not contain are null.
+"""
+
+import glob
+import json
+import os
+import re
+import zipfile
+from typing import Dict, List
+
+# Label in Log.final.out -> (field, type)
+STAR_FIELDS = {
+    "Number of input reads": ("input_reads", int),
+    "Average input read length": ("average_input_read_length", float),
+    "Uniquely mapped reads number": ("uniquely_mapped_reads", int),
+    "Uniquely mapped reads %": ("uniquely_mapped_pct", float),
+    "Average mapped length": ("average_mapped_length", float),
+    "Number of splices: Total": ("splices_total", int),
+    "Mismatch rate per base, %": ("mismatch_rate_pct", float),
+    "Number of reads mapped to multiple loci": ("multi_mapped_reads", int),
+    "% of reads mapped to multiple loci": ("multi_mapped_pct", float),
+    "Number of reads mapped to too many loci": ("too_many_loci_reads", int),
+    "% of reads unmapped: too many mismatches": ("unmapped_mismatches_pct", float),
+    "% of reads unmapped: too short": ("unmapped_too_short_pct", float),
+    "% of reads unmapped: other": ("unmapped_other_pct", float),
+    "Number of chimeric reads": ("chimeric_reads", int),
+}
+
+# Pattern in the trimming report -> (field, type)
+TRIMMING_FIELDS = {
+    r"Total reads processed:\s+([\d,]+)": ("reads_processed", int),
+    r"Reads with adapters:\s+([\d,]+)": ("reads_with_adapters", int),
+    r"Reads written \(passing filters\):\s+([\d,]+)": ("reads_written", int),
+    r"Total basepairs processed:\s+([\d,]+) bp": ("bp_processed", int),
+    r"Quality-trimmed:\s+([\d,]+) bp": ("bp_quality_trimmed", int),
+    r"Total written \(filtered\):\s+([\d,]+) bp": ("bp_written", int),
+    r"sequence pairs removed because at least one read was shorter than the length "
+    r"cutoff \(\d+ bp\):\s+([\d,]+)": ("pairs_removed_too_short", int),
+}
+
+# Basic statistics in fastqc_data.txt -> (field, type)
+FASTQC_FIELDS = {
+    "Total Sequences": ("total_sequences", int),
+    "Sequences flagged as poor quality": ("poor_quality_sequences", int),
+    "Sequence length": ("sequence_length", str),
+    "%GC": ("gc_pct", float),
+}
+
+LIBRARY_FIELDS = {
+    "expected_format": ("expected_format", str),
+    "compatible_fragment_ratio": ("compatible_fragment_ratio", float),
+    "num_compatible_fragments": ("num_compatible_fragments", int),
+    "num_assigned_fragments": ("num_assigned_fragments", int),
+    "strand_mapping_bias": ("strand_mapping_bias", float),
+}
+
+_ARROW_TYPES = {int: "int64", float: "float64", str: "string"}
+
+
+def _cast(value: str, kind: type):
+    try:
+        return kind(value.replace(",", "").strip().rstrip("%"))
+    except (ValueError, AttributeError):
+        return None
+
+
+def _slug(name: str) -> str:
+    return re.sub(r"[^a-z0-9]+", "_", name.lower()).strip("_")
+
+
+def parse_star_log(path: str) -> Dict:
+    """Parses STAR's Log.final.out."""
+    record = {field: None for field, _ in STAR_FIELDS.values()}
+    with open(path) as f:
+        for line in f:
+            label, sep, value = line.partition("|")
+            if sep and label.strip() in STAR_FIELDS:
+                field, kind = STAR_FIELDS[label.strip()]
+                record[field] = _cast(value, kind)
+    return record
+
+
+def parse_trimming_report(path: str) -> Dict:
+    """Parses a Trim Galore trimming report."""
+    with open(path) as f:
+        text = f.read()
+    record = {"file": os.path.basename(path)}
+    for pattern, (field, kind) in TRIMMING_FIELDS.items():
+        match = re.search(pattern, text)
+        record[field] = _cast(match.group(1), kind) if match else None
+    return record
+
+
+def parse_fastqc_data(text: str) -> Dict:
+    """Parses the basic statistics and the module status of fastqc_data.txt.
+
+    Module status is stored as e.g. per_base_sequence_quality: "pass"
+    """
+    record = {field: None for field, _ in FASTQC_FIELDS.values()}
+    for line in text.splitlines():
+        if line.startswith(">>") and not line.startswith(">>END_MODULE"):
+            name, _, status = line[2:].partition("\t")
+            record[_slug(name)] = status.strip()
+            continue
+        key, _, value = line.partition("\t")
+        if key in FASTQC_FIELDS:
+            field, kind = FASTQC_FIELDS[key]
+            record[field] = _cast(value, kind)
+    return record
+
+
+def parse_fastqc_zip(path: str) -> Dict:
+    """Parses fastqc_data.txt inside a FastQC result zip."""
+    with zipfile.ZipFile(path) as archive:
+        name = next(n for n in archive.namelist() if n.endswith("/fastqc_data.txt"))
+        record = parse_fastqc_data(archive.read(name).decode())
+    record["file"] = os.path.basename(path)
+    return record
+
+
+def parse_lib_format_counts(path: str) -> Dict:
+    """Parses salmon's lib_format_counts.json."""
+    with open(path) as f:
+        counts = json.load(f)
+    record = {"file": os.path.relpath(path, os.path.dirname(os.path.dirname(path)))}
+    for key, (field, kind) in LIBRARY_FIELDS.items():
+        value = counts.get(key)
+        record[field] = None if value is None else kind(value)
+    return record
+
+
+def collect_records(plid: str, root: str = "/data") -> Dict[str, List[Dict]]:
+    """Parses all QC reports of a run.
+
+    Returns:
+        Dict[str, List[Dict]]: records per table, each with the plid
+    """
+    run_dir = os.path.join(root, str(plid))
+    records = {"star": [], "trimming": [], "fastqc": [], "library": []}
+
+    star_log = os.path.join(run_dir, "staralign", "Log.final.out")
+    if os.path.exists(star_log):
+        records["star"].append(parse_star_log(star_log))
+    for path in sorted(glob.glob(f"{run_dir}/trimgalore/*_trimming_report.txt")):
+        records["trimming"].append(parse_trimming_report(path))
+    for path in sorted(glob.glob(f"{run_dir}/fastqc/*_fastqc.zip")):
+        records["fastqc"].append(parse_fastqc_zip(path))
+    for stage in ("salmon", "strandedness"):
+        path = os.path.join(run_dir, stage, "lib_format_counts.json")
+        if os.path.exists(path):
+            records["library"].append(parse_lib_format_counts(path))
+
+    for table in records.values():
+        for record in table:
+            record["plid"] = str(plid)
+    return records
+
+
+def schema(table: str, records: List[Dict] = ()):
+    """Returns the Arrow schema of a table.
+
+    The FastQC module status columns are taken from the records, as they depend on
+    the FastQC version and configuration.
+    """
+    import pyarrow as pa
+
+    fields = {
+        "star": STAR_FIELDS.values(),
+        "trimming": TRIMMING_FIELDS.values(),
+        "fastqc": FASTQC_FIELDS.values(),
+        "library": LIBRARY_FIELDS.values(),
+    }[table]
+    columns = [("plid", pa.string())]
+    if table != "star":
+        columns.append(("file", pa.string()))
+    columns += [
+        (field, pa.type_for_alias(_ARROW_TYPES[kind])) for field, kind in fields
+    ]
+
+    known = {name for name, _ in columns}
+    for record in records:
+        for name in record:
+            if name not in known:
+                columns.append((name, pa.string()))
+                known.add(name)
+    return pa.schema(columns)
+
+
+def to_table(table: str, records: List[Dict]):
+    """Converts the records of a table into an Arrow table with its schema."""
+    import pyarrow as pa
+
+    table_schema = schema(table, records)
+    return pa.Table.from_pylist(
+        [{name: record.get(name) for name in table_schema.names} for record in records],
+        schema=table_schema,
+    )
@@ -0,0 +1,92 @@
+"""
+Columnar store of the QC metrics of all runs.
+
+The QC reports of the samples of a batch (see modules/qcreports.py) are parsed into
+typed records and written as one Parquet file per table and batch, partitioned by
+batch:
+
+    /data/qc/{table}/batch_id={batch_id}/part-0.parquet
+
+Storing a batch again replaces its partition. Batch-wide questions are then a scan
+of a few columns instead of thousands of text files, e.g. after
+`modal volume get rnaseq-vol qc`:
+
+    import pyarrow.dataset as ds
+    star = ds.dataset("qc/star", partitioning="hive").to_table(
+        columns=["plid", "uniquely_mapped_pct"]
+    )
+
+Run this on modal with: modal run rnaseqpipe/modules/qcstore.py
+"""
+
+from modal import Image, App
+from typing import List
+
+from rnaseqpipe.config import vol
+from rnaseqpipe.modules.metrics import measure
+from rnaseqpipe.modules.volsession import VolumeSession
+from rnaseqpipe.modules.batching import batch_id as make_batch_id
+from rnaseqpipe.modules.qcreports import collect_records, to_table
+from rnaseqpipe.modules.counts import save_parquet
+
+app = App("rnaseq-qcstore")
+
+image = Image.debian_slim().pip_install("pyarrow")
+
+QC_ROOT = "/data/qc"
+TABLES = ["star", "trimming", "fastqc", "library"]
+
+
+def partition_path(table: str, batch_id: str, root: str = QC_ROOT) -> str:
+    return f"{root}/{table}/batch_id={batch_id}/part-0.parquet"
+
+
+@app.function(image=image, volumes={"/data": vol}, timeout=60 * 30)
+def store_qc(plids: List[str], batch_id: str = None):
+    """Parse the QC reports of the samples of a batch into the QC store.
+
+    Args:
+        plids (List[str]): samples of the batch
+        batch_id (str): ID of the batch, derived from the plids by default
+
+    Returns:
+        Dict[str, int]: number of records per table
+    """
+    import os
+
+    batch_id = batch_id or make_batch_id(plids)
+    metrics_id = os.path.join("batches", batch_id)
+    session = VolumeSession(vol, metrics_id, "qc_store")
+    session.reload()
+
+    with measure(metrics_id, "qc_store") as record:
+        records = {table: [] for table in TABLES}
+        for plid in plids:
+            try:
+                for table, rows in collect_records(plid).items():
+                    records[table] += rows
+            except Exception as e:
+                # A broken report must not keep the other samples out of the store
+                print(f"{plid}:qc_store: Could not parse the QC reports: {e}")
+
+        for table, rows in records.items():
+            path = partition_path(table, batch_id)
+            if not rows:
+                if os.path.exists(path):
+                    os.remove(path)
+                continue
+            save_parquet(to_table(table, rows), path)
+            record["output_bytes"] += os.path.getsize(path)
+
+    counts = {table: len(rows) for table, rows in records.items()}
+    print(f"{batch_id}:qc_store: Stored {counts} records of {len(plids)} samples")
+
+    session.commit()
+    return counts
+
+
+@app.local_entrypoint()
+def run():
+    plids = ["pl-SRR6059709", "pl-DRR023785"]
+
+    print(store_qc.remote(plids))
@@ -0,0 +1,116 @@
+"""
+Lightweight read QC computed natively in Python.
+
+Streams a (gzipped) FASTQ file in chunks of records and computes per-base mean
+quality, GC content and the read length distribution with vectorized NumPy. This
+gives a cheap QC number for every sample without the JVM startup cost of FastQC.
+"""
+
+import gzip
+from itertools import islice
+from typing import Dict
+
+CHUNK_RECORDS = 100_000
+PHRED_OFFSET = 33
+
+
+def _open_fastq(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def _accumulate(total, counts):
+    """Adds two 1D count arrays of possibly different length."""
+    import numpy as np
+
+    if total is None:
+        return counts.astype(np.float64)
+    if len(counts) > len(total):
+        total, counts = counts.astype(np.float64), total
+    total[: len(counts)] += counts
+    return total
+
+
+def summarize_fastq(path: str, chunk_records: int = CHUNK_RECORDS) -> Dict:
+    """Computes a QC summary of a FASTQ file.
+
+    Args:
+        path (str): path to a plain or gzipped FASTQ file
+        chunk_records (int): number of records processed per vectorized chunk
+
+    Returns:
+        Dict: read and base counts, mean quality, fraction of bases >= Q30,
+            per-base mean quality, mean GC content, GC histogram (percent) and
+            read length histogram
+    """
+    import numpy as np
+
+    gc_lookup = np.zeros(256, dtype=np.uint8)
+    for base in b"GCgc":
+        gc_lookup[base] = 1
+
+    n_reads = 0
+    n_bases = 0
+    q30_bases = 0
+    quality_sum = None
+    position_count = None
+    length_hist = None
+    gc_hist = np.zeros(101, dtype=np.int64)
+    gc_sum = 0.0
+    gc_reads = 0
+
+    with _open_fastq(path) as f:
+        while True:
+            lines = list(islice(f, 4 * chunk_records))
+            if not lines:
+                break
+
+            seqs = [line.rstrip(b"\r\n") for line in lines[1::4]]
+            quals = [line.rstrip(b"\r\n") for line in lines[3::4]]
+
+            lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+            seq = np.frombuffer(b"".join(seqs), dtype=np.uint8)
+            qual = np.frombuffer(b"".join(quals), dtype=np.uint8).astype(np.int64)
+            qual -= PHRED_OFFSET
+
+            # Position of every base within its read
+            starts = np.cumsum(lengths) - lengths
+            position = np.arange(len(qual)) - np.repeat(starts, lengths)
+
+            quality_sum = _accumulate(quality_sum, np.bincount(position, weights=qual))
+            position_count = _accumulate(position_count, np.bincount(position))
+            length_hist = _accumulate(length_hist, np.bincount(lengths))
+            q30_bases += int(np.count_nonzero(qual >= 30))
+
+            nonempty = lengths > 0
+            if nonempty.any():
+                gc_counts = np.add.reduceat(gc_lookup[seq], starts[nonempty])
+                gc_fraction = gc_counts / lengths[nonempty]
+                gc_hist += np.bincount(
+                    np.rint(gc_fraction * 100).astype(np.int64), minlength=101
+                )
+                gc_sum += float(gc_fraction.sum())
+                gc_reads += len(gc_fraction)
+
+            n_reads += len(seqs)
+            n_bases += int(lengths.sum())
+
+    if n_reads == 0:
+        return {"file": path, "reads": 0, "bases": 0}
+
+    return {
+        "file": path,
+        "reads": n_reads,
+        "bases": n_bases,
+        "mean_quality": float(quality_sum.sum() / n_bases) if n_bases else 0.0,
+        "q30_fraction": q30_bases / n_bases if n_bases else 0.0,
+        "per_base_mean_quality": (quality_sum / np.maximum(position_count, 1))
+        .round(2)
+        .tolist(),
+        "mean_gc": gc_sum / gc_reads if gc_reads else 0.0,
+        "gc_histogram": gc_hist.tolist(),
+        "length_histogram": {
+            int(length): int(count) for length, count in enumerate(length_hist) if count
+        },
+    }
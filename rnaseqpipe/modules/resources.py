@@ -0,0 +1,210 @@
+"""
+Resource model that sizes CPU and memory of a stage invocation from its input.
+
+For every sized stage the model holds
+- cpu_bytes_per_second: input bytes one CPU processes per second
+- target_seconds: wall time the stage should take, CPUs are scaled to reach it
+- min_cpu / max_cpu: bounds for the number of CPUs
+- base_memory_mb: memory needed independent of the input
+- memory_mb_per_gb: additional memory per GB of input
+- index_memory_factor: memory per byte of the reference index (e.g. STAR genome)
+- max_memory_mb: upper bound for the memory, the largest container available
+
+CPUs are rounded up to a power of two so that invocations fall into a few tiers.
+Sized stages record their input size, resources, runtime and peak RSS through
+metrics.run_stage, and `calibrate` refits the model from those records.
+"""
+
+import glob
+import json
+import math
+import os
+import statistics
+from typing import Dict, List, Tuple
+
+MODEL_PATH = "/data/resources/model.json"
+
+# Largest memory a Modal container can request
+MAX_MEMORY_MB = 336 * 1024
+
+DEFAULT_MODEL = {
+    "trimgalore": {
+        "cpu_bytes_per_second": 4 * 1024**2,
+        "target_seconds": 15 * 60,
+        "min_cpu": 2,
+        "max_cpu": 8,
+        "base_memory_mb": 1024,
+        "memory_mb_per_gb": 128,
+        "index_memory_factor": 0.0,
+        "max_memory_mb": MAX_MEMORY_MB,
+    },
+    "staralign": {
+        "cpu_bytes_per_second": 2 * 1024**2,
+        "target_seconds": 20 * 60,
+        "min_cpu": 4,
+        "max_cpu": 32,
+        "base_memory_mb": 4 * 1024,
+        "memory_mb_per_gb": 512,
+        "index_memory_factor": 1.2,
+        "max_memory_mb": MAX_MEMORY_MB,
+    },
+    "salmon_quant": {
+        "cpu_bytes_per_second": 8 * 1024**2,
+        "target_seconds": 10 * 60,
+        "min_cpu": 4,
+        "max_cpu": 16,
+        "base_memory_mb": 2 * 1024,
+        "memory_mb_per_gb": 64,
+        "index_memory_factor": 1.5,
+        "max_memory_mb": MAX_MEMORY_MB,
+    },
+}
+
+# Memory headroom on top of the observed peak RSS when calibrating
+MEMORY_HEADROOM = 1.5
+# Share of the observations the calibrated memory line lies above
+MEMORY_PERCENTILE = 0.95
+
+
+def load_model(path: str = MODEL_PATH) -> Dict:
+    """Returns the calibrated model if one exists, merged over the defaults."""
+    model = {stage: dict(params) for stage, params in DEFAULT_MODEL.items()}
+    if os.path.exists(path):
+        with open(path) as f:
+            for stage, params in json.load(f).items():
+                model.setdefault(stage, {}).update(params)
+    return model
+
+
+def plan_resources(
+    stage: str, input_bytes: int, index_bytes: int = 0, model: Dict = None
+) -> Dict:
+    """Picks CPU and memory (MB) for a stage invocation.
+
+    Args:
+        stage (str): name of the stage in the model
+        input_bytes (int): total size of the stage's input files
+        index_bytes (int): size of the reference index the stage loads
+        model (Dict): resource model, defaults to load_model()
+
+    Returns:
+        Dict: {"cpu": float, "memory": int}, usable as Modal with_options kwargs
+    """
+    params = (model or load_model())[stage]
+
+    cpu_seconds = input_bytes / params["cpu_bytes_per_second"]
+    cpu = max(cpu_seconds / params["target_seconds"], 1)
+    cpu = 2 ** math.ceil(math.log2(cpu))
+    cpu = min(max(cpu, params["min_cpu"]), params["max_cpu"])
+
+    memory = (
+        params["base_memory_mb"]
+        + params["memory_mb_per_gb"] * input_bytes / 1024**3
+        + params["index_memory_factor"] * index_bytes / 1024**2
+    )
+    memory = min(memory, params.get("max_memory_mb", MAX_MEMORY_MB))
+
+    return {"cpu": float(cpu), "memory": int(math.ceil(memory))}
+
+
+def directory_bytes(path: str) -> int:
+    """Returns the total size of all files below path, 0 if it does not exist."""
+    total = 0
+    for root, _, names in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in names)
+    return total
+
+
+def load_observations(root: str = "/data") -> List[Dict]:
+    """Returns the metrics records of all sized stages of all runs."""
+    from rnaseqpipe.modules.metrics import load_records
+
+    observations = []
+    for directory in glob.glob(f"{root}/pl-*/metrics"):
+        observations.extend(
+            r for r in load_records(directory) if r["stage"] in DEFAULT_MODEL
+        )
+    return observations
+
+
+def fit_memory(points: List[Tuple[float, float]]) -> Tuple[float, float]:
+    """Fits memory (MB) = base + per_gb * input (GB) by least squares.
+
+    The line is shifted up to lie above MEMORY_PERCENTILE of the points and
+    scaled by MEMORY_HEADROOM, neither coefficient is negative.
+
+    Args:
+        points (List[Tuple[float, float]]): (input GB, memory MB) per observation,
+            with at least two different input sizes
+
+    Returns:
+        Tuple[float, float]: base memory (MB) and memory per GB of input
+    """
+    mean_gb = statistics.fmean(gb for gb, _ in points)
+    mean_mb = statistics.fmean(mb for _, mb in points)
+    per_gb = sum((gb - mean_gb) * (mb - mean_mb) for gb, mb in points) / sum(
+        (gb - mean_gb) ** 2 for gb, _ in points
+    )
+    per_gb = max(per_gb, 0.0)
+    base = mean_mb - per_gb * mean_gb
+
+    residuals = sorted(mb - (base + per_gb * gb) for gb, mb in points)
+    base += residuals[min(int(len(residuals) * MEMORY_PERCENTILE), len(residuals) - 1)]
+
+    return max(base, 0.0) * MEMORY_HEADROOM, per_gb * MEMORY_HEADROOM
+
+
+def calibrate(observations: List[Dict], model: Dict = None) -> Dict:
+    """Refits throughput and memory coefficients per stage from observations.
+
+    - cpu_bytes_per_second: median input bytes per CPU-second of wall time
+    - base_memory_mb, memory_mb_per_gb: fit_memory of the peak RSS beyond the
+      index memory against the input size, only if the observations cover at
+      least two input sizes
+    """
+    model = model or load_model()
+
+    by_stage = {}
+    for obs in observations:
+        if obs.get("exit_code") == 0 and obs["input_bytes"] > 0 and obs["cpu"]:
+            by_stage.setdefault(obs["stage"], []).append(obs)
+
+    for stage, stage_obs in by_stage.items():
+        if stage not in model:
+            continue
+        params = model[stage]
+
+        throughputs = sorted(
+            obs["input_bytes"] / (obs["wall_seconds"] * obs["cpu"])
+            for obs in stage_obs
+            if obs["wall_seconds"] > 0
+        )
+        if throughputs:
+            params["cpu_bytes_per_second"] = throughputs[len(throughputs) // 2]
+
+        # A ratio per observation would blow small inputs up to the whole base
+        # memory per GB, so intercept and slope are fitted together
+        points = [
+            (
+                obs["input_bytes"] / 1024**3,
+                obs["peak_rss_kb"] / 1024
+                - params["index_memory_factor"] * obs.get("index_bytes", 0) / 1024**2,
+            )
+            for obs in stage_obs
+        ]
+        if len({gb for gb, _ in points}) > 1:
+            params["base_memory_mb"], params["memory_mb_per_gb"] = fit_memory(points)
+
+        print(
+            f"resources: {stage}: calibrated from {len(stage_obs)} observations: {params}"
+        )
+
+    return model
+
+
+def save_model(model: Dict, path: str = MODEL_PATH) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(model, f, indent=2)
+    os.replace(tmp_path, path)
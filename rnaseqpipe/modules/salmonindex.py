@@ -0,0 +1,180 @@
+"""
+Layout and preparation of the salmon indices on the volume.
+
+Every assembly has a directory {SALMON_INDEX_ROOT}/{assembly}/ with
+- decoy/: the gentrome (the transcripts followed by the genome) and the names of
+  the genome sequences, which salmon uses as decoys, see prepare_decoys
+- index-{version}/: a salmon index, named by the key of its build (salmon version,
+  parameters and the checksums of the gentrome and decoys)
+- CURRENT: the name of the index the pipeline uses
+
+A new index is built next to the current one and published by rewriting CURRENT,
+so running pipelines keep reading the index they resolved. Assemblies indexed
+before indices were versioned only have transcripts_index/, which is used while
+there is no CURRENT.
+
+    index = index_dir("R64-1-1")  # -> /data/salmon_index/R64-1-1/index-1a2b3c4d5e6f
+"""
+
+import gzip
+import os
+import re
+import shutil
+from typing import List, Tuple
+
+from rnaseqpipe.modules.stagecache import StageCache
+
+SALMON_INDEX_ROOT = "/data/salmon_index"
+LEGACY_INDEX = "transcripts_index"
+DECOY_VERSION = "gentrome-v2"
+READ_BLOCK_SIZE = 16 * 1024 * 1024  # 16 MiB
+
+# Genome and transcriptome FASTA per assembly, as in config.reference_img
+SOURCES = {
+    "R64-1-1": (
+        "/R64-1-1.fa.gz",
+        "/Saccharomyces_cerevisiae.R64-1-1.cdna.all.fa.gz",
+    ),
+}
+
+_HEADER = re.compile(rb"^>(\S+)", re.MULTILINE)
+
+
+def assembly_dir(assembly_name: str, root: str = SALMON_INDEX_ROOT) -> str:
+    return os.path.join(root, assembly_name)
+
+
+def decoy_dir(assembly_name: str, root: str = SALMON_INDEX_ROOT) -> str:
+    return os.path.join(root, assembly_name, "decoy")
+
+
+def index_dir(assembly_name: str, root: str = SALMON_INDEX_ROOT) -> str:
+    """Returns the salmon index of an assembly the pipeline uses."""
+    current = os.path.join(assembly_dir(assembly_name, root), "CURRENT")
+    if os.path.exists(current):
+        with open(current) as f:
+            return os.path.join(assembly_dir(assembly_name, root), f.read().strip())
+    return os.path.join(assembly_dir(assembly_name, root), LEGACY_INDEX)
+
+
+def publish_index(assembly_name: str, name: str, root: str = SALMON_INDEX_ROOT):
+    """Makes the index {assembly}/{name} the one the pipeline uses."""
+    current = os.path.join(assembly_dir(assembly_name, root), "CURRENT")
+    with open(f"{current}.tmp", "w") as f:
+        f.write(f"{name}\n")
+    os.replace(f"{current}.tmp", current)
+
+
+def _open(path: str):
+    return gzip.open(path, "rb") if str(path).endswith(".gz") else open(path, "rb")
+
+
+def fetch(source: str, directory: str) -> str:
+    """Returns a local path of a FASTA, downloading URLs into directory once."""
+    import urllib.request
+
+    if not re.match(r"https?://", source):
+        return source
+
+    path = os.path.join(directory, os.path.basename(source))
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        print(f"salmonindex: Downloading {source}...")
+        with urllib.request.urlopen(source) as response, open(
+            f"{path}.part", "wb"
+        ) as f:
+            shutil.copyfileobj(response, f, READ_BLOCK_SIZE)
+        os.replace(f"{path}.part", path)
+    return path
+
+
+def decoy_names(genome: str, output: str) -> int:
+    """Writes the names of the sequences of a (gzipped) FASTA, one per line.
+
+    The FASTA is read in blocks in a single pass, only the header lines are kept.
+
+    Returns:
+        int: number of sequences
+    """
+    count = 0
+    tail = b""
+    with _open(genome) as f, open(f"{output}.tmp", "wb") as out:
+        for block in iter(lambda: f.read(READ_BLOCK_SIZE), b""):
+            block = tail + block
+            # A header may continue in the next block, keep the partial last line
+            end = block.rfind(b"\n") + 1
+            names = _HEADER.findall(block, 0, end)
+            out.writelines(name + b"\n" for name in names)
+            count += len(names)
+            tail = block[end:]
+        names = _HEADER.findall(tail)
+        out.writelines(name + b"\n" for name in names)
+        count += len(names)
+    os.replace(f"{output}.tmp", output)
+    return count
+
+
+def concatenate(paths: List[str], output: str) -> None:
+    """Concatenates files, e.g. gzipped FASTA into one gzipped FASTA."""
+    with open(f"{output}.tmp", "wb") as out:
+        for path in paths:
+            with open(path, "rb") as f:
+                shutil.copyfileobj(f, out, READ_BLOCK_SIZE)
+    os.replace(f"{output}.tmp", output)
+
+
+def prepare_decoys(
+    assembly_name: str,
+    genome: str = None,
+    transcriptome: str = None,
+    root: str = SALMON_INDEX_ROOT,
+    force_recompute: bool = False,
+) -> Tuple[str, str]:
+    """Writes the gentrome and decoy names of an assembly, unless they are up to date.
+
+    Follows https://combine-lab.github.io/alevin-tutorial/2019/selective-alignment/.
+    The step is skipped if the genome and transcriptome have the same checksums as
+    for the existing files.
+
+    Args:
+        assembly_name (str): assembly, e.g. "R64-1-1"
+        genome, transcriptome (str): gzipped FASTA paths or URLs, SOURCES by default
+
+    Returns:
+        Tuple[str, str]: paths of gentrome.fa.gz and decoys.txt
+    """
+    if genome is None or transcriptome is None:
+        if assembly_name not in SOURCES:
+            raise ValueError(
+                f"salmonindex: No genome and transcriptome for {assembly_name}"
+            )
+        genome = genome or SOURCES[assembly_name][0]
+        transcriptome = transcriptome or SOURCES[assembly_name][1]
+
+    sources = os.path.join(assembly_dir(assembly_name, root), "sources")
+    genome, transcriptome = fetch(genome, sources), fetch(transcriptome, sources)
+
+    output_dir = decoy_dir(assembly_name, root)
+    gentrome = os.path.join(output_dir, "gentrome.fa.gz")
+    decoys = os.path.join(output_dir, "decoys.txt")
+
+    cache = StageCache(
+        os.path.join(assembly_dir(assembly_name, root), ".stagecache"),
+        "decoys",
+        DECOY_VERSION,
+        f"cat {os.path.basename(transcriptome)} {os.path.basename(genome)}",
+        [genome, transcriptome],
+    )
+    if cache.hit() and not force_recompute:
+        print(f"{assembly_name}:decoys: Gentrome is up to date! Skipping.")
+        return gentrome, decoys
+
+    cache.invalidate()
+    os.makedirs(output_dir, exist_ok=True)
+
+    count = decoy_names(genome, decoys)
+    concatenate([transcriptome, genome], gentrome)
+    print(f"{assembly_name}:decoys: {count} decoy sequences, gentrome in {output_dir}")
+
+    cache.record([gentrome, decoys])
+    return gentrome, decoys
@@ -0,0 +1,312 @@
+"""
+Transcript quantification with salmon's selective alignment against the decoy-aware
+index built by scripts/make_salmon_index.py.
+
+SalmonQuant runs on the trimmed reads in parallel with STAR. Its containers copy the
+index of an assembly to local disk on first use and keep it (and the page cache)
+warm for the following samples. quant.sf and salmon's reports are written to
+/data/{plid}/salmon/, merge_salmon_quant combines the samples of a batch into TPM
+and counts tables, see modules/counts.py.
+
+Run this on modal with: modal run rnaseqpipe/modules/salmonquant.py
+"""
+
+from modal import App, enter, method
+from typing import List, Tuple
+
+from rnaseqpipe.config import vol, salmon_image
+from rnaseqpipe.modules.utils import PLID
+from rnaseqpipe.modules.stagecache import StageCache, cache_dir
+from rnaseqpipe.modules.metrics import run_stage, measure
+from rnaseqpipe.modules.volsession import VolumeSession
+from rnaseqpipe.modules.scratch import Scratch
+from rnaseqpipe.modules.batching import (
+    batch_dir,
+    batch_id as make_batch_id,
+    run_per_sample,
+)
+from rnaseqpipe.modules.counts import merge_quant, quant_sf_path, save_parquet
+from rnaseqpipe.modules.salmonindex import index_dir
+
+app = App("rnaseq-salmon")
+
+image = salmon_image.pip_install("numpy", "pyarrow")
+
+CPUS = 8.0
+MEMORY = 16 * 1024  # 16 GB
+TOOL_VERSION = "salmon-1.10.0"
+SALMON_BIN = "/salmon-latest_linux_x86_64/bin/salmon"
+LOCAL_INDEX_DIR = "/tmp/salmon_index"
+
+# Salmon outputs that are copied to the volume
+SALMON_OUTPUTS = [
+    "quant.sf",
+    "lib_format_counts.json",
+    "cmd_info.json",
+    "aux_info/meta_info.json",
+    "logs/salmon_quant.log",
+]
+
+
+@app.cls(
+    image=image,
+    volumes={"/data": vol},
+    timeout=60 * 100,
+    cpu=CPUS,
+    memory=MEMORY,
+    # Keep containers (and their local index copies) around between calls
+    container_idle_timeout=60 * 5,
+)
+class SalmonQuant:
+
+    @enter()
+    def enter(self):
+        # Local copy of each index, made on first use
+        self.local_indices = {}
+
+    def _local_index(self, assembly_name: str, source: str) -> str:
+        """Returns a copy of the assembly's index source on local disk.
+
+        Salmon reads the whole index on every run, from local disk (or the page
+        cache) that is much faster than from the volume. A newly published index of
+        the assembly is copied again. Falls back to the index on the volume if it
+        cannot be copied.
+        """
+        import os
+        import shutil
+        import time
+
+        if source in self.local_indices:
+            return self.local_indices[source]
+
+        target = os.path.join(LOCAL_INDEX_DIR, assembly_name, os.path.basename(source))
+        start = time.time()
+        try:
+            shutil.rmtree(target, ignore_errors=True)
+            shutil.copytree(source, f"{target}.copying")
+            os.replace(f"{target}.copying", target)
+            print(
+                f"SalmonQuant: Copied {source} to local disk in {time.time() - start:.1f}s"
+            )
+        except OSError as e:
+            print(f"SalmonQuant: Could not copy {source}, using the volume: {e}")
+            shutil.rmtree(f"{target}.copying", ignore_errors=True)
+            target = source
+
+        self.local_indices[source] = target
+        return target
+
+    def _salmon_cmd(self, read_files: List[str], index: str, out_dir: str) -> str:
+        if len(read_files) == 2:
+            reads = f"-1 {read_files[0]} -2 {read_files[1]}"
+        else:
+            reads = f"-r {read_files[0]}"
+
+        return f"""{SALMON_BIN} quant \
+            -i {index} \
+            --libType A \
+            {reads} \
+            --validateMappings \
+            -o {out_dir}
+            """
+
+    @method()
+    def quant(
+        self,
+        plid: PLID,
+        read_files: List[str],
+        assembly_name: str = "R64-1-1",
+        force_recompute: bool = False,
+        cpu: float = CPUS,
+        memory: int = MEMORY,
+        scratch: bool = True,
+    ):
+        """Quantify the transcripts of a sample with salmon.
+
+        Args:
+            plid (PLID): pipeline ID
+            read_files (List[str]): 1 or 2 (paired) (trimmed) read files
+            assembly_name (str): assembly of the salmon index
+            cpu (float), memory (int): resources of the container (see
+                resources.plan_resources and SalmonQuant.with_options)
+            scratch (bool): run salmon on local disk and only copy SALMON_OUTPUTS to
+                the volume
+        """
+        session = VolumeSession(vol, plid, "salmon_quant")
+        session.reload()
+
+        result = self._quant(
+            plid, read_files, assembly_name, force_recompute, cpu, memory, scratch
+        )
+
+        session.commit()
+        return result
+
+    @method()
+    def quant_many(
+        self,
+        samples: List[Tuple[PLID, List[str]]],
+        assembly_name: str = "R64-1-1",
+        force_recompute: bool = False,
+        cpu: float = CPUS,
+        memory: int = MEMORY,
+        scratch: bool = True,
+    ):
+        """Quantify several samples back to back against the warm index.
+
+        Args:
+            samples (List[Tuple[PLID, List[str]]]): (plid, read_files) per sample
+
+        Returns:
+            Dict[str, Union[bool, str]]: True per successful plid, the error otherwise
+        """
+        # One reload and commit for the batch instead of one per sample
+        session = VolumeSession(vol, stage="quant_many")
+        session.reload()
+
+        results = run_per_sample(
+            "salmon_quant",
+            samples,
+            lambda plid, read_files: self._quant(
+                plid, read_files, assembly_name, force_recompute, cpu, memory, scratch
+            ),
+        )
+
+        session.commit()
+        return results
+
+    def _quant(
+        self,
+        plid: PLID,
+        read_files: List[str],
+        assembly_name: str,
+        force_recompute: bool,
+        cpu: float,
+        memory: int,
+        scratch: bool,
+    ):
+        """Quantifies the reads, the caller reloads and commits the volume."""
+        assert len(read_files) in (1, 2), "Only 1 or 2 read files supported."
+
+        result_path = f"/data/{plid}/salmon/"
+        index = index_dir(assembly_name)
+
+        # The key is built with the index and result path on the volume
+        cache = StageCache(
+            cache_dir(plid),
+            "salmon_quant",
+            TOOL_VERSION,
+            self._salmon_cmd(read_files, index, result_path),
+            read_files + [f"{index}/versionInfo.json"],
+        )
+        if cache.hit() and not force_recompute:
+            print(f"{plid}:salmon_quant: Quantification already exists! Skipping.")
+            return True
+
+        cache.invalidate()
+
+        local_index = self._local_index(assembly_name, index)
+        with Scratch(plid, "salmon", result_path, enabled=scratch) as work_dir:
+            cmd = self._salmon_cmd(read_files, local_index, work_dir.path)
+            print(cmd)
+
+            record = run_stage(
+                plid,
+                "salmon_quant",
+                f"{cmd.rstrip()} --threads {int(cpu)}",
+                inputs=read_files,
+                outputs=[work_dir.path],
+                cpu=cpu,
+                memory=memory,
+                check=False,
+            )
+            if record["exit_code"] != 0:
+                raise Exception(
+                    f"{plid}:salmon_quant: salmon failed with {record['exit_code']}"
+                )
+
+            outputs = work_dir.publish(SALMON_OUTPUTS)
+
+        cache.record(outputs)
+
+        print(f"{plid}:salmon_quant: Succeeded!")
+        return True
+
+
+@app.function(image=image, volumes={"/data": vol}, timeout=60 * 30)
+def merge_salmon_quant(
+    plids: List[str], batch_id: str = None, force_recompute: bool = False
+):
+    """Merge the salmon quantifications of the samples of a batch.
+
+    The tables are written to /data/batches/{batch_id}/salmon_tpm.parquet and
+    salmon_counts.parquet.
+
+    Returns:
+        Dict[str, Union[bool, str]]: True per plid in the tables, the error otherwise
+    """
+    import os
+
+    batch_id = batch_id or make_batch_id(plids)
+    metrics_id = os.path.join("batches", batch_id)
+    session = VolumeSession(vol, metrics_id, "salmon_merge")
+    session.reload()
+
+    output_dir = batch_dir(batch_id)
+    outputs = {
+        "tpm": os.path.join(output_dir, "salmon_tpm.parquet"),
+        "counts": os.path.join(output_dir, "salmon_counts.parquet"),
+    }
+
+    samples = {
+        plid: quant_sf_path(plid)
+        for plid in plids
+        if os.path.exists(quant_sf_path(plid))
+    }
+    results = {plid: True if plid in samples else "no quant.sf" for plid in plids}
+    if not samples:
+        print(f"{batch_id}:salmon_merge: No salmon quantifications.")
+        return results
+
+    cache = StageCache(
+        os.path.join(output_dir, ".stagecache"),
+        "salmon_merge",
+        TOOL_VERSION,
+        "merge_quant",
+        list(samples.values()),
+    )
+    if cache.hit() and not force_recompute:
+        print(f"{batch_id}:salmon_merge: Tables are up to date! Skipping.")
+        return results
+
+    cache.invalidate()
+
+    with measure(metrics_id, "salmon_merge") as record:
+        tables = merge_quant(samples)
+        for name, table in tables.items():
+            save_parquet(table, outputs[name])
+        record["input_bytes"] = sum(os.path.getsize(p) for p in samples.values())
+        record["output_bytes"] = sum(os.path.getsize(p) for p in outputs.values())
+
+    print(
+        f"{batch_id}:salmon_merge: {tables['tpm'].num_rows} transcripts x "
+        f"{len(samples)} samples -> {output_dir}"
+    )
+
+    cache.record(list(outputs.values()))
+    session.commit()
+
+    return results
+
+
+@app.local_entrypoint()
+def run():
+    plid = PLID("pl-SRR6059709")
+
+    SalmonQuant().quant.remote(
+        plid,
+        [
+            f"/data/{plid}/trimgalore/SRR6059709_1_val_1.fq.gz",
+            f"/data/{plid}/trimgalore/SRR6059709_2_val_2.fq.gz",
+        ],
+    )
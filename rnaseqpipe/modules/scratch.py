@@ -0,0 +1,94 @@
+"""
+Per-stage scratch directories on the container's local disk.
+
+Tools write their output, and temporary files such as STAR's BAM sort buckets, to a
+scratch directory under /tmp, which is on the container's local SSD rather than the
+networked volume. Once the tool has finished, only the declared outputs are copied
+to the result directory on the volume. Every file is first copied to a hidden
+temporary name and then renamed, so readers never see partially written files, and
+the stage cache manifest is only recorded after all of them are published.
+
+    with Scratch(plid, "staralign", f"/data/{plid}/staralign/") as scratch:
+        run(f"STAR ... --outFileNamePrefix {scratch.path}/")
+        outputs = scratch.publish(["Aligned.sortedByCoord.out.bam", "Signal.*.bw"])
+
+With enabled=False the tool writes straight to the result directory, as before.
+"""
+
+import glob
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+SCRATCH_ROOT = "/tmp/scratch"
+PUBLISH_WORKERS = 4
+
+
+class Scratch:
+    def __init__(
+        self,
+        plid: str,
+        stage: str,
+        publish_dir: str,
+        enabled: bool = True,
+        root: str = SCRATCH_ROOT,
+    ) -> None:
+        self.publish_dir = publish_dir.rstrip("/")
+        self.enabled = enabled
+        self.path = (
+            os.path.join(root, str(plid), stage) if enabled else self.publish_dir
+        )
+
+    def __enter__(self) -> "Scratch":
+        # Leftovers of an earlier call in the same container, e.g. STAR's _STARtmp,
+        # would make the tools fail
+        self.cleanup()
+        os.makedirs(self.path, exist_ok=True)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        self.cleanup()
+        return False
+
+    def cleanup(self) -> None:
+        if self.enabled:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    def _publish_file(self, src: str) -> str:
+        dest = os.path.join(self.publish_dir, os.path.relpath(src, self.path))
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp_path = os.path.join(
+            os.path.dirname(dest), f".{os.path.basename(dest)}.publishing"
+        )
+        shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, dest)
+        return dest
+
+    def publish(self, patterns: List[str]) -> List[str]:
+        """Copies the outputs matching patterns (relative to the scratch directory)
+        to the result directory.
+
+        Returns:
+            List[str]: paths of the published files on the volume
+        """
+        files = sorted(
+            {
+                path
+                for pattern in patterns
+                for path in glob.glob(os.path.join(self.path, pattern))
+                if os.path.isfile(path)
+            }
+        )
+        if not self.enabled:
+            return files
+
+        os.makedirs(self.publish_dir, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=PUBLISH_WORKERS) as executor:
+            published = list(executor.map(self._publish_file, files))
+
+        print(
+            f"scratch: Published {len(published)} files "
+            f"({sum(os.path.getsize(p) for p in published) / 1e6:.1f} MB) to {self.publish_dir}"
+        )
+        return published
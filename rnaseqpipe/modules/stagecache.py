@@ -0,0 +1,168 @@
+"""
+Content-addressed cache for pipeline stages.
+
+A stage's cache key is the hash of its name, the tool version, the (normalized)
+command line and the SHA-256 digest of every input file. When a stage finishes
+successfully it writes a manifest to /data/{plid}/.stagecache/{stage}.json with that
+key and the size of each output. A later run only skips the stage if the key is
+identical and all recorded outputs are still present with the recorded size, so
+half-written or stale outputs and changed parameters are never treated as cache hits.
+
+Hashing multi-GB inputs is expensive, so the manifest also stores the size and mtime
+of each input alongside its digest and the digest is only recomputed if those changed.
+"""
+
+import hashlib
+import json
+import os
+from typing import Dict, List
+
+HASH_BLOCK_SIZE = 4 * 1024 * 1024  # 4 MiB
+
+
+def file_digest(path: str) -> str:
+    """Returns the SHA-256 hex digest of a file, read in blocks."""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def cache_dir(plid: str, root: str = "/data") -> str:
+    """Returns the directory holding the stage manifests of a pipeline run."""
+    return os.path.join(root, str(plid), ".stagecache")
+
+
+def _expand(paths: List[str]) -> List[str]:
+    """Expands directories into the files they contain (recursively)."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in names)
+        else:
+            files.append(path)
+    return sorted(files)
+
+
+class StageCache:
+    """Cache manifest for a single stage of a single pipeline run.
+
+    Usage:
+        cache = StageCache(cache_dir(plid), "fastqc", TOOL_VERSION, cmd, read_files)
+        if cache.hit() and not force_recompute:
+            return True
+        cache.invalidate()
+        ... run the stage ...
+        cache.record([result_path])
+    """
+
+    def __init__(
+        self,
+        manifest_dir: str,
+        stage: str,
+        tool_version: str,
+        command: str,
+        inputs: List[str],
+    ) -> None:
+        self.stage = stage
+        self.tool_version = tool_version
+        # Whitespace in (multi-line) shell commands must not change the key
+        self.command = " ".join(command.split())
+        self.inputs = sorted(map(str, inputs))
+        self.manifest_path = os.path.join(manifest_dir, f"{stage}.json")
+        self._input_stats = None
+
+    def _load_manifest(self) -> Dict:
+        if not os.path.exists(self.manifest_path):
+            return None
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def _stat_inputs(self, previous: Dict) -> Dict:
+        """Returns size, mtime and digest of every input, reusing previous digests."""
+        previous = previous or {}
+        stats = {}
+        for path in self.inputs:
+            st = os.stat(path)
+            old = previous.get(path)
+            if old and old["size"] == st.st_size and old["mtime_ns"] == st.st_mtime_ns:
+                digest = old["sha256"]
+            else:
+                digest = file_digest(path)
+            stats[path] = {
+                "size": st.st_size,
+                "mtime_ns": st.st_mtime_ns,
+                "sha256": digest,
+            }
+        return stats
+
+    def key(self, input_stats: Dict) -> str:
+        sha = hashlib.sha256()
+        sha.update(self.stage.encode())
+        sha.update(b"\0" + self.tool_version.encode())
+        sha.update(b"\0" + self.command.encode())
+        for path in self.inputs:
+            sha.update(b"\0" + input_stats[path]["sha256"].encode())
+        return sha.hexdigest()
+
+    def current_key(self) -> str:
+        """Returns the key for the current inputs, e.g. to name the outputs by it."""
+        if self._input_stats is None:
+            manifest = self._load_manifest() or {}
+            self._input_stats = self._stat_inputs(manifest.get("inputs"))
+        return self.key(self._input_stats)
+
+    def hit(self) -> bool:
+        """Returns True if the stage already ran with identical inputs, tool and command."""
+        manifest = self._load_manifest()
+        if manifest is None:
+            return False
+
+        self._input_stats = self._stat_inputs(manifest.get("inputs"))
+        if manifest.get("key") != self.key(self._input_stats):
+            print(f"stagecache: {self.stage} inputs or parameters changed.")
+            return False
+
+        for path, size in manifest["outputs"].items():
+            if not os.path.exists(path) or os.path.getsize(path) != size:
+                print(f"stagecache: {self.stage} output {path} is stale.")
+                return False
+
+        print(f"stagecache: {self.stage} is up to date.")
+        return True
+
+    def invalidate(self) -> None:
+        """Removes the manifest, e.g. before a stage starts overwriting its outputs."""
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+
+    def record(self, outputs: List[str]) -> None:
+        """Atomically writes the manifest for a successfully completed stage.
+
+        Args:
+            outputs (List[str]): output files or directories of the stage
+        """
+        if self._input_stats is None:
+            self._input_stats = self._stat_inputs(None)
+
+        manifest = {
+            "stage": self.stage,
+            "tool_version": self.tool_version,
+            "command": self.command,
+            "key": self.key(self._input_stats),
+            "inputs": self._input_stats,
+            "outputs": {path: os.path.getsize(path) for path in _expand(outputs)},
+        }
+
+        os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.manifest_path)
@@ -1,72 +1,209 @@
-from modal import App, Secret, Image, build, enter, method
-from typing import List
-
-from rnaseqpipe.modules.utils import PLID
-from rnaseqpipe.config import vol
+from modal import App, Image, enter, exit, method
+from typing import List, Tuple
+
+from rnaseqpipe.modules.utils import PLID, trimmed_read_files
+from rnaseqpipe.config import vol, star_img, trimgalore_img
+from rnaseqpipe.modules.genomes import DEFAULT_ASSEMBLY, genome_dir, read_chrom_sizes
+from rnaseqpipe.modules.bigwig import (
+    STAR_SIGNAL_TRACKS,
+    convert_star_signal,
+    signal_paths,
+)
+from rnaseqpipe.modules.stagecache import StageCache, cache_dir
+from rnaseqpipe.modules.metrics import run_stage, measure
+from rnaseqpipe.modules.volsession import VolumeSession
+from rnaseqpipe.modules.scratch import Scratch
+from rnaseqpipe.modules.batching import run_per_sample
 
 app = App("rnaseq-staralign")
+# Trim Galore is included for the fused trim_and_align mode
+# pyBigWig converts the signal tracks, it needs NumPy installed before it is built
 aligner_img = (
-    Image.debian_slim()
-    .pip_install("azure-storage-blob")
-    .apt_install("wget")
-    .run_commands(
-        "wget https://github.com/alexdobin/STAR/archive/2.7.11b.tar.gz",
-        "tar -xzf 2.7.11b.tar.gz",
-        "cd STAR-2.7.11b",
-    )
+    star_img(trimgalore_img(Image.debian_slim()))
     .run_commands("ls STAR-2.7.11b/bin")
     .apt_install("tree")
+    .pip_install("numpy")
+    .pip_install("pyBigWig==0.3.22")
 )
 
 CPUs = 32.0
+MEMORY = 20 * 1024  # 20 GB
+TOOL_VERSION = "STAR-2.7.11b"
+TRIMGALORE_VERSION = "TrimGalore-0.6.10"
+SIGNAL_VERSION = "pyBigWig-0.3.22+bigwig-2"
+
+STAR_BIN = "/STAR-2.7.11b/bin/Linux_x86_64_static/STAR"
+TRIMGALORE_BIN = "/TrimGalore-0.6.10/trim_galore"
+
+# Genome index files that are read into memory by STAR
+GENOME_IDX_FILES = ["Genome", "SA", "SAindex"]
+
+# Files of the output prefix that are copied to the volume, the BAM sort buckets in
+# _STARtmp and the wiggle tracks (converted to bigWig) stay on local disk
+STAR_OUTPUTS = [
+    "Aligned.sortedByCoord.out.bam",
+    "Log.final.out",
+    "Log.out",
+    "Log.progress.out",
+    "SJ.out.tab",
+    "Signal.*.bw",
+    "ReadsPerGene.out.tab",
+]
 
 
 @app.cls(
     image=aligner_img,
     volumes={"/data": vol},
-    secrets=[Secret.from_name("azure-connect-str")],
     timeout=60 * 1000,
     cpu=CPUs,
-    memory=20 * 1024,  # 20 GB
-    container_idle_timeout=5,
+    memory=MEMORY,
+    # Keep containers (and the genome loaded in their shared memory) around between calls
+    container_idle_timeout=60 * 5,
 )
 class STARAlign:
 
-    @build()
-    def build(self):
-        # Download genome index from azure
+    @enter()
+    def enter(self):
+        # Genome index loaded by this container, see _load_genome
+        self.genome = None
+        self.genome_load = None
+        self.index_bytes = 0
+
+    def _load_genome(self, genome: str):
+        """Load a genome index once per container.
+
+        The index is loaded into shared memory with --genomeLoad LoadAndExit, so that
+        every subsequent align call attaches to it with LoadAndKeep instead of reading
+        it from the volume. If shared memory is not available, the index files are read
+        once to warm the page cache and STAR falls back to NoSharedMemory. A call for
+        another index (assembly or version) replaces the loaded one.
+        """
+        import os
+        import subprocess
+        import time
+
+        if genome == self.genome:
+            return
+
+        self._remove_genome()
+
+        start = time.time()
+        load_dir = "/tmp/genome-load/"
+
+        self.index_bytes = sum(
+            os.path.getsize(os.path.join(genome, name))
+            for name in GENOME_IDX_FILES
+            if os.path.exists(os.path.join(genome, name))
+        )
+
+        result = subprocess.run(
+            f"{STAR_BIN} --genomeLoad LoadAndExit --genomeDir {genome} --outFileNamePrefix {load_dir}",
+            shell=True,
+            capture_output=True,
+        )
+
+        if result.returncode == 0:
+            self.genome_load = "LoadAndKeep"
+        else:
+            print(
+                f"STARAlign: Could not load genome into shared memory, warming page cache instead: {result.stderr}"
+            )
+            self._warm_page_cache(genome)
+            self.genome_load = "NoSharedMemory"
+
+        self.genome = genome
+        print(
+            f"STARAlign: Genome index {genome} ready ({self.genome_load}) after {time.time() - start:.1f}s"
+        )
+
+    def _remove_genome(self):
+        import subprocess
+
+        if self.genome_load == "LoadAndKeep":
+            subprocess.run(
+                f"{STAR_BIN} --genomeLoad Remove --genomeDir {self.genome} --outFileNamePrefix /tmp/genome-load/",
+                shell=True,
+                capture_output=True,
+            )
+        self.genome = None
+        self.genome_load = None
+
+    @exit()
+    def exit(self):
+        self._remove_genome()
+
+    def _warm_page_cache(self, genome: str):
         import os
-        from azure.storage.blob import BlobServiceClient
 
-        connect_str = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
+        for name in GENOME_IDX_FILES:
+            path = os.path.join(genome, name)
+            if not os.path.exists(path):
+                continue
+            with open(path, "rb") as f:
+                while f.read(64 * 1024 * 1024):
+                    pass
 
-        # Get the client for the container
-        blob_service_client = BlobServiceClient.from_connection_string(connect_str)
+    def _runtime_args(self, cpu: float, memory: int) -> str:
+        """STAR arguments that depend on the container, not on the result.
 
-        # Download the genome index
-        container_name = "pipeline"
+        They are appended to the command built by _star_cmd when running it, so that
+        the cache key does not depend on container size or how the genome was loaded.
+        """
+        threads = str(cpu).split(".")[0]
 
-        # Get the client for the container
-        container_client = blob_service_client.get_container_client(container_name)
+        # Sorting may use what is left after the genome, with some headroom
+        available = memory * 1024**2 - self.index_bytes
+        bam_sort_ram = int(max(available, 2 * 1024**3) * 0.75)
 
-        blob_client = container_client.get_blob_client("genome-index.zip")
+        return f"--runThreadN {threads} --limitBAMsortRAM {bam_sort_ram} --genomeLoad {self.genome_load}"
 
-        with open("genome-index.zip", "wb") as f:
-            f.write(blob_client.download_blob().readall())
+    def _signal_to_bigwig(self, plid: PLID, star_dir: str, genome: str):
+        """Converts STAR's wiggle tracks in star_dir to bigWig and removes the wigs."""
+        import os
 
-        # Unzip the genome index
-        import zipfile
+        wigs = [signal_paths(star_dir, track)[0] for track in STAR_SIGNAL_TRACKS]
+        with measure(plid, "bigwig") as record:
+            record["input_bytes"] = sum(os.path.getsize(wig) for wig in wigs)
+            bigwigs = convert_star_signal(
+                star_dir, read_chrom_sizes(os.path.join(genome, "chrNameLength.txt"))
+            )
+            record["output_bytes"] = sum(os.path.getsize(bw) for bw in bigwigs.values())
 
-        with zipfile.ZipFile("genome-index.zip", "r") as zip_ref:
-            zip_ref.extractall("/data/genome-index")
+        for wig in wigs:
+            os.remove(wig)
 
-        vol.commit()
+    def _star_cmd(self, read_files: List[str], result_path: str, genome: str) -> str:
+        import os
 
-        pass
+        # Construct the basic command for STAR alignment
+        if len(read_files) == 2:  # Paired-end reads
+            read_files_cmd = f"{read_files[0]} {read_files[1]}"
+        else:  # Single-end reads
+            read_files_cmd = f"{read_files[0]}"
 
-    @enter()
-    def enter(self):
-        pass
+        # Gzipped reads are decompressed on the fly instead of landing on disk
+        read_files_command = (
+            "--readFilesCommand pigz -dc"
+            if all(str(f).endswith(".gz") for f in read_files)
+            else ""
+        )
+
+        # Reads per gene are counted while aligning if the index has annotations
+        quant_mode = (
+            "--quantMode GeneCounts"
+            if os.path.exists(os.path.join(genome, "geneInfo.tab"))
+            else ""
+        )
+
+        return f"""{STAR_BIN} \
+            --genomeDir {genome} \
+            --readFilesIn {read_files_cmd} \
+            {read_files_command} \
+            {quant_mode} \
+            --outWigType wiggle \
+            --outSAMtype BAM SortedByCoordinate \
+            --outFileNamePrefix {result_path}
+            """
 
     @method()
     def align(
@@ -74,54 +211,254 @@ class STARAlign:
         plid: PLID,
         read_files: List[str],
         force_recompute: bool = False,
+        cpu: float = CPUs,
+        memory: int = MEMORY,
+        scratch: bool = True,
+        assembly_name: str = DEFAULT_ASSEMBLY,
+    ):
+        """Align reads to the genome.
+
+        Args:
+            plid (PLID): pipeline ID
+            read_files (List[str]): 1 or 2 (paired) read files, optionally gzipped
+            cpu (float), memory (int): resources of the container (see
+                resources.plan_resources and STARAlign.with_options)
+            scratch (bool): align on local disk, including the temporary files of
+                the BAM sort, and only copy STAR_OUTPUTS to the volume at the end
+            assembly_name (str): assembly to align to, see genomes.genome_dir
+        """
+        # Warm containers must see the trimmed reads written by other containers
+        session = VolumeSession(vol, plid, "staralign")
+        session.reload()
+
+        result = self._align(
+            plid, read_files, force_recompute, cpu, memory, scratch, assembly_name
+        )
+
+        session.commit()
+        return result
+
+    @method()
+    def align_many(
+        self,
+        samples: List[Tuple[PLID, List[str]]],
+        force_recompute: bool = False,
+        cpu: float = CPUs,
+        memory: int = MEMORY,
+        scratch: bool = True,
+        assembly_name: str = DEFAULT_ASSEMBLY,
+    ):
+        """Align several samples back to back against the warm genome index.
+
+        Args:
+            samples (List[Tuple[PLID, List[str]]]): (plid, read_files) per sample
+
+        Returns:
+            Dict[str, Union[bool, str]]: True per successful plid, the error otherwise
+        """
+        # One reload and commit for the batch instead of one per sample
+        session = VolumeSession(vol, stage="align_many")
+        session.reload()
+
+        results = run_per_sample(
+            "align_many",
+            samples,
+            lambda plid, read_files: self._align(
+                plid,
+                read_files,
+                force_recompute,
+                cpu,
+                memory,
+                scratch,
+                assembly_name,
+            ),
+        )
+
+        session.commit()
+        return results
+
+    def _align(
+        self,
+        plid: PLID,
+        read_files: List[str],
+        force_recompute: bool = False,
+        cpu: float = CPUs,
+        memory: int = MEMORY,
+        scratch: bool = True,
+        assembly_name: str = DEFAULT_ASSEMBLY,
     ):
-        import subprocess  # Ensure this import is added to the module where this class and method are defined.
+        """Aligns the reads, the caller reloads and commits the volume."""
         import os
 
         assert len(read_files) in (1, 2), "Only 1 or 2 read files supported."
 
         print("Aligning reads...")
-        threads = str(CPUs).split(".")[0]
-        genome_idx_dir = "/data/genome-index/genome-index"
         result_path = f"/data/{plid}/staralign/"
+        genome = genome_dir(assembly_name)
 
         os.makedirs(result_path, exist_ok=True)
 
-        if (
-            os.path.exists(f"{result_path}/Signal.Unique.str1.out.wig")
-            and os.path.exists(f"{result_path}/Signal.Unique.str2.out.wig")
-            and not force_recompute
-        ):
+        cmd = self._star_cmd(read_files, result_path, genome)
+
+        # genomeParameters.txt is rewritten whenever the index is regenerated
+        cache = StageCache(
+            cache_dir(plid),
+            "staralign",
+            f"{TOOL_VERSION}+{SIGNAL_VERSION}",
+            cmd,
+            read_files + [f"{genome}/genomeParameters.txt"],
+        )
+        if cache.hit() and not force_recompute:
             print(f"Alignment result already exists for {plid}. Skipping alignment.")
             return True
 
-        # Construct the basic command for STAR alignment
-        if len(read_files) == 2:  # Paired-end reads
-            read_files_cmd = f"{read_files[0]} {read_files[1]}"
-        else:  # Single-end reads
-            read_files_cmd = f"{read_files[0]}"
+        cache.invalidate()
+        self._load_genome(genome)
 
-        cmd = f"""/STAR-2.7.11b/bin/Linux_x86_64_static/STAR --runThreadN {str(threads)} \
-            --genomeDir {genome_idx_dir} \
-            --readFilesIn {read_files_cmd} \
-            --outWigType wiggle \
-            --outSAMtype BAM SortedByCoordinate \
-            --limitBAMsortRAM 20000000000 \
-            --outFileNamePrefix {result_path}
-            """
+        # The key is built with the result path, so it does not depend on scratch
+        with Scratch(plid, "staralign", result_path, enabled=scratch) as work_dir:
+            cmd = self._star_cmd(read_files, f"{work_dir.path}/", genome)
+            print(cmd)
 
-        print(cmd)
+            run_stage(
+                plid,
+                "staralign",
+                f"{cmd.rstrip()} {self._runtime_args(cpu, memory)}",
+                inputs=read_files,
+                outputs=[work_dir.path],
+                cpu=cpu,
+                memory=memory,
+                extra={
+                    "index_bytes": self.index_bytes,
+                    "genome_load": self.genome_load,
+                },
+            )
 
-        try:
-            # Execute the command using subprocess
-            result = subprocess.run(cmd, check=True, capture_output=True, shell=True)
+            self._signal_to_bigwig(plid, work_dir.path, genome)
+            outputs = work_dir.publish(STAR_OUTPUTS)
 
-            vol.commit()
+        cache.record(outputs)
+
+        print(f"{plid}: Alignment succeeded!")
+
+        return True
+
+    @method()
+    def trim_and_align(
+        self,
+        plid: PLID,
+        read_files: List[str],
+        force_recompute: bool = False,
+        cpu: float = CPUs,
+        memory: int = MEMORY,
+        scratch: bool = True,
+        assembly_name: str = DEFAULT_ASSEMBLY,
+    ):
+        """Trim the raw reads with Trim Galore and stream them into STAR.
+
+        Trim Galore writes its final output into named pipes that STAR reads from, so
+        the trimmed reads never land on the volume. STAR writes to local disk as well,
+        only STAR_OUTPUTS and the trimming reports are copied to the volume.
+        """
+        import subprocess
+        import os
+        import glob
+        import shutil
+        import signal
+        import tempfile
+        import time
+
+        assert len(read_files) in (1, 2), "Only 1 or 2 read files supported."
+
+        session = VolumeSession(vol, plid, "trim_and_align")
+        session.reload()
+
+        result_path = f"/data/{plid}/staralign/"
+        report_path = f"/data/{plid}/trimgalore/"
+        genome = genome_dir(assembly_name)
+        os.makedirs(result_path, exist_ok=True)
+        os.makedirs(report_path, exist_ok=True)
+
+        # Intermediate files of Trim Galore go to local disk
+        tmp_dir = tempfile.mkdtemp(prefix=f"{plid}-trim-")
+        fifos = trimmed_read_files(read_files, tmp_dir)
+
+        trimgalore_cmd = f"""{TRIMGALORE_BIN} {' '.join(map(str, read_files))} \
+            --cores {min(int(cpu), 8)} \
+            {"--paired" if len(read_files) == 2 else ''} \
+            -o {tmp_dir} \
+            --dont_gzip
+            """
+        star_cmd = self._star_cmd(fifos, result_path, genome)
+
+        cache = StageCache(
+            cache_dir(plid),
+            "trim_and_align",
+            f"{TRIMGALORE_VERSION}+{TOOL_VERSION}+{SIGNAL_VERSION}",
+            # The temporary directory must not change the key
+            f"{trimgalore_cmd} | {star_cmd}".replace(tmp_dir, "<tmp>"),
+            read_files + [f"{genome}/genomeParameters.txt"],
+        )
+        if cache.hit() and not force_recompute:
+            print(f"Alignment result already exists for {plid}. Skipping alignment.")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return True
 
-            print(f"Succeeded: {result.stdout}")
-        except subprocess.CalledProcessError as e:
-            print(f"Failed to align reads: {e.stderr}")
-            raise
+        cache.invalidate()
+        self._load_genome(genome)
+
+        for fifo in fifos:
+            os.mkfifo(fifo)
+
+        with measure(
+            plid, "trim_and_align", cpu=cpu, memory=memory, children=True
+        ) as record, Scratch(
+            plid, "trim_and_align", result_path, enabled=scratch
+        ) as work_dir:
+            # STAR writes to local disk, the key above is built with the result path
+            star_cmd = self._star_cmd(fifos, f"{work_dir.path}/", genome)
+            print(f"{plid}:trim_and_align: \n\t{trimgalore_cmd}\n\t{star_cmd}")
+
+            record["input_bytes"] = sum(os.path.getsize(f) for f in read_files)
+
+            # Own process groups, so that killing the shell also kills the tools
+            trim = subprocess.Popen(trimgalore_cmd, shell=True, start_new_session=True)
+            star = subprocess.Popen(
+                f"{star_cmd.rstrip()} {self._runtime_args(cpu, memory)}",
+                shell=True,
+                start_new_session=True,
+            )
+
+            def kill(process):
+                if process.poll() is None:
+                    os.killpg(process.pid, signal.SIGKILL)
+                    process.wait()
+
+            try:
+                # If either side dies, the other would block forever on its pipe
+                while trim.poll() is None or star.poll() is None:
+                    if trim.returncode not in (None, 0):
+                        kill(star)
+                    if star.returncode not in (None, 0):
+                        kill(trim)
+                    time.sleep(1)
+
+                if trim.returncode != 0:
+                    raise Exception(f"{plid}:trim_and_align: Trim Galore failed.")
+                if star.returncode != 0:
+                    raise Exception(f"{plid}:trim_and_align: STAR failed.")
+
+                self._signal_to_bigwig(plid, work_dir.path, genome)
+                outputs = work_dir.publish(STAR_OUTPUTS)
+                for report in glob.glob(f"{tmp_dir}/*_trimming_report.txt"):
+                    shutil.copy(report, report_path)
+            finally:
+                kill(trim)
+                kill(star)
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        cache.record(outputs)
+        session.commit()
 
         return True
 
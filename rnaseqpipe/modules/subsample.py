@@ -0,0 +1,172 @@
+"""
+Streaming subsampling of (paired, gzipped) FASTQ files.
+
+The mates of a paired sample are read in lockstep and checked to have the same read
+names, so the sample stays in sync. Two methods are supported:
+- "head": the first n records. Only as much of the files is decompressed as needed,
+  which is enough when the order of the reads carries no bias.
+- "reservoir": a uniform sample of n records from the whole files (Algorithm L),
+  reproducible through the seed. The sampled records keep their order in the input.
+
+The sample is kept in memory. Tools that need files get it through named pipes:
+
+    mates = subsample(read_files, 60000, "reservoir")
+    with FifoFeeder(mates, scratch_dir) as fifos:
+        subprocess.run(["salmon", "quant", "-1", fifos[0], "-2", fifos[1], ...])
+"""
+
+import gzip
+import math
+import os
+import random
+import threading
+from itertools import islice
+from typing import Iterable, List, Tuple
+
+HEAD = "head"
+RESERVOIR = "reservoir"
+
+
+def _open(path: str):
+    return gzip.open(path, "rb") if str(path).endswith(".gz") else open(path, "rb")
+
+
+def _read_name(header: bytes) -> bytes:
+    """Returns the read name without the mate suffix (/1, /2) and comment."""
+    name = header.split()[0] if header.strip() else b""
+    if name.endswith((b"/1", b"/2")):
+        name = name[:-2]
+    return name
+
+
+def iter_records(path: str) -> Iterable[bytes]:
+    """Yields the FASTQ records of a file, each as its 4 lines."""
+    with _open(path) as f:
+        while True:
+            lines = list(islice(f, 4))
+            if not lines:
+                return
+            if len(lines) < 4 or not lines[0].startswith(b"@"):
+                raise ValueError(f"subsample: Truncated or malformed record in {path}")
+            yield b"".join(lines)
+
+
+def iter_fragments(read_files: List[str]) -> Iterable[Tuple[bytes, ...]]:
+    """Yields the records of all mates of a fragment together.
+
+    Raises:
+        ValueError: if the mates have different read names or numbers of records
+    """
+    iterators = [iter_records(f) for f in read_files]
+    sentinel = object()
+    while True:
+        records = [next(it, sentinel) for it in iterators]
+        if all(r is sentinel for r in records):
+            return
+        if any(r is sentinel for r in records):
+            raise ValueError(
+                f"subsample: Mates have different numbers of records: {read_files}"
+            )
+        if len(records) > 1:
+            names = {_read_name(r.split(b"\n", 1)[0]) for r in records}
+            if len(names) > 1:
+                raise ValueError(f"subsample: Mates out of sync at {sorted(names)}")
+        yield tuple(records)
+
+
+def _reservoir(fragments: Iterable, n: int, seed: int) -> List:
+    """Uniform sample of n items in input order (Algorithm L)."""
+    if n <= 0:
+        return []
+
+    rng = random.Random(seed)
+    reservoir = []
+    w = math.exp(math.log(rng.random()) / n)
+    next_index = n + math.floor(math.log(rng.random()) / math.log(1 - w))
+
+    for i, fragment in enumerate(fragments):
+        if i < n:
+            reservoir.append((i, fragment))
+        elif i == next_index:
+            reservoir[rng.randrange(n)] = (i, fragment)
+            w *= math.exp(math.log(rng.random()) / n)
+            next_index += math.floor(math.log(rng.random()) / math.log(1 - w)) + 1
+
+    return [fragment for _, fragment in sorted(reservoir, key=lambda item: item[0])]
+
+
+def subsample(
+    read_files: List[str], n: int, method: str = HEAD, seed: int = 0
+) -> List[List[bytes]]:
+    """Samples n fragments from the read files.
+
+    Args:
+        read_files (List[str]): 1 or 2 (paired) (gzipped) FASTQ files
+        n (int): number of fragments, all of them if the files have fewer
+        method (str): "head" or "reservoir"
+        seed (int): seed of the reservoir sample
+
+    Returns:
+        List[List[bytes]]: the sampled records (4 lines each) per read file
+    """
+    fragments = iter_fragments(read_files)
+    if method == HEAD:
+        sample = list(islice(fragments, n))
+    elif method == RESERVOIR:
+        sample = _reservoir(fragments, n, seed)
+    else:
+        raise ValueError(f"subsample: Unknown method {method}")
+
+    return [[fragment[mate] for fragment in sample] for mate in range(len(read_files))]
+
+
+def sequences(records: List[bytes]) -> List[bytes]:
+    """Returns the sequence lines of FASTQ records."""
+    return [record.split(b"\n", 2)[1].rstrip(b"\r") for record in records]
+
+
+class FifoFeeder:
+    """Feeds the records of every mate into a named pipe from a background thread.
+
+    On exit, writers whose reader never opened the pipe or stopped reading (e.g.
+    because the tool failed) are released and the pipes removed.
+    """
+
+    def __init__(
+        self, mates: List[List[bytes]], directory: str, prefix: str = "sample"
+    ) -> None:
+        self.mates = mates
+        self.paths = [
+            os.path.join(directory, f"{prefix}_{i + 1}.fq") for i in range(len(mates))
+        ]
+        self.threads = []
+
+    def _write(self, path: str, records: List[bytes]) -> None:
+        try:
+            with open(path, "wb") as f:
+                for record in records:
+                    f.write(record)
+        except BrokenPipeError:
+            pass
+
+    def __enter__(self) -> List[str]:
+        for path, records in zip(self.paths, self.mates):
+            if os.path.exists(path):
+                os.remove(path)
+            os.mkfifo(path)
+            thread = threading.Thread(
+                target=self._write, args=(path, records), daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+        return self.paths
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        for path, thread in zip(self.paths, self.threads):
+            if thread.is_alive():
+                # Opening and closing the read end makes the writer fail with EPIPE
+                fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+                os.close(fd)
+            thread.join(timeout=10)
+            os.remove(path)
+        return False
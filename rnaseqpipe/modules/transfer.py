@@ -0,0 +1,94 @@
+"""
+Streaming blob downloads that write straight to disk with bounded memory.
+
+The blob is fetched as fixed-size ranged GETs that run in parallel, but chunks are
+written to disk strictly in order. At most `max_concurrency` chunks are held in
+memory at any time, and the partial file is always a contiguous prefix of the blob,
+which is what makes resuming an interrupted download possible.
+"""
+
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024  # 8 MiB
+DEFAULT_MAX_CONCURRENCY = 4
+
+
+def stream_download(
+    blob_client,
+    dest_path: str,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    resume: bool = True,
+) -> int:
+    """Download a blob to `dest_path` in chunks using parallel ranged GETs.
+
+    The data is written to `<dest_path>.part` and only renamed to `dest_path` once
+    complete. With `resume=True`, an existing partial file is continued instead of
+    being discarded, as long as the blob has not changed since (checked via ETag).
+
+    Args:
+        blob_client: azure BlobClient of the blob to download
+        dest_path (str): local path the blob is written to
+        chunk_size (int): size of each ranged GET in bytes
+        max_concurrency (int): number of ranged GETs in flight
+        resume (bool): continue an existing partial download
+
+    Returns:
+        int: size of the downloaded blob in bytes
+    """
+    from azure.core import MatchConditions
+
+    properties = blob_client.get_blob_properties()
+    size = properties.size
+    etag = properties.etag
+
+    part_path = f"{dest_path}.part"
+    etag_path = f"{part_path}.etag"
+
+    offset = 0
+    if resume and os.path.exists(part_path) and _read_etag(etag_path) == etag:
+        offset = min(os.path.getsize(part_path), size)
+        print(f"Resuming download of {blob_client.blob_name} at byte {offset}/{size}")
+    else:
+        with open(etag_path, "w") as f:
+            f.write(etag)
+
+    def fetch(start: int, length: int) -> bytes:
+        downloader = blob_client.download_blob(
+            offset=start,
+            length=length,
+            etag=etag,
+            match_condition=MatchConditions.IfNotModified,
+        )
+        return downloader.readall()
+
+    with open(part_path, "r+b" if offset else "wb") as f:
+        f.seek(offset)
+        f.truncate()
+
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            pending = deque()
+            for start in range(offset, size, chunk_size):
+                length = min(chunk_size, size - start)
+                pending.append(executor.submit(fetch, start, length))
+                if len(pending) >= max_concurrency:
+                    f.write(pending.popleft().result())
+            while pending:
+                f.write(pending.popleft().result())
+
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(part_path, dest_path)
+    os.remove(etag_path)
+
+    return size
+
+
+def _read_etag(etag_path: str):
+    if not os.path.exists(etag_path):
+        return None
+    with open(etag_path) as f:
+        return f.read().strip()
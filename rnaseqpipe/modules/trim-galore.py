@@ -3,81 +3,164 @@ Adapter and Quality Trimming using Trim Galore
 """
 
 from modal import App, Image
-from typing import List
+from typing import List, Tuple
 
-from rnaseqpipe.modules.utils import PLID
-from rnaseqpipe.config import vol, fastqc_img
+from rnaseqpipe.modules.utils import PLID, trimmed_read_files
+from rnaseqpipe.config import vol, fastqc_img, trimgalore_img
+from rnaseqpipe.modules.stagecache import StageCache, cache_dir
+from rnaseqpipe.modules.metrics import run_stage
+from rnaseqpipe.modules.volsession import VolumeSession
+from rnaseqpipe.modules.scratch import Scratch
+from rnaseqpipe.modules.batching import run_per_sample
 
 app = App("rnaseq-trim-galore")
 
 CPUS = 8.0
-
-trimgalore_img = (
-    fastqc_img(Image.debian_slim())
-    .apt_install("cutadapt", "curl")
-    .run_commands(
-        "curl -fsSL https://github.com/FelixKrueger/TrimGalore/archive/0.6.10.tar.gz -o trim_galore.tar.gz",
-        "tar xvzf trim_galore.tar.gz",
+TOOL_VERSION = "TrimGalore-0.6.10"
+TRIMGALORE_BIN = "/TrimGalore-0.6.10/trim_galore"
+
+image = trimgalore_img(fastqc_img(Image.debian_slim()))
+
+
+@app.function(cpu=CPUS, volumes={"/data": vol}, image=image, timeout=6000)
+def trimgalore(
+    plid: str,
+    read_files: List[str],
+    force_recompute: bool = False,
+    compress: bool = False,
+    cpu: float = CPUS,
+    memory: int = None,
+    scratch: bool = True,
+):
+    """Trim adapters and low-quality bases.
+
+    Args:
+        plid (str): pipeline ID
+        read_files (List[str]): list of read files (2 for paired reads)
+        compress (bool): write the trimmed reads gzipped (multithreaded via pigz)
+            instead of uncompressed, to cut volume I/O and storage
+        cpu (float): CPUs of the container (see resources.plan_resources), sets --cores
+        memory (int): memory of the container in MB, only recorded
+        scratch (bool): trim on local disk and only copy the trimmed reads and
+            reports to the volume once Trim Galore finished
+    """
+    session = VolumeSession(vol, plid, "trimgalore")
+    session.reload()
+
+    result = _trimgalore(
+        plid, read_files, force_recompute, compress, cpu, memory, scratch
     )
-)
 
+    session.commit()
+    return result
+
+
+def _trimgalore(
+    plid: str,
+    read_files: List[str],
+    force_recompute: bool,
+    compress: bool,
+    cpu: float,
+    memory: int,
+    scratch: bool,
+):
+    """Runs Trim Galore, the caller reloads and commits the volume."""
+    import os
 
-@app.function(cpu=CPUS, volumes={"/data": vol}, image=trimgalore_img, timeout=6000)
-def trimgalore(plid: str, read_files: List[str], force_recompute: bool = False):
     print(f"Running TrimGalore! for plid {plid}...")
 
     assert len(read_files) in [1, 2], "TrimGalore!: Invalid number of read files"
 
-    vol.reload()
-
-    # Check if trimgalore result files already exist
-    import os
+    result_path = f"/data/{plid}/trimgalore"
 
-    if os.path.exists(f"/data/{plid}/trimgalore") and not force_recompute:
-        files = os.listdir(f"/data/{plid}/trimgalore")
-        print(f"{plid}:trim-galore: Files in trimgalore directory: {files}")
-        sample_id = plid.split("-")[-1]
-
-        print("Sample id", sample_id)
-
-        if len(read_files) == 2:
-            if (
-                f"{sample_id}_1_val_1.fq" in files
-                and f"{sample_id}_2_val_2.fq" in files
-                and f"{sample_id}_1.fastq.gz_trimming_report.txt" in files
-                and f"{sample_id}_2.fastq.gz_trimming_report.txt" in files
-            ):
-                print(
-                    f"{plid}:trim-galore: Trimgalore results already exist! Returning without action."
-                )
-                return True
-        elif len(read_files) == 1:
-            if (
-                f"{sample_id}_trimmed.fq.gz" in files
-            ) and f"{sample_id}.fastq.gz_trimming_report.txt" in files:
-                print(
-                    f"{plid}:trim-galore: Trimgalore results already exist! Returning without action."
-                )
-                return True
-
-    trimgalore_cmd = f"""/TrimGalore-0.6.10/trim_galore {' '.join(map(str, read_files))} \
-        --cores {int(CPUS)} \
+    def trimgalore_args(out_dir: str) -> str:
+        return f"""{' '.join(map(str, read_files))} \
         {"--paired" if len(read_files) == 2 else ''} \
-        -o /data/{plid}/trimgalore \
-        --dont_gzip
+        -o {out_dir} \
+        {"" if compress else "--dont_gzip"}
         """
 
-    print(f"Running TrimGalore: \n\t{trimgalore_cmd}")
+    # Check if trimgalore result files already exist. The number of cores and the
+    # scratch directory do not change the result, so they are not part of the key.
+    cache = StageCache(
+        cache_dir(plid),
+        "trimgalore",
+        TOOL_VERSION,
+        trimgalore_args(result_path),
+        read_files,
+    )
+    if cache.hit() and not force_recompute:
+        print(
+            f"{plid}:trim-galore: Trimgalore results already exist! Returning without action."
+        )
+        return True
+
+    cache.invalidate()
+
+    with Scratch(plid, "trimgalore", result_path, enabled=scratch) as work_dir:
+        trimgalore_cmd = (
+            f"{TRIMGALORE_BIN} --cores {int(cpu)} {trimgalore_args(work_dir.path)}"
+        )
+
+        print(f"Running TrimGalore: \n\t{trimgalore_cmd}")
+
+        run_stage(
+            plid,
+            "trimgalore",
+            trimgalore_cmd,
+            inputs=read_files,
+            outputs=[work_dir.path],
+            cpu=cpu,
+            memory=memory,
+        )
+
+        outputs = work_dir.publish(
+            [
+                os.path.basename(f)
+                for f in trimmed_read_files(read_files, work_dir.path, compress)
+            ]
+            + ["*_trimming_report.txt"]
+        )
+
+    cache.record(outputs)
 
-    import subprocess
+    print("TrimGalore completed successfully!")
 
-    subprocess.run(trimgalore_cmd, check=True, shell=True)
+    return True
 
-    vol.commit()
 
-    print("TrimGalore completed successfully!")
+@app.function(cpu=CPUS, volumes={"/data": vol}, image=image, timeout=6000)
+def trimgalore_many(
+    samples: List[Tuple[str, List[str]]],
+    force_recompute: bool = False,
+    compress: bool = False,
+    cpu: float = CPUS,
+    memory: int = None,
+):
+    """Trim several samples back to back in one container.
+
+    Args:
+        samples (List[Tuple[str, List[str]]]): (plid, read_files) per sample
+        cpu (float), memory (int): resources of the container, sized from the total
+            input of the batch
+
+    Returns:
+        Dict[str, Union[bool, str]]: True per successful plid, the error otherwise
+    """
+    # One reload and commit for the batch instead of one per sample
+    session = VolumeSession(vol, stage="trimgalore_many")
+    session.reload()
+
+    results = run_per_sample(
+        "trimgalore",
+        samples,
+        lambda plid, read_files: _trimgalore(
+            plid, read_files, force_recompute, compress, cpu, memory, True
+        ),
+    )
 
-    return True
+    session.commit()
+    return results
 
 
 @app.local_entrypoint()
@@ -3,15 +3,35 @@ This module is used to upload the results of the pipeline to Azure Blob Storage.
 """
 
 from modal import Image, App, Secret
+from typing import List
 from rnaseqpipe.config import vol
+from rnaseqpipe.modules.metrics import measure
+from rnaseqpipe.modules.volsession import VolumeSession
+from rnaseqpipe.modules.batching import run_per_sample
+from rnaseqpipe.modules.uploadmanifest import UploadManifest, manifest_path, file_md5
+from rnaseqpipe.modules.artifacts import (
+    COMPRESS,
+    DISCARD,
+    compress_file,
+    format_savings,
+    load_policies,
+    plan_artifacts,
+    savings,
+)
 
 app = App("rnaseq-uploader")
-uploader_img = Image.debian_slim().pip_install("azure-storage-blob", "tqdm")
+uploader_img = (
+    Image.debian_slim().apt_install("pigz").pip_install("azure-storage-blob", "tqdm")
+)
+
+DEFAULT_BLOCK_SIZE = 8 * 1024 * 1024  # 8 MiB
+DEFAULT_MAX_CONCURRENCY = 4
 
 with uploader_img.imports():
     import os
-    from azure.storage.blob import BlobServiceClient
-    from azure.core.exceptions import ResourceNotFoundError
+    import shutil
+    import tempfile
+    from azure.storage.blob import BlobServiceClient, ContentSettings
     from concurrent.futures import ThreadPoolExecutor, as_completed
     from tqdm import tqdm
 
@@ -22,86 +42,150 @@ with uploader_img.imports():
     secrets=[Secret.from_name("azure-connect-str")],
     timeout=60 * 1000,
 )
-def upload_results(plid: str):
-    """Function that uploads all results to Azure Blob Storage.
+def upload_results(
+    plid: str,
+    block_size: int = DEFAULT_BLOCK_SIZE,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    max_workers: int = 8,
+):
+    """Function that uploads the results to Azure Blob Storage.
+
+    Which files are uploaded, gzipped first or left out is decided by the artifact
+    policies (see modules/artifacts.py). The blobs already in the container are taken
+    from a single listing of the plid prefix, and files recorded in the upload
+    manifest as unchanged are skipped.
+
     Args:
         plid (str): pipeline id for which results are to be uploaded.
+        block_size (int): size of the blocks files larger than it are uploaded in
+        max_concurrency (int): number of blocks of a file uploaded in parallel
+        max_workers (int): number of files uploaded in parallel
     """
+    session = VolumeSession(vol, plid, "upload")
+    session.reload()
+
+    result = _upload_results(plid, block_size, max_concurrency, max_workers)
+
+    session.commit()
+    return result
+
+
+def _upload_results(
+    plid: str, block_size: int, max_concurrency: int, max_workers: int
+) -> bool:
+    """Uploads the results, the caller reloads and commits the volume."""
     RES_CONTAINER = "rna-seq-pipeline-results"
     connect_str = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
     # Get the client for the container
-    blob_service_client = BlobServiceClient.from_connection_string(connect_str)
+    blob_service_client = BlobServiceClient.from_connection_string(
+        connect_str, max_block_size=block_size, max_single_put_size=block_size
+    )
     # Get the client for the container
     container_client = blob_service_client.get_container_client(RES_CONTAINER)
     base_path = f"/data/{plid}/"
 
-    def should_upload(file_path, blob_name):
-        blob_client = container_client.get_blob_client(blob_name)
+    manifest = UploadManifest(manifest_path(plid))
+
+    def upload_file(file_path, blob_name, compress):
+        print("Now uploading file:", blob_name, file_path)
+        upload_path = file_path
+        if compress:
+            # Compressed on local disk, not on the volume
+            upload_path = os.path.join(
+                tempfile.mkdtemp(prefix=f"{plid}-upload-"), os.path.basename(blob_name)
+            )
+            compress_file(file_path, upload_path)
+            md5 = file_md5(upload_path)
+        else:
+            md5 = manifest.md5(file_path)
         try:
-            blob_properties = blob_client.get_blob_properties()
-            azure_size = blob_properties.size
-            local_size = os.path.getsize(file_path)
-            return local_size != azure_size
-        except ResourceNotFoundError:
-            return True
-
-    def upload_file(file_path, blob_name):
-        if should_upload(file_path, blob_name):
-            print("Now uploading file:", blob_name, file_path)
             blob_client = container_client.get_blob_client(blob_name)
-            with open(file_path, "rb") as data:
-                blob_client.upload_blob(data, overwrite=True)
-            return blob_name
-        return None
-
-    files_to_upload = []
-    for root, _, files in os.walk(base_path):
-        for file in files:
-            full_path = os.path.join(root, file)
-            relative_path = os.path.relpath(full_path, base_path)
-            blob_name = f"{plid}/{relative_path}"
-            files_to_upload.append((full_path, blob_name))
-
-    print(f"Found {len(files_to_upload)} files to check for upload.")
-
-    # Use ThreadPoolExecutor for parallel uploads
-    with ThreadPoolExecutor(max_workers=30) as executor:
-        future_to_file = {
-            executor.submit(upload_file, file_path, blob_name): (file_path, blob_name)
-            for file_path, blob_name in files_to_upload
+            with open(upload_path, "rb") as data:
+                result = blob_client.upload_blob(
+                    data,
+                    overwrite=True,
+                    max_concurrency=max_concurrency,
+                    content_settings=ContentSettings(
+                        content_md5=bytearray.fromhex(md5)
+                    ),
+                )
+            return md5, result.get("etag"), os.path.getsize(upload_path)
+        finally:
+            if compress:
+                shutil.rmtree(os.path.dirname(upload_path), ignore_errors=True)
+
+    artifacts = plan_artifacts(base_path, load_policies(), exclude=[manifest.path])
+    files_to_upload = [
+        (artifact.path, artifact.blob_name(plid), artifact.action == COMPRESS)
+        for artifact in artifacts
+        if artifact.action != DISCARD
+    ]
+
+    # The record is written after the final check, since the check compares the
+    # local files, including the metrics of earlier uploads
+    with measure(plid, "upload") as record:
+        # One listing of the sample's prefix instead of a HEAD request per file
+        remote_blobs = {
+            blob.name: blob
+            for blob in container_client.list_blobs(name_starts_with=f"{plid}/")
         }
+        pending = [
+            (file_path, blob_name, compress)
+            for file_path, blob_name, compress in files_to_upload
+            if not manifest.unchanged(file_path, blob_name, remote_blobs.get(blob_name))
+        ]
+        print(
+            f"Found {len(artifacts)} files, {len(files_to_upload)} to publish, "
+            f"{len(pending)} of them new or changed."
+        )
+
+        # Use ThreadPoolExecutor for parallel uploads
         uploaded_count = 0
-        for future in tqdm(
-            as_completed(future_to_file),
-            total=len(files_to_upload),
-            desc="Processing files",
-        ):
-            file_path, blob_name = future_to_file[future]
-            try:
-                result = future.result()
-                if result:
-                    uploaded_count += 1
-            except Exception as exc:
-                print(f"{file_path} generated an exception: {exc}")
-
-    # Final Check that all files were uploaded and have the correct size
-    uploaded_files = container_client.list_blobs()
-    uploaded_files = [
-        blob.name for blob in uploaded_files if blob.name.startswith(plid)
-    ]
-    if len(uploaded_files) != len(files_to_upload):
-        raise Exception(
-            f"Upload failed. {len(uploaded_files)} files were uploaded, but {len(files_to_upload)} were expected."
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                future_to_file = {
+                    executor.submit(upload_file, file_path, blob_name, compress): (
+                        file_path,
+                        blob_name,
+                    )
+                    for file_path, blob_name, compress in pending
+                }
+                for future in tqdm(
+                    as_completed(future_to_file),
+                    total=len(pending),
+                    desc="Uploading files",
+                ):
+                    file_path, blob_name = future_to_file[future]
+                    try:
+                        md5, etag, blob_size = future.result()
+                        manifest.record(file_path, blob_name, md5, etag, blob_size)
+                        uploaded_count += 1
+                        record["output_bytes"] += blob_size
+                    except Exception as exc:
+                        print(f"{file_path} generated an exception: {exc}")
+        finally:
+            # Keep the progress, so that a retry only uploads what is missing
+            manifest.save()
+
+        record["files"] = len(files_to_upload)
+        record["files_uploaded"] = uploaded_count
+
+        summary = savings(
+            artifacts,
+            {
+                path: entry["blob_size"]
+                for path, entry in manifest.entries.items()
+                if "blob_size" in entry
+            },
         )
-    # Check if files have the correct size
-    for file in uploaded_files:
-        blob_client = container_client.get_blob_client(file)
-        blob_properties = blob_client.get_blob_properties()
-        azure_size = blob_properties.size
-        local_size = os.path.getsize(os.path.join(base_path, file.split(plid + "/")[1]))
-        if local_size != azure_size:
+        record["bytes_saved"] = summary["saved_bytes"]
+        print(f"{plid}:upload:\n{format_savings(summary)}")
+
+        # Final Check that every file was uploaded in its current state
+        missing = manifest.verify([file_path for file_path, _, _ in files_to_upload])
+        if missing:
             raise Exception(
-                f"Upload failed. File {file} has incorrect size. Local size: {local_size}, Azure size: {azure_size}"
+                f"Upload failed. {len(missing)} of {len(files_to_upload)} files were not uploaded: {missing[:10]}"
             )
 
     print(f"Upload completed. {uploaded_count} files were uploaded or updated.")
@@ -109,6 +193,37 @@ def upload_results(plid: str):
     return True
 
 
+@app.function(
+    image=uploader_img,
+    volumes={"/data": vol},
+    secrets=[Secret.from_name("azure-connect-str")],
+    timeout=60 * 1000,
+)
+def upload_many(
+    plids: List[str],
+    block_size: int = DEFAULT_BLOCK_SIZE,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    max_workers: int = 8,
+):
+    """Uploads the results of several runs one after another in one container.
+
+    Returns:
+        Dict[str, Union[bool, str]]: True per uploaded plid, the error otherwise
+    """
+    # One reload and commit for the batch instead of one per sample
+    session = VolumeSession(vol, stage="upload_many")
+    session.reload()
+
+    results = run_per_sample(
+        "upload",
+        [(plid,) for plid in plids],
+        lambda plid: _upload_results(plid, block_size, max_concurrency, max_workers),
+    )
+
+    session.commit()
+    return results
+
+
 @app.local_entrypoint()
 def main():
     plid = "pl-SRR7696663"  # Replace with actual PLID or add as a command-line argument
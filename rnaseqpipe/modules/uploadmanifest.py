@@ -0,0 +1,138 @@
+"""
+Local manifest of the files a pipeline run uploaded to the results container.
+
+For every uploaded file the manifest stores its size, mtime and MD5 along with the
+blob name, blob size and ETag it was uploaded as. A file whose size and mtime still match its
+entry, and whose blob is still present with that size in a single prefix listing of
+the container, is skipped without computing its MD5 or making any per-file request.
+The manifest is written to /data/{plid}/.stagecache/upload.json, next to the stage
+cache manifests, and is itself never uploaded.
+"""
+
+import hashlib
+import json
+import os
+from typing import Dict, List
+
+from rnaseqpipe.modules.stagecache import HASH_BLOCK_SIZE, cache_dir
+
+
+def manifest_path(plid: str, root: str = "/data") -> str:
+    return os.path.join(cache_dir(plid, root), "upload.json")
+
+
+def file_md5(path: str) -> str:
+    """Returns the MD5 hex digest of a file, read in blocks."""
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def _remote_md5(blob) -> str:
+    """Returns the Content-MD5 of a listed blob as hex, None if it has none."""
+    settings = getattr(blob, "content_settings", None)
+    md5 = getattr(settings, "content_md5", None)
+    return bytes(md5).hex() if md5 else None
+
+
+class UploadManifest:
+    """Tracks which local files are already present in the results container.
+
+    Usage:
+        manifest = UploadManifest(manifest_path(plid))
+        remote = {b.name: b for b in container_client.list_blobs(name_starts_with=...)}
+        if not manifest.unchanged(path, blob_name, remote.get(blob_name)):
+            md5 = manifest.md5(path)
+            ... upload ...
+            manifest.record(path, blob_name, md5, etag)
+        manifest.save()
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.entries: Dict[str, Dict] = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.entries = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                self.entries = {}
+
+    def _matches_local(self, path: str) -> bool:
+        entry = self.entries.get(path)
+        if entry is None:
+            return False
+        st = os.stat(path)
+        return entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns
+
+    def md5(self, path: str) -> str:
+        """Returns the MD5 of a file, reusing the recorded one if it did not change."""
+        if self._matches_local(path):
+            return self.entries[path]["md5"]
+        return file_md5(path)
+
+    def unchanged(self, path: str, blob_name: str, remote_blob) -> bool:
+        """Returns True if the file does not need to be uploaded.
+
+        Args:
+            path (str): local file
+            blob_name (str): name of the blob the file is uploaded as
+            remote_blob: the blob from the container listing, None if it is missing
+        """
+        if remote_blob is None:
+            return False
+
+        if self._matches_local(path):
+            entry = self.entries[path]
+            return (
+                entry["blob_name"] == blob_name
+                and entry.get("blob_size", entry["size"]) == remote_blob.size
+            )
+
+        # Not in the manifest (e.g. uploaded before it existed), but the blob has the
+        # same content, which is only known if the blob carries an MD5
+        remote_md5 = _remote_md5(remote_blob)
+        if remote_md5 is None or os.path.getsize(path) != remote_blob.size:
+            return False
+        md5 = file_md5(path)
+        if md5 != remote_md5:
+            return False
+        self.record(path, blob_name, md5, getattr(remote_blob, "etag", None))
+        return True
+
+    def record(
+        self,
+        path: str,
+        blob_name: str,
+        md5: str,
+        etag: str = None,
+        blob_size: int = None,
+    ) -> None:
+        """Records an uploaded file.
+
+        Args:
+            md5 (str): MD5 of the uploaded content
+            blob_size (int): size of the blob if it differs from the file (compressed)
+        """
+        st = os.stat(path)
+        self.entries[path] = {
+            "blob_name": blob_name,
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "blob_size": st.st_size if blob_size is None else blob_size,
+            "md5": md5,
+            "etag": etag,
+        }
+
+    def verify(self, files: List[str]) -> List[str]:
+        """Returns the files that are not recorded as uploaded in their current state."""
+        return [path for path in files if not self._matches_local(path)]
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f, indent=2)
+        os.replace(tmp_path, self.path)
@@ -1,3 +1,7 @@
+import os
+from typing import List
+
+
 class PLID:
     def __init__(self, id: str = None) -> None:
         if id is None:
@@ -15,3 +19,21 @@ class PLID:
 
     def __str__(self) -> str:
         return self.id
+
+
+def trimmed_read_files(
+    read_files: List[str], out_dir: str, compressed: bool = False
+) -> List[str]:
+    """Returns the paths Trim Galore writes the trimmed reads of read_files to."""
+    names = [os.path.basename(str(f)).split(".")[0] for f in read_files]
+    ext = ".fq.gz" if compressed else ".fq"
+
+    if len(names) == 1:
+        return [os.path.join(out_dir, f"{names[0]}_trimmed{ext}")]
+    elif len(names) == 2:
+        return [
+            os.path.join(out_dir, f"{names[0]}_val_1{ext}"),
+            os.path.join(out_dir, f"{names[1]}_val_2{ext}"),
+        ]
+    else:
+        raise ValueError("Only 1 or 2 read files supported.")
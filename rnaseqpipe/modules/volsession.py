@@ -0,0 +1,102 @@
+"""
+Batched, retried and timed access to the shared Modal volume.
+
+A stage reloads the volume once when it starts and commits once when it is done,
+instead of committing after every file it writes:
+
+    session = VolumeSession(vol, plid, "trimgalore")
+    session.reload()
+    ... write outputs ...
+    session.commit()
+
+or equivalently `with VolumeSession(vol, plid, "trimgalore"): ...`, which commits
+only if the block succeeds. Commits (and reloads) that fail, e.g. because another
+container committed at the same time, are retried with exponential backoff. The
+duration and number of attempts of every commit and reload are appended to
+/data/{plid}/metrics/volume.jsonl. A record written after the last commit of a
+container is persisted by the commit Modal does when the container exits.
+"""
+
+import random
+import time
+
+from rnaseqpipe.modules.metrics import metrics_dir, write_record
+
+COMMIT_RETRIES = 5
+BACKOFF_SECONDS = 1.0
+
+
+class VolumeSession:
+    def __init__(
+        self,
+        volume,
+        plid: str = None,
+        stage: str = None,
+        retries: int = COMMIT_RETRIES,
+        backoff: float = BACKOFF_SECONDS,
+    ) -> None:
+        """
+        Args:
+            volume: the modal Volume mounted at /data
+            plid (str): pipeline ID the timings are recorded for, None to only print
+            stage (str): name of the stage, recorded with the timings
+            retries (int): attempts per commit or reload before giving up
+            backoff (float): delay before the first retry, doubled for every retry
+        """
+        self.volume = volume
+        self.plid = plid
+        self.stage = stage
+        self.retries = retries
+        self.backoff = backoff
+
+    def _run(self, operation: str, fn) -> None:
+        started = time.time()
+        for attempt in range(1, self.retries + 1):
+            try:
+                fn()
+                break
+            except Exception as e:
+                if attempt == self.retries:
+                    print(
+                        f"{self.plid}:{self.stage}: Volume {operation} failed after {attempt} attempts: {e}"
+                    )
+                    raise
+                delay = self.backoff * 2 ** (attempt - 1) * (1 + random.random())
+                print(
+                    f"{self.plid}:{self.stage}: Volume {operation} failed ({e}), retrying in {delay:.1f}s"
+                )
+                time.sleep(delay)
+
+        seconds = time.time() - started
+        print(
+            f"{self.plid}:{self.stage}: Volume {operation} took {seconds:.2f}s ({attempt} attempts)"
+        )
+        if self.plid:
+            write_record(
+                metrics_dir(self.plid),
+                "volume",
+                {
+                    "plid": str(self.plid),
+                    "stage": "volume",
+                    "operation": operation,
+                    "caller": self.stage,
+                    "started": started,
+                    "wall_seconds": seconds,
+                    "attempts": attempt,
+                },
+            )
+
+    def reload(self) -> None:
+        self._run("reload", self.volume.reload)
+
+    def commit(self) -> None:
+        self._run("commit", self.volume.commit)
+
+    def __enter__(self) -> "VolumeSession":
+        self.reload()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        if exc_type is None:
+            self.commit()
+        return False
@@ -0,0 +1,218 @@
+"""
+Garbage collection and retention for the pipeline volume.
+
+Only pipeline run folders (/data/pl-*) are ever touched, the shared references
+(genome index, salmon index, resource model, ...) in PINNED_DIRS are never deleted.
+A run is eligible once its upload is verified, i.e. every file its artifact policy
+publishes or compresses is recorded in the upload manifest in its current state,
+and it has been idle for min_idle_hours. For eligible runs
+
+1. intermediates are removed: files the policy discards (raw and trimmed reads, ...)
+   and the originals of files that were uploaded compressed (wig tracks)
+2. if the volume is still above the retention budget, whole run folders are removed,
+   least recently used first, until it fits
+
+Run it as a dry run first, which only reports the bytes it would reclaim:
+
+    modal run rnaseqpipe/modules/volume_gc.py --budget-gb 500
+    modal run rnaseqpipe/modules/volume_gc.py --budget-gb 500 --apply
+"""
+
+import os
+import shutil
+import time
+from typing import Dict, List
+
+from modal import App, Image
+from rnaseqpipe.config import vol
+from rnaseqpipe.modules.artifacts import (
+    COMPRESS,
+    DISCARD,
+    PUBLISH,
+    load_policies,
+    plan_artifacts,
+)
+from rnaseqpipe.modules.uploadmanifest import UploadManifest, manifest_path
+from rnaseqpipe.modules.volsession import VolumeSession
+
+app = App("rnaseq-gc")
+
+# Shared references on the volume that are never collected
+PINNED_DIRS = ["genome-index", "salmon_index", "resources"]
+
+# Files that keep changing after the upload (the upload's own metrics)
+UNVERIFIED_PATTERNS = ("metrics/",)
+
+
+class RunUsage:
+    """Disk usage of a pipeline run folder."""
+
+    def __init__(self, plid: str, path: str) -> None:
+        self.plid = plid
+        self.path = path
+        self.total_bytes = 0
+        self.intermediate_bytes = 0
+        self.intermediates: List[str] = []
+        self.last_used = 0.0
+        self.verified = False
+
+
+def run_usage(root: str, plid: str, policies) -> RunUsage:
+    base_path = os.path.join(root, plid, "")
+    usage = RunUsage(plid, base_path)
+
+    manifest = UploadManifest(manifest_path(plid, root))
+    artifacts = plan_artifacts(base_path, policies)
+
+    uploaded = [
+        a
+        for a in artifacts
+        if a.action in (PUBLISH, COMPRESS)
+        and not a.relative_path.startswith(UNVERIFIED_PATTERNS)
+        and not a.path.startswith(manifest.path)
+    ]
+    usage.verified = bool(manifest.entries) and not manifest.verify(
+        [a.path for a in uploaded]
+    )
+
+    for artifact in artifacts:
+        usage.total_bytes += artifact.size
+        usage.last_used = max(usage.last_used, os.path.getmtime(artifact.path))
+        if artifact.action in (DISCARD, COMPRESS) and not artifact.path.startswith(
+            manifest.path
+        ):
+            usage.intermediates.append(artifact.path)
+            usage.intermediate_bytes += artifact.size
+
+    return usage
+
+
+def plan_gc(
+    root: str,
+    budget_bytes: int = None,
+    min_idle_hours: float = 24,
+    now: float = None,
+) -> Dict:
+    """Plans what to delete.
+
+    Args:
+        root (str): mount point of the volume
+        budget_bytes (int): size the run folders may take up in total, None for no limit
+        min_idle_hours (float): runs with files newer than this are left alone
+
+    Returns:
+        Dict: "runs" (all RunUsage), "intermediates" (RunUsage whose intermediates are
+            removed), "evict" (RunUsage removed entirely) and "reclaimed_bytes"
+    """
+    now = now or time.time()
+    policies = load_policies(os.path.join(root, "resources", "artifacts.json"))
+
+    runs = [
+        run_usage(root, name, policies)
+        for name in sorted(os.listdir(root))
+        if name.startswith("pl-")
+        and name not in PINNED_DIRS
+        and os.path.isdir(os.path.join(root, name))
+    ]
+    eligible = [
+        r for r in runs if r.verified and now - r.last_used >= min_idle_hours * 3600
+    ]
+
+    intermediates = [r for r in eligible if r.intermediates]
+    remaining = sum(r.total_bytes for r in runs) - sum(
+        r.intermediate_bytes for r in intermediates
+    )
+
+    evict = []
+    if budget_bytes is not None:
+        for run in sorted(eligible, key=lambda r: r.last_used):
+            if remaining <= budget_bytes:
+                break
+            evict.append(run)
+            remaining -= run.total_bytes - (
+                run.intermediate_bytes if run in intermediates else 0
+            )
+
+    reclaimed = sum(
+        r.total_bytes if r in evict else r.intermediate_bytes
+        for r in set(intermediates) | set(evict)
+    )
+
+    return {
+        "runs": runs,
+        "intermediates": [r for r in intermediates if r not in evict],
+        "evict": evict,
+        "reclaimed_bytes": reclaimed,
+        "remaining_bytes": remaining,
+    }
+
+
+def format_plan(plan: Dict) -> str:
+    lines = [
+        f"{'run':<40}{'size [MB]':>12}{'intermediate [MB]':>19}  action",
+    ]
+    for run in plan["runs"]:
+        if run in plan["evict"]:
+            action = "evict (LRU)"
+        elif run in plan["intermediates"]:
+            action = "remove intermediates"
+        elif not run.verified:
+            action = "keep (upload not verified)"
+        else:
+            action = "keep"
+        lines.append(
+            f"{run.plid:<40}{run.total_bytes / 1e6:>12.1f}"
+            f"{run.intermediate_bytes / 1e6:>19.1f}  {action}"
+        )
+    lines.append(
+        f"reclaim {plan['reclaimed_bytes'] / 1e9:.2f} GB, "
+        f"{plan['remaining_bytes'] / 1e9:.2f} GB of run folders remain"
+    )
+    return "\n".join(lines)
+
+
+def apply_plan(plan: Dict) -> None:
+    for run in plan["intermediates"]:
+        for path in run.intermediates:
+            if os.path.exists(path):
+                os.remove(path)
+    for run in plan["evict"]:
+        shutil.rmtree(run.path, ignore_errors=True)
+
+
+@app.function(image=Image.debian_slim(), volumes={"/data": vol}, timeout=60 * 60)
+def collect_garbage(
+    dry_run: bool = True, budget_gb: float = None, min_idle_hours: float = 24
+):
+    """Removes intermediates of uploaded runs and enforces the retention budget.
+
+    Args:
+        dry_run (bool): only report what would be deleted
+        budget_gb (float): total size of the run folders to stay below, None for no
+            limit
+        min_idle_hours (float): runs with newer files are not touched
+    """
+    session = VolumeSession(vol, stage="gc")
+    session.reload()
+
+    budget_bytes = int(budget_gb * 1e9) if budget_gb is not None else None
+    plan = plan_gc("/data", budget_bytes, min_idle_hours)
+    print(format_plan(plan))
+
+    if dry_run:
+        print("gc: Dry run, nothing was deleted.")
+        return plan["reclaimed_bytes"]
+
+    apply_plan(plan)
+    session.commit()
+
+    print(f"gc: Reclaimed {plan['reclaimed_bytes'] / 1e9:.2f} GB.")
+
+    return plan["reclaimed_bytes"]
+
+
+@app.local_entrypoint()
+def main(apply: bool = False, budget_gb: float = None, min_idle_hours: float = 24):
+    collect_garbage.remote(
+        dry_run=not apply, budget_gb=budget_gb, min_idle_hours=min_idle_hours
+    )
@@ -5,7 +5,7 @@ app = App("rnaseq-process_batch")
 
 
 @app.local_entrypoint()
-def main():
+def main(batched: bool = False):
 
     # def run_pipeline(sample_id: Tuple[str, List[str]], no_cache: bool = False):
 
@@ -19,6 +19,12 @@ def main():
         (("SRR22383428", ["SRR22383428_1.fastq.gz", "SRR22383428_2.fastq.gz"]), False),
     ]
 
+    # Small samples, processed with one container per stage for the whole batch
+    if batched:
+        run_batch = Function.lookup("rna-seq", "run_batch")
+        print(run_batch.remote([sample_id for sample_id, no_cache in sample_ids]))
+        return
+
     run_pipeline = Function.lookup("rna-seq", "run_pipeline")
 
     for sample_id, no_cache in sample_ids:
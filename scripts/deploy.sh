@@ -21,9 +21,17 @@ deploy_module() {
                 echo "Deploying staralign..."
                 modal deploy rnaseqpipe/modules/staralign.py
                 ;;
-            bw)
-                echo "Deploying wigToBigWig..."
-                modal deploy rnaseqpipe/modules/wigToBigWig.py
+            sq)
+                echo "Deploying salmon quant..."
+                modal deploy rnaseqpipe/modules/salmonquant.py
+                ;;
+            gc)
+                echo "Deploying genecounts..."
+                modal deploy rnaseqpipe/modules/genecounts.py
+                ;;
+            qs)
+                echo "Deploying qcstore..."
+                modal deploy rnaseqpipe/modules/qcstore.py
                 ;;
             up)
                 echo "Deploying uploader..."
@@ -39,7 +47,9 @@ deploy_module() {
                 modal deploy rnaseqpipe/modules/trim-galore.py
                 modal deploy rnaseqpipe/modules/fastqc.py
                 modal deploy rnaseqpipe/modules/staralign.py
-                modal deploy rnaseqpipe/modules/wigToBigWig.py
+                modal deploy rnaseqpipe/modules/genecounts.py
+                modal deploy rnaseqpipe/modules/salmonquant.py
+                modal deploy rnaseqpipe/modules/qcstore.py
                 modal deploy rnaseqpipe/modules/uploader.py
                 modal deploy rnaseqpipe/main.py
                 ;;
@@ -1,54 +1,49 @@
 """
 This script is used to generate a decoy transcriptome for use in the Salmon quantification step.
+
+The gentrome and the decoy names are written to /data/salmon_index/{assembly}/decoy/
+and only regenerated if the genome or transcriptome changed, see
+rnaseqpipe/modules/salmonindex.py. scripts/make_salmon_index.py runs this step
+itself, this script is for the gentrome alone.
+
+Run with: modal run scripts/generate_decoy_transcriptome.py --assembly-name R64-1-1
 """
 
 from modal import App, Image
-from rnaseqpipe.config import vol
+from rnaseqpipe.config import vol, reference_img
+from rnaseqpipe.modules.salmonindex import prepare_decoys
 
 app = App("generate-decoy-transcriptome")
 
-image = (
-    Image.debian_slim()
-    .apt_install("git", "wget", "grep")
-    .run_commands("wget https://zenodo.org/api/records/11550687/files-archive")
-    .run_commands("mv files-archive files-archive.zip")
-    .apt_install("unzip")
-    .run_commands("unzip files-archive.zip")
-)
+image = reference_img(Image.debian_slim())
 
 
-@app.function(image=image, volumes={"/data": vol})
-def generate_decoy_transcriptome(assembly_name: str = "R64-1-1"):
+@app.function(image=image, volumes={"/data": vol}, timeout=60 * 60)
+def generate_decoy_transcriptome(
+    assembly_name: str = "R64-1-1",
+    genome: str = None,
+    transcriptome: str = None,
+    force_recompute: bool = False,
+):
     """
     Follows the implementation from here: https://combine-lab.github.io/alevin-tutorial/2019/selective-alignment/
     using the files I downloaded from Ensemble and uploaded to here: https://zenodo.org/records/11550687
-    """
-
-    import os
-    import subprocess
-
-    salmon_index_dir = f"/data/salmon_index/{assembly_name}/decoy"
-    os.makedirs(salmon_index_dir, exist_ok=True)
-
-    # Delete all files in salmon_index_dir
-    for file in os.listdir(salmon_index_dir):
-        os.remove(f"{salmon_index_dir}/{file}")
 
-    # Run the script to generate the decoy transcriptome
-
-    subprocess.run(
-        f'grep "^>" <(gunzip -c /R64-1-1.fa.gz) | cut -d " " -f 1 > {salmon_index_dir}/decoys.txt',
-        shell=True,
-        executable="/bin/bash",
-    )
+    Args:
+        assembly_name (str): assembly, e.g. "R64-1-1"
+        genome, transcriptome (str): gzipped FASTA paths or URLs, needed for
+            assemblies that are not in salmonindex.SOURCES
+    """
+    vol.reload()
 
-    subprocess.run(
-        f"sed -i.bak -e 's/>//g' /data/salmon_index/R64-1-1/decoy/decoys.txt",
-        shell=True,
-    )
-    subprocess.run(
-        f"cat /Saccharomyces_cerevisiae.R64-1-1.cdna.all.fa.gz /R64-1-1.fa.gz > {salmon_index_dir}/gentrome.fa.gz",
-        shell=True,
+    paths = prepare_decoys(
+        assembly_name, genome, transcriptome, force_recompute=force_recompute
     )
 
     vol.commit()
+    return paths
+
+
+@app.local_entrypoint()
+def run(assembly_name: str = "R64-1-1", genome: str = None, transcriptome: str = None):
+    print(generate_decoy_transcriptome.remote(assembly_name, genome, transcriptome))
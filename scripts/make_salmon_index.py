@@ -1,56 +1,142 @@
 """
 Script that generates the salmon index and stores is in a shared modal volume
 
-./bin/salmon index -t transcripts.fa -i transcripts_index --decoys decoys.txt -k 31
+./bin/salmon index -t gentrome.fa.gz -i transcripts_index --decoys decoys.txt \
+    -k 31 -p 16
+
+One call prepares the gentrome (see scripts/generate_decoy_transcriptome.py), builds
+the index on local disk and publishes it as
+/data/salmon_index/{assembly}/index-{version}. Steps whose inputs did not change are
+skipped, the index is only rebuilt if the gentrome, the decoys, k or salmon changed.
+The k-mer index of rnaseqpipe/modules/strandedness.py is built from the same
+gentrome into the index. Pipelines that are running keep using the index they
+started with, see rnaseqpipe/modules/salmonindex.py.
+
+Run with: modal run scripts/make_salmon_index.py --assembly-name R64-1-1
 """
 
 from modal import App, Volume, Image
-from rnaseqpipe.config import vol, salmon_image
+from rnaseqpipe.config import vol, salmon_image, reference_img
+from rnaseqpipe.modules.salmonindex import (
+    assembly_dir,
+    prepare_decoys,
+    publish_index,
+)
+from rnaseqpipe.modules.stagecache import StageCache
+from rnaseqpipe.modules.metrics import measure, run_stage
+from rnaseqpipe.modules.strandedness import build_index, index_path, save_index
 
 app = App("salmon-index")
 
-salmon_image = salmon_image.run_commands(
-    "chmod +x /salmon-latest_linux_x86_64/bin/salmon"
+salmon_image = (
+    reference_img(salmon_image)
+    .run_commands("chmod +x /salmon-latest_linux_x86_64/bin/salmon")
+    .pip_install("numpy")
 )
 
+# salmon index runs one thread per core, the decoy-aware index of a mammalian
+# genome needs ~20 GB of memory, the yeast one a fraction of that
+CPUS = 16.0
+MEMORY = 32 * 1024  # 32 GB
+K = 31
+TOOL_VERSION = "salmon-1.10.0"
+SALMON_BIN = "/salmon-latest_linux_x86_64/bin/salmon"
+LOCAL_BUILD_DIR = "/tmp/salmon_index"
 
-@app.function(image=salmon_image, volumes={"/data": vol})
-def make_salmon_index(assembly_name: str, transcriptome: str):
-    import subprocess
+
+@app.function(
+    image=salmon_image,
+    volumes={"/data": vol},
+    cpu=CPUS,
+    memory=MEMORY,
+    timeout=60 * 60 * 4,
+)
+def make_salmon_index(
+    assembly_name: str = "R64-1-1",
+    transcriptome: str = None,
+    genome: str = None,
+    force_recompute: bool = False,
+):
+    """Builds and publishes the decoy-aware salmon index of an assembly.
+
+    Args:
+        assembly_name (str): assembly, e.g. "R64-1-1"
+        transcriptome, genome (str): gzipped FASTA paths or URLs, needed for
+            assemblies that are not in salmonindex.SOURCES
+
+    Returns:
+        str: path of the published index
+    """
     import os
+    import shutil
 
-    salmon_index_dir = f"/data/salmon_index/{assembly_name}"
-    os.makedirs(salmon_index_dir, exist_ok=True)
-
-    cmd = [
-        "/salmon-latest_linux_x86_64/bin/salmon",
-        "index",
-        "-t",
-        f"{salmon_index_dir}/decoy/gentrome.fa.gz",
-        "-i",
-        f"{salmon_index_dir}/transcripts_index",
-        "--decoys",
-        f"{salmon_index_dir}/decoy/decoys.txt",
-        "-k",
-        "31",
-    ]
-
-    try:
-        result = subprocess.run(cmd, check=True, capture_output=True, text=True)
-        vol.commit()
-        print(f"Succeeded: {result.stdout}")
-    except subprocess.CalledProcessError as e:
-        print(f"Failed to run Salmon index: {e.stderr}")
-        raise e
+    vol.reload()
 
+    gentrome, decoys = prepare_decoys(
+        assembly_name, genome, transcriptome, force_recompute=force_recompute
+    )
+    vol.commit()
 
-@app.local_entrypoint()
-def run():
-    assembly_name = "R64-1-1"
-    transcriptome_url = "https://ftp.ensembl.org/pub/release-112/fasta/saccharomyces_cerevisiae/cdna/Saccharomyces_cerevisiae.R64-1-1.cdna.all.fa.gz"
+    # The index is named by its key, so an unchanged index is found again
+    cache = StageCache(
+        os.path.join(assembly_dir(assembly_name), ".stagecache"),
+        "salmon_index",
+        TOOL_VERSION,
+        f"salmon index -k {K} --decoys",
+        [gentrome, decoys],
+    )
+    name = f"index-{cache.current_key()[:12]}"
+    index = os.path.join(assembly_dir(assembly_name), name)
+
+    if os.path.exists(f"{index}/versionInfo.json") and not force_recompute:
+        print(f"{assembly_name}:salmon_index: {index} already exists! Skipping.")
+    else:
+        local_index = os.path.join(LOCAL_BUILD_DIR, name)
+        shutil.rmtree(local_index, ignore_errors=True)
+
+        # Built on local disk, only the finished index is copied to the volume
+        run_stage(
+            os.path.join("salmon_index", assembly_name),
+            "salmon_index",
+            f"{SALMON_BIN} index -t {gentrome} -i {local_index} --decoys {decoys} "
+            f"-k {K} -p {int(CPUS)}",
+            inputs=[gentrome, decoys],
+            outputs=[local_index],
+            cpu=CPUS,
+            memory=MEMORY,
+        )
+
+        shutil.rmtree(f"{index}.copying", ignore_errors=True)
+        shutil.copytree(local_index, f"{index}.copying")
+        shutil.rmtree(index, ignore_errors=True)
+        os.replace(f"{index}.copying", index)
+        cache.record([index])
+
+    # infer_strandedness only reads the k-mer index, it never builds one
+    kmer_index = index_path(index)
+    if not os.path.exists(kmer_index) or force_recompute:
+        with measure(
+            os.path.join("salmon_index", assembly_name), "strandedness_index"
+        ) as record:
+            save_index(build_index(gentrome, decoys), kmer_index)
+            record["output_bytes"] = os.path.getsize(kmer_index)
 
-    make_salmon_index.remote(
-        assembly_name=assembly_name,
-        transcriptome=transcriptome_url,
+    publish_index(assembly_name, name)
+    vol.commit()
+
+    print(f"{assembly_name}:salmon_index: Published {index}")
+    return index
+
+
+@app.local_entrypoint()
+def run(assembly_name: str = "R64-1-1", transcriptome: str = None, genome: str = None):
+    # e.g. the cDNA of R64-1-1 from Ensembl release 112,
+    # https://ftp.ensembl.org/pub/release-112/fasta/saccharomyces_cerevisiae/cdna/
+    # Saccharomyces_cerevisiae.R64-1-1.cdna.all.fa.gz
+    print(
+        make_salmon_index.remote(
+            assembly_name=assembly_name,
+            transcriptome=transcriptome,
+            genome=genome,
+        )
     )
-    pass
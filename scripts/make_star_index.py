@@ -0,0 +1,160 @@
+"""
+Script that generates the STAR genome index of an assembly and stores it in the shared modal volume
+
+STAR --runMode genomeGenerate --genomeDir star-index --genomeFastaFiles genome.fa \
+    --sjdbGTFfile annotation.gtf --sjdbOverhang 100 --genomeSAindexNbases 14 --genomeSAsparseD 1
+
+The genome and annotation are decompressed to local disk, the index is built there
+and published as /data/genome-index/{assembly}/star-{version}, see
+rnaseqpipe/modules/genomes.py. The version is the key of the build (STAR version,
+parameters and the checksums of genome and annotation), an unchanged index is not
+rebuilt. The suffix array is made sparse as far as needed to fit into MEMORY, so the
+index of a large genome can be built (and aligned to) on a smaller container.
+STARAlign picks the index by assembly name.
+
+Run with: modal run scripts/make_star_index.py --assembly-name R64-1-1
+"""
+
+from modal import App, Image
+from rnaseqpipe.config import vol, star_img, reference_img
+from rnaseqpipe.modules.genomes import (
+    SOURCES,
+    assembly_dir,
+    decompress_fasta,
+    publish_genome,
+    read_chrom_sizes,
+    star_index_params,
+    write_chrom_sizes,
+)
+from rnaseqpipe.modules.salmonindex import fetch
+from rnaseqpipe.modules.stagecache import StageCache
+from rnaseqpipe.modules.metrics import run_stage
+
+app = App("star-index")
+
+image = reference_img(star_img(Image.debian_slim()))
+
+CPUS = 16.0
+MEMORY = 32 * 1024  # 32 GB
+TOOL_VERSION = "STAR-2.7.11b"
+STAR_BIN = "/STAR-2.7.11b/bin/Linux_x86_64_static/STAR"
+LOCAL_BUILD_DIR = "/tmp/star_index"
+SJDB_OVERHANG = 100
+
+
+@app.function(
+    image=image,
+    volumes={"/data": vol},
+    cpu=CPUS,
+    memory=MEMORY,
+    timeout=60 * 60 * 6,
+)
+def make_star_index(
+    assembly_name: str = "R64-1-1",
+    genome: str = None,
+    annotation: str = None,
+    sjdb_overhang: int = SJDB_OVERHANG,
+    force_recompute: bool = False,
+):
+    """Builds and publishes the STAR genome index of an assembly.
+
+    Args:
+        assembly_name (str): assembly, e.g. "R64-1-1"
+        genome (str): (gzipped) genome FASTA path or URL
+        annotation (str): (gzipped) GTF path or URL, the index counts reads per gene
+            only with an annotation. genome and annotation default to
+            genomes.SOURCES.
+        sjdb_overhang (int): read length - 1 the splice junctions are built for
+
+    Returns:
+        str: path of the published index
+    """
+    import gzip
+    import os
+    import shutil
+
+    vol.reload()
+
+    if genome is None:
+        if assembly_name not in SOURCES:
+            raise ValueError(f"make_star_index: No genome for {assembly_name}")
+        genome, annotation = SOURCES[assembly_name]
+
+    sources = os.path.join(assembly_dir(assembly_name), "sources")
+    genome = fetch(genome, sources)
+    annotation = fetch(annotation, sources) if annotation else None
+    vol.commit()
+
+    inputs = [genome] + ([annotation] if annotation else [])
+    cache = StageCache(
+        os.path.join(assembly_dir(assembly_name), ".stagecache"),
+        "star_index",
+        TOOL_VERSION,
+        f"genomeGenerate --sjdbOverhang {sjdb_overhang} {MEMORY}",
+        inputs,
+    )
+    name = f"star-{cache.current_key()[:12]}"
+    index = os.path.join(assembly_dir(assembly_name), name)
+
+    if os.path.exists(f"{index}/genomeParameters.txt") and not force_recompute:
+        print(f"{assembly_name}:star_index: {index} already exists! Skipping.")
+    else:
+        build_dir = os.path.join(LOCAL_BUILD_DIR, name)
+        local_index = os.path.join(build_dir, "index")
+        shutil.rmtree(build_dir, ignore_errors=True)
+        os.makedirs(local_index)
+
+        # genomeGenerate reads plain FASTA and GTF
+        fasta = os.path.join(build_dir, "genome.fa")
+        genome_length = decompress_fasta(genome, fasta)
+        params = star_index_params(genome_length, MEMORY)
+        print(f"{assembly_name}:star_index: {genome_length} bases, {params}")
+
+        annotation_args = ""
+        if annotation:
+            gtf = os.path.join(build_dir, "annotation.gtf")
+            with (gzip.open if annotation.endswith(".gz") else open)(
+                annotation, "rb"
+            ) as f, open(gtf, "wb") as out:
+                shutil.copyfileobj(f, out, 16 * 1024**2)
+            annotation_args = f"--sjdbGTFfile {gtf} --sjdbOverhang {sjdb_overhang}"
+
+        run_stage(
+            os.path.join("genome-index", assembly_name),
+            "star_index",
+            f"{STAR_BIN} --runMode genomeGenerate --genomeDir {local_index} "
+            f"--genomeFastaFiles {fasta} {annotation_args} "
+            f"--genomeSAindexNbases {params['genomeSAindexNbases']} "
+            f"--genomeSAsparseD {params['genomeSAsparseD']} "
+            f"--runThreadN {int(CPUS)} "
+            f"--limitGenomeGenerateRAM {int(MEMORY * 1024**2 * 0.9)} "
+            f"--outTmpDir {build_dir}/_STARtmp --outFileNamePrefix {build_dir}/",
+            inputs=inputs,
+            outputs=[local_index],
+            cpu=CPUS,
+            memory=MEMORY,
+        )
+        # The bigwigs take the chromosome sizes from the index, see genomes.py
+        write_chrom_sizes(
+            read_chrom_sizes(os.path.join(local_index, "chrNameLength.txt")),
+            os.path.join(local_index, "chrom.sizes"),
+        )
+
+        # Built on local disk, only the finished index is copied to the volume
+        shutil.rmtree(f"{index}.copying", ignore_errors=True)
+        shutil.copytree(local_index, f"{index}.copying")
+        shutil.rmtree(index, ignore_errors=True)
+        os.replace(f"{index}.copying", index)
+        shutil.rmtree(build_dir, ignore_errors=True)
+        cache.record([index])
+
+    publish_genome(assembly_name, name)
+    vol.commit()
+
+    print(f"{assembly_name}:star_index: Published {index}")
+    return index
+
+
+@app.local_entrypoint()
+def run(assembly_name: str = "R64-1-1", genome: str = None, annotation: str = None):
+    print(make_star_index.remote(assembly_name, genome, annotation))
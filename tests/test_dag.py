@@ -0,0 +1,152 @@
+import threading
+import time
+
+import pytest
+
+from rnaseqpipe.modules.dag import (
+    COMPLETED,
+    FAILED,
+    SKIPPED,
+    DAGExecutionError,
+    DAGExecutor,
+    Node,
+    NodeResult,
+    format_report,
+)
+
+
+def recorder(order, name, result=True):
+    def fn():
+        order.append(name)
+        return result
+
+    return fn
+
+
+def fail():
+    raise RuntimeError("boom")
+
+
+def test_nodes_run_after_their_inputs():
+    order = []
+    dag = DAGExecutor(
+        [
+            Node("upload", recorder(order, "upload"), ["bigwig"], ["uploaded"]),
+            Node("star", recorder(order, "star"), ["trimmed"], ["bigwig"]),
+            Node("trim", recorder(order, "trim"), ["reads"], ["trimmed"]),
+        ]
+    )
+
+    results = dag.run(available=["reads"])
+
+    assert order == ["trim", "star", "upload"]
+    assert all(result.status == COMPLETED for result in results.values())
+    assert dag.dependencies("upload") == ["star"]
+
+
+def test_node_starts_without_waiting_for_unrelated_nodes():
+    released = threading.Event()
+
+    def slow():
+        # Only returns once the other branch finished, it never waits on it
+        assert released.wait(timeout=5)
+
+    dag = DAGExecutor(
+        [
+            Node("fastqc", slow, ["reads"], ["report"]),
+            Node("trim", lambda: True, ["reads"], ["trimmed"]),
+            Node("star", released.set, ["trimmed"], ["alignment"]),
+        ]
+    )
+
+    # fastqc fails, and with it the DAG, if star had to wait for it
+    results = dag.run(available=["reads"])
+
+    assert results["fastqc"].status == COMPLETED
+    assert results["star"].started < results["fastqc"].finished
+
+
+def test_failure_skips_dependent_nodes():
+    order = []
+    dag = DAGExecutor(
+        [
+            Node("qc", fail, ["reads"], ["report"], required=False),
+            Node("summary", recorder(order, "summary"), ["report"], ["summary"]),
+            Node("publish", recorder(order, "publish"), ["summary"], required=False),
+            Node("trim", recorder(order, "trim"), ["reads"], ["trimmed"]),
+        ]
+    )
+
+    with pytest.raises(DAGExecutionError) as error:
+        dag.run(available=["reads"])
+
+    results = error.value.results
+    assert results["qc"].status == FAILED
+    assert results["summary"].status == SKIPPED
+    assert results["publish"].status == SKIPPED
+    assert results["trim"].status == COMPLETED
+    assert order == ["trim"]
+
+
+def test_optional_inputs_wait_but_may_fail():
+    order = []
+    dag = DAGExecutor(
+        [
+            Node("qc", fail, ["reads"], ["report"], required=False),
+            Node("star", recorder(order, "star"), ["reads"], ["bigwig"]),
+            Node(
+                "upload",
+                recorder(order, "upload"),
+                ["bigwig"],
+                ["uploaded"],
+                optional_inputs=["report"],
+            ),
+        ]
+    )
+
+    results = dag.run(available=["reads"])
+
+    assert results["qc"].status == FAILED
+    assert results["upload"].status == COMPLETED
+    assert list(results).index("upload") > list(results).index("qc")
+    assert dag.dependencies("upload") == ["qc", "star"]
+
+
+def test_failed_required_node_raises():
+    dag = DAGExecutor(
+        [
+            Node("trim", fail, ["reads"], ["trimmed"]),
+            Node("star", lambda: True, ["trimmed"], ["alignment"]),
+        ]
+    )
+
+    with pytest.raises(DAGExecutionError) as error:
+        dag.run(available=["reads"])
+
+    assert "trim" in str(error.value)
+    assert isinstance(error.value.results["trim"].error, RuntimeError)
+    assert error.value.results["star"].status == SKIPPED
+
+
+def test_unknown_input_is_rejected():
+    dag = DAGExecutor([Node("star", lambda: True, ["trimmed"], ["alignment"])])
+
+    with pytest.raises(ValueError):
+        dag.run(available=["reads"])
+
+
+def test_format_report_lists_timing_per_node():
+    dag = DAGExecutor([Node("trim", lambda: time.sleep(0.05), ["reads"], ["trimmed"])])
+    results = dag.run(available=["reads"])
+    assert results["trim"].wall_seconds >= 0.05
+
+    star = NodeResult("star")
+    star.status, star.started, star.finished = COMPLETED, 100.0, 112.5
+    skipped = NodeResult("upload")
+    skipped.status = SKIPPED
+
+    lines = format_report({"star": star, "upload": skipped}).splitlines()
+
+    assert lines[0].split() == ["node", "status", "wall", "[s]"]
+    assert lines[1].split() == ["star", COMPLETED, "12.5"]
+    assert lines[2].split() == ["upload", SKIPPED, "0.0"]
@@ -0,0 +1,66 @@
+import pytest
+
+from rnaseqpipe.modules.planner import DirectoryBlobStore, build_plan
+
+
+@pytest.fixture
+def store(tmp_path):
+    def write(name, size):
+        (tmp_path / name).write_bytes(b"\0" * size)
+
+    write("SRR1_1.fastq.gz", 100)
+    write("SRR1_2.fastq.gz", 120)
+    write("SRR10.fastq.gz", 500)
+    write("SRR2_1.fastq.gz", 50)
+    write("DRR_lib_a_1.fastq.gz", 300)
+    write("DRR_lib_a_2.fastq.gz", 310)
+    write("my_sample.fq.gz", 40)
+    write("notes.txt", 10)
+    return DirectoryBlobStore(str(tmp_path))
+
+
+def test_pairs_paired_and_single_end_files(store):
+    plan = build_plan(store, ["SRR1", "SRR10"])
+
+    samples = {sample.accession: sample for sample in plan.samples}
+    assert samples["SRR1"].files == ["SRR1_1.fastq.gz", "SRR1_2.fastq.gz"]
+    assert samples["SRR1"].paired
+    assert samples["SRR10"].files == ["SRR10.fastq.gz"]
+    assert not samples["SRR10"].paired
+
+
+def test_missing_mate_is_an_error(store):
+    plan = build_plan(store, ["SRR2", "SRR1"])
+
+    assert plan.invalid == {"SRR2": "incomplete pair, only mate 1"}
+    assert [accession for accession, _ in plan.tasks()] == ["SRR1"]
+
+
+def test_prefix_listing_does_not_match_longer_accessions(store):
+    plan = build_plan(store, ["SRR1", "SRR3"])
+
+    assert plan.tasks() == [("SRR1", ["SRR1_1.fastq.gz", "SRR1_2.fastq.gz"])]
+    assert plan.missing == ["SRR3"]
+
+
+def test_accessions_with_underscores(store):
+    plan = build_plan(store, ["DRR_lib_a", "my_sample"])
+
+    assert plan.tasks() == [
+        ("DRR_lib_a", ["DRR_lib_a_1.fastq.gz", "DRR_lib_a_2.fastq.gz"]),
+        ("my_sample", ["my_sample.fq.gz"]),
+    ]
+
+
+def test_largest_first_with_input_bytes(store):
+    plan = build_plan(store, [])
+
+    assert [(s.accession, s.input_bytes) for s in plan.samples] == [
+        ("DRR_lib_a", 610),
+        ("SRR10", 500),
+        ("SRR1", 220),
+        ("my_sample", 40),
+    ]
+    assert plan.total_bytes == 1370
+    assert list(plan.invalid) == ["SRR2"]
+    assert "4 samples" in plan.summary()
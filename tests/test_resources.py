@@ -0,0 +1,59 @@
+import pytest
+
+from rnaseqpipe.modules.resources import (
+    MEMORY_HEADROOM,
+    calibrate,
+    load_model,
+    plan_resources,
+)
+
+GB = 1024**3
+
+
+def observation(input_gb: float, peak_mb: float) -> dict:
+    return {
+        "stage": "trimgalore",
+        "exit_code": 0,
+        "input_bytes": int(input_gb * GB),
+        "cpu": 4.0,
+        "wall_seconds": 60.0,
+        "peak_rss_kb": peak_mb * 1024,
+        "index_bytes": 0,
+    }
+
+
+def test_calibrate_mixed_small_and_large_inputs(tmp_path):
+    # 1.5 GB of baseline memory, more than the default, plus 100 MB per GB of
+    # input. A per-GB ratio of the 10 MB input alone would be ~50 GB per GB.
+    sizes = [0.01, 0.05, 0.1, 2.0, 10.0, 40.0]
+    observations = [observation(gb, 1536 + 100 * gb) for gb in sizes]
+
+    model = calibrate(observations, load_model(str(tmp_path / "model.json")))
+    params = model["trimgalore"]
+
+    assert params["memory_mb_per_gb"] == pytest.approx(100 * MEMORY_HEADROOM)
+    assert params["base_memory_mb"] == pytest.approx(1536 * MEMORY_HEADROOM)
+
+    # Covers every observation without inflating the large ones
+    for gb in sizes:
+        planned = plan_resources("trimgalore", int(gb * GB), model=model)
+        assert 1536 + 100 * gb <= planned["memory"] <= (1536 + 100 * gb) * 2
+
+
+def test_calibrate_keeps_memory_with_a_single_input_size(tmp_path):
+    model = load_model(str(tmp_path / "model.json"))
+    before = dict(model["trimgalore"])
+
+    calibrate([observation(0.01, 900), observation(0.01, 950)], model)
+
+    assert model["trimgalore"]["base_memory_mb"] == before["base_memory_mb"]
+    assert model["trimgalore"]["memory_mb_per_gb"] == before["memory_mb_per_gb"]
+
+
+def test_plan_resources_clamps_memory(tmp_path):
+    model = load_model(str(tmp_path / "model.json"))
+    model["staralign"]["max_memory_mb"] = 64 * 1024
+
+    planned = plan_resources("staralign", 500 * GB, index_bytes=100 * GB, model=model)
+
+    assert planned["memory"] == 64 * 1024
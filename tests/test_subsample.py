@@ -0,0 +1,27 @@
+import gzip
+
+import pytest
+
+from rnaseqpipe.modules.subsample import HEAD, RESERVOIR, subsample
+
+
+@pytest.fixture
+def read_file(tmp_path):
+    path = tmp_path / "reads.fastq.gz"
+    with gzip.open(path, "wb") as f:
+        for i in range(50):
+            f.write(f"@read{i}\nACGT\n+\nIIII\n".encode())
+    return str(path)
+
+
+@pytest.mark.parametrize("method", [HEAD, RESERVOIR])
+def test_zero_reads(read_file, method):
+    assert subsample([read_file], 0, method) == [[]]
+
+
+def test_reservoir_keeps_input_order(read_file):
+    (records,) = subsample([read_file], 10, RESERVOIR, seed=1)
+
+    numbers = [int(record.split(b"\n", 1)[0][len(b"@read") :]) for record in records]
+    assert len(numbers) == 10
+    assert numbers == sorted(numbers)